@@ -0,0 +1,51 @@
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """The request was not admitted, the caller should retry later."""
+
+
+class AdmissionControl:
+    """Caps the requests in flight, with a bounded queue of requests waiting for a slot.
+
+    A request arriving to a full queue, or waiting longer than `queue_timeout` seconds,
+    is rejected with `Overloaded` right away instead of piling onto the LLM and database.
+    """
+
+    def __init__(self, max_in_flight: int, max_queued: int, queue_timeout: float = 5.0):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.queued = 0
+        self.rejected = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self.max_in_flight - self.semaphore._value
+
+    def reject(self, reason: str) -> Overloaded:
+        self.rejected += 1
+        logger.warning(f"Rejected a request, {reason} ({self.in_flight} in flight)")
+        return Overloaded(reason)
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.semaphore.locked() and self.queued >= self.max_queued:
+            raise self.reject("queue is full")
+        self.queued += 1
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await self.semaphore.acquire()
+        except TimeoutError:
+            raise self.reject(f"queued for over {self.queue_timeout}s") from None
+        finally:
+            self.queued -= 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
@@ -0,0 +1,390 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+from chunk_store import ChunkStore, top_k
+
+logger = logging.getLogger(__name__)
+
+
+def unit_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def nearest(data: np.ndarray, centroids: np.ndarray, inner_product: bool = False) -> np.ndarray:
+    """Index of the nearest centroid of each row, by inner product or L2 distance."""
+    labels = np.empty(len(data), dtype=np.int32)
+    squared = None if inner_product else (centroids**2).sum(axis=1)
+    # in batches, so the distance matrix stays small for large inputs
+    for start in range(0, len(data), 16384):
+        products = data[start : start + 16384] @ centroids.T
+        labels[start : start + 16384] = (
+            products.argmax(axis=1) if inner_product else (squared - 2 * products).argmin(axis=1)
+        )
+    return labels
+
+
+def kmeans(
+    data: np.ndarray,
+    clusters: int,
+    iterations: int = 10,
+    seed: int = 0,
+    spherical: bool = False,
+) -> np.ndarray:
+    """Lloyd's k-means, with unit length centroids and cosine assignment for `spherical`."""
+    rng = np.random.default_rng(seed)
+    clusters = min(clusters, len(data))
+    centroids = data[rng.choice(len(data), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest(data, centroids, inner_product=spherical)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=clusters)
+        present = np.flatnonzero(counts)
+        sums = np.add.reduceat(data[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[present])
+        centroids[present] = sums / counts[present, None]
+        # reseed empty clusters on random rows
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+        if spherical:
+            centroids = unit_rows(centroids)
+    return centroids
+
+
+class ANNIndex(ABC):
+    """Approximate cosine top-k over the rows of a ChunkStore.
+
+    Rows are added incrementally as they are loaded or uploaded, and deleted rows are
+    tombstoned, skipped by searches and dropped from the index when it is next saved.
+    Rows of the store that aren't indexed yet are scored exactly, so results never
+    miss a recent upload. Backends implement `train`, `_add`, `_candidates` and their
+    part of the saved state, see `IVFPQIndex`.
+    """
+
+    backend = ""
+
+    def __init__(self, **params):
+        self.params = params
+        self.ndim: int | None = None
+        self.indexed = np.zeros(0, dtype=bool)
+        self.deleted = np.zeros(0, dtype=bool)
+
+    @property
+    def trained(self) -> bool:
+        return self.ndim is not None
+
+    def __len__(self) -> int:
+        return int(self.indexed.sum() - (self.indexed & self.deleted).sum())
+
+    def _grow(self, size: int) -> None:
+        if size > len(self.indexed):
+            self.indexed = np.concatenate([self.indexed, np.zeros(size - len(self.indexed), bool)])
+            self.deleted = np.concatenate([self.deleted, np.zeros(size - len(self.deleted), bool)])
+
+    @abstractmethod
+    def train(self, embeddings: np.ndarray) -> None:
+        ...
+
+    @abstractmethod
+    def _add(self, rows: np.ndarray, embeddings: np.ndarray) -> None:
+        ...
+
+    @abstractmethod
+    def _candidates(
+        self, query: np.ndarray, k: int, allowed: np.ndarray | None
+    ) -> np.ndarray:
+        """Indexed rows likely to hold the top-k of a unit `query`, to be scored exactly."""
+
+    def add(self, rows: np.ndarray, embeddings: np.ndarray) -> None:
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        self._grow(int(rows.max()) + 1)
+        rows, embeddings = rows[~self.indexed[rows]], np.asarray(embeddings)[~self.indexed[rows]]
+        self._add(rows, unit_rows(embeddings))
+        self.indexed[rows] = True
+
+    def add_missing(self, chunks: ChunkStore) -> int:
+        """Index the rows of `chunks` that aren't yet, returns how many were added."""
+        self._grow(len(chunks))
+        missing = np.flatnonzero(~self.indexed[: len(chunks)])
+        for start in range(0, len(missing), 65536):
+            batch = missing[start : start + 65536]
+            self.add(batch, chunks.embeddings[batch])
+        return len(missing)
+
+    def delete(self, rows: np.ndarray) -> None:
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows):
+            self._grow(int(rows.max()) + 1)
+            self.deleted[rows] = True
+
+    def search(
+        self,
+        chunks: ChunkStore,
+        queries: np.ndarray,
+        k: int,
+        rows: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k rows of `chunks` among `rows` (all when None) for each query.
+
+        Same shapes as `ShardedSearch.search_batch`. A query whose candidates come up
+        short of k, for example under a narrow filter, is answered exactly instead.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        # snapshot the size, rows appended during the search are not scored
+        size = len(chunks)
+        allowed = None
+        if rows is not None:
+            allowed = np.zeros(size, dtype=bool)
+            allowed[rows[rows < size]] = True
+        indexed = np.zeros(size, dtype=bool)
+        count = min(size, len(self.indexed))
+        indexed[:count] = self.indexed[:count] & ~self.deleted[:count]
+        unindexed = np.ones(size, dtype=bool)
+        unindexed[:count] = ~self.indexed[:count] & ~self.deleted[:count]
+        if allowed is not None:
+            unindexed &= allowed
+        unindexed = np.flatnonzero(unindexed)
+        searchable = int(indexed.sum() if allowed is None else (indexed & allowed).sum())
+        k = min(k, searchable + len(unindexed))
+
+        top_rows = np.empty((len(queries), k), dtype=np.int64)
+        top_scores = np.empty((len(queries), k), dtype=np.float32)
+        for i, query in enumerate(queries):
+            candidates = self._candidates(unit_rows(query), k, allowed)
+            candidates = candidates[candidates < size]
+            candidates = np.concatenate([candidates[indexed[candidates]], unindexed])
+            if len(candidates) < k:
+                # too few candidates, score everything the query may return
+                candidates = np.flatnonzero(indexed if allowed is None else indexed & allowed)
+                candidates = np.concatenate([candidates, unindexed])
+            top, scores = top_k(
+                chunks.embeddings[candidates], chunks.norms[candidates], query[None], k
+            )
+            top_rows[i], top_scores[i] = candidates[top[0]], scores[0]
+        return top_rows, top_scores
+
+    @abstractmethod
+    def _state(self) -> dict[str, np.ndarray]:
+        """Backend arrays to save, per-row arrays are indexed by row."""
+
+    @abstractmethod
+    def _restore(self, state: dict[str, np.ndarray], rows: np.ndarray, size: int) -> None:
+        """Inverse of `_state`, `rows` maps saved rows to rows of the new store (-1 if gone)."""
+
+    def save(self, path: Path | str, chunks: ChunkStore, meta: dict | None = None) -> None:
+        """Write the index to `path`, keyed by chunk id so it can be loaded into a new store.
+
+        Tombstoned rows and rows without an id (uploaded since the load) are left out,
+        the latter are indexed again after the next load.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        count = min(len(chunks), len(self.indexed))
+        saved = np.flatnonzero(self.indexed[:count] & ~self.deleted[:count])
+        ids = [chunks.ids[row] for row in saved]
+        saved = saved[np.array([chunk_id is not None for chunk_id in ids], dtype=bool)]
+        state = self._state()
+        arrays = {
+            key: (value[saved] if key.startswith("row_") else value)
+            for key, value in state.items()
+        }
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                meta=np.array(
+                    json.dumps(
+                        {
+                            "backend": self.backend,
+                            "params": self.params,
+                            "ndim": self.ndim,
+                            **(meta or {}),
+                        }
+                    )
+                ),
+                ids=np.array([chunks.ids[row] for row in saved], dtype=str),
+                **arrays,
+            )
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path: Path | str, chunks: ChunkStore) -> tuple["ANNIndex", dict]:
+        """The index saved at `path` mapped onto the rows of `chunks`, and its metadata.
+
+        Rows of `chunks` missing from the saved index are left unindexed, see `add_missing`.
+        """
+        with np.load(path, allow_pickle=False) as saved:
+            meta = json.loads(str(saved["meta"]))
+            state = {key: saved[key] for key in saved.files if key not in ("meta", "ids")}
+            ids = saved["ids"].tolist()
+        index = ANN_BACKENDS[meta["backend"]](**meta["params"])
+        index.ndim = meta["ndim"]
+        row_of = {chunk_id: row for row, chunk_id in enumerate(chunks.ids) if chunk_id is not None}
+        rows = np.array([row_of.get(chunk_id, -1) for chunk_id in ids], dtype=np.int64)
+        index._grow(len(chunks))
+        index._restore(state, rows, len(chunks))
+        index.indexed[rows[rows >= 0]] = True
+        return index, meta
+
+
+class IVFPQIndex(ANNIndex):
+    """Inverted file index over product quantized residuals (IVF-PQ).
+
+    Rows are assigned to the nearest of `nlist` k-means centroids, 4 * sqrt(rows) when
+    None. A query scans the rows of its `nprobe` nearest lists, estimates their scores
+    from `pq_m` one-byte codes per row, and scores the best `refine` * k exactly from
+    the full vectors in the store. Raising `nprobe` and `refine` trades speed for recall,
+    `pq_m=0` skips the codes and scores every scanned row exactly.
+    """
+
+    backend = "ivfpq"
+
+    def __init__(
+        self,
+        nlist: int | None = None,
+        nprobe: int = 16,
+        pq_m: int = 48,
+        refine: int = 8,
+        train_size: int = 65536,
+        iterations: int = 10,
+        seed: int = 0,
+    ):
+        super().__init__(
+            nlist=nlist,
+            nprobe=nprobe,
+            pq_m=pq_m,
+            refine=refine,
+            train_size=train_size,
+            iterations=iterations,
+            seed=seed,
+        )
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.refine = refine
+        self.train_size = train_size
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        # (pq_m, 256, ndim / pq_m) sub-vector centroids of the residuals
+        self.codebooks = np.zeros((0, 0, 0), dtype=np.float32)
+        # rows of each list, in insertion order
+        self.lists: list[np.ndarray] = []
+        self.row_lists = np.zeros(0, dtype=np.int32)
+        self.row_codes = np.zeros((0, pq_m), dtype=np.uint8)
+
+    def train(self, embeddings: np.ndarray) -> None:
+        embeddings = np.asarray(embeddings)
+        ndim = embeddings.shape[1]
+        if self.pq_m and ndim % self.pq_m:
+            raise ValueError(f"pq_m={self.pq_m} must divide the embedding size {ndim}")
+        rng = np.random.default_rng(self.seed)
+        sample = embeddings
+        if len(sample) > self.train_size:
+            sample = sample[np.sort(rng.choice(len(sample), self.train_size, replace=False))]
+        sample = unit_rows(sample)
+        nlist = self.nlist or max(1, int(4 * math.sqrt(len(embeddings))))
+        self.centroids = kmeans(
+            sample, nlist, self.iterations, self.seed, spherical=True
+        ).astype(np.float32)
+        if self.pq_m:
+            # 32 rows per code are plenty for the sub-space codebooks
+            pq_sample = sample[rng.permutation(len(sample))[: 256 * 32]]
+            labels = nearest(pq_sample, self.centroids, inner_product=True)
+            residuals = pq_sample - self.centroids[labels]
+            self.codebooks = np.stack(
+                [
+                    kmeans(np.ascontiguousarray(sub), 256, self.iterations, self.seed + j)
+                    for j, sub in enumerate(np.split(residuals, self.pq_m, axis=1))
+                ]
+            ).astype(np.float32)
+        self.lists = [np.zeros(0, dtype=np.int64) for _ in range(len(self.centroids))]
+        self.row_lists = np.zeros(0, dtype=np.int32)
+        self.row_codes = np.zeros((0, self.pq_m), dtype=np.uint8)
+        self.ndim = ndim
+
+    def _grow(self, size: int) -> None:
+        if size > len(self.row_lists):
+            extra = size - len(self.row_lists)
+            self.row_lists = np.concatenate([self.row_lists, np.full(extra, -1, np.int32)])
+            self.row_codes = np.concatenate(
+                [self.row_codes, np.zeros((extra, self.pq_m), np.uint8)]
+            )
+        super()._grow(size)
+
+    def _encode(self, residuals: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(residuals), self.pq_m), dtype=np.uint8)
+        for j, sub in enumerate(np.split(residuals, self.pq_m, axis=1)):
+            codes[:, j] = nearest(sub, self.codebooks[j])
+        return codes
+
+    def _add(self, rows: np.ndarray, embeddings: np.ndarray) -> None:
+        labels = nearest(embeddings, self.centroids, inner_product=True)
+        self.row_lists[rows] = labels
+        if self.pq_m:
+            self.row_codes[rows] = self._encode(embeddings - self.centroids[labels])
+        # group by list, so each touched list is extended once
+        order = np.argsort(labels, kind="stable")
+        touched, starts = np.unique(labels[order], return_index=True)
+        for label, group in zip(touched, np.split(rows[order], starts[1:]), strict=True):
+            self.lists[label] = np.concatenate([self.lists[label], group])
+
+    def _candidates(
+        self, query: np.ndarray, k: int, allowed: np.ndarray | None
+    ) -> np.ndarray:
+        coarse = self.centroids @ query
+        nprobe = min(self.nprobe, len(coarse))
+        probe = np.argpartition(-coarse, nprobe - 1)[:nprobe]
+        candidates = np.concatenate([self.lists[label] for label in probe])
+        candidates = candidates[~self.deleted[candidates]]
+        if allowed is not None:
+            candidates = candidates[candidates < len(allowed)]
+            candidates = candidates[allowed[candidates]]
+        shortlist = self.refine * k
+        if not self.pq_m or len(candidates) <= shortlist:
+            return candidates
+        # inner products of the query with every code of every sub-space
+        tables = np.einsum(
+            "jd,jcd->jc", query.reshape(self.pq_m, -1), self.codebooks
+        ).ravel()
+        offsets = np.arange(self.pq_m, dtype=np.intp) * self.codebooks.shape[1]
+        estimates = coarse[self.row_lists[candidates]] + np.take(
+            tables, self.row_codes[candidates] + offsets
+        ).sum(axis=1)
+        return candidates[np.argpartition(-estimates, shortlist - 1)[:shortlist]]
+
+    def _state(self) -> dict[str, np.ndarray]:
+        return {
+            "centroids": self.centroids,
+            "codebooks": self.codebooks,
+            "row_lists": self.row_lists,
+            "row_codes": self.row_codes,
+        }
+
+    def _restore(self, state: dict[str, np.ndarray], rows: np.ndarray, size: int) -> None:
+        self.centroids = state["centroids"]
+        self.codebooks = state["codebooks"]
+        self.row_lists = np.full(size, -1, dtype=np.int32)
+        self.row_codes = np.zeros((size, self.pq_m), dtype=np.uint8)
+        kept = rows >= 0
+        self.row_lists[rows[kept]] = state["row_lists"][kept]
+        self.row_codes[rows[kept]] = state["row_codes"][kept]
+        self.lists = [np.zeros(0, dtype=np.int64) for _ in range(len(self.centroids))]
+        indexed = np.sort(rows[kept])
+        labels = self.row_lists[indexed]
+        order = np.argsort(labels, kind="stable")
+        touched, starts = np.unique(labels[order], return_index=True)
+        for label, group in zip(touched, np.split(indexed[order], starts[1:]), strict=True):
+            self.lists[label] = group
+
+
+# backends by name, for SupabaseStore.ann_backend
+ANN_BACKENDS: dict[str, type[ANNIndex]] = {IVFPQIndex.backend: IVFPQIndex}
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+import time
+
+import numpy as np
+from pydantic import BaseModel
+
+from single_flight import normalize_question
+
+
+class CachedAnswer(BaseModel):
+    """Where an answer served from the cache came from."""
+
+    question: str
+    similarity: float
+    # seconds since the cached answer was made
+    age: float
+    corpus_version: str
+
+
+@dataclass
+class Entry:
+    partition: str
+    question: str
+    embedding: np.ndarray | None
+    answer: object
+    corpus_version: str
+    created_at: float
+
+
+class AnswerCache:
+    """Recent answers, reused for repeats and for questions that mean the same.
+
+    An answer is reused for a question in the same partition (settings and filters)
+    whose embedding is within `threshold` cosine similarity, or only for the same
+    normalized question when `threshold` is None. Answers are only reused within the
+    corpus version they were made for, entries of older versions are dropped.
+    """
+
+    def __init__(
+        self, threshold: float | None = 0.95, max_entries: int = 1024, ttl: float = 24 * 3600
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (partition, normalized question) -> entry, least recently used first
+        self.entries: OrderedDict[tuple[str, str], Entry] = OrderedDict()
+        self.hits = self.misses = self.invalidated = 0
+        self.hit_ages: list[float] = []
+
+    def _evict(self, corpus_version: str) -> None:
+        # callers hold self.lock
+        now = time.time()
+        for key, entry in list(self.entries.items()):
+            if entry.corpus_version != corpus_version or now - entry.created_at > self.ttl:
+                del self.entries[key]
+                self.invalidated += 1
+
+    def get(
+        self,
+        partition: str,
+        question: str,
+        corpus_version: str,
+        embedding: np.ndarray | None = None,
+    ) -> tuple[object, CachedAnswer] | None:
+        """The cached answer and where it came from, None on a miss."""
+        key = (partition, normalize_question(question))
+        with self.lock:
+            self._evict(corpus_version)
+            entry, similarity = self.entries.get(key), 1.0
+            if entry is None and self.threshold is not None and embedding is not None:
+                candidates = [
+                    e
+                    for e in self.entries.values()
+                    if e.partition == partition and e.embedding is not None
+                ]
+                if candidates:
+                    similarities = np.stack([e.embedding for e in candidates]) @ unit(embedding)
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.threshold:
+                        entry, similarity = candidates[best], float(similarities[best])
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((entry.partition, entry.question))
+            self.hits += 1
+            age = time.time() - entry.created_at
+            self.hit_ages = [*self.hit_ages[-999:], age]
+            return entry.answer, CachedAnswer(
+                question=entry.question,
+                similarity=similarity,
+                age=age,
+                corpus_version=entry.corpus_version,
+            )
+
+    def put(
+        self,
+        partition: str,
+        question: str,
+        corpus_version: str,
+        answer: object,
+        embedding: np.ndarray | None = None,
+    ) -> None:
+        key = (partition, normalize_question(question))
+        with self.lock:
+            self._evict(corpus_version)
+            self.entries[key] = Entry(
+                partition=partition,
+                question=key[1],
+                embedding=None if embedding is None else unit(embedding),
+                answer=answer,
+                corpus_version=corpus_version,
+                created_at=time.time(),
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            now = time.time()
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "invalidated": self.invalidated,
+                # staleness, how old answers were when served and how old the oldest is
+                "mean_hit_age": (
+                    sum(self.hit_ages) / len(self.hit_ages) if self.hit_ages else None
+                ),
+                "oldest_entry_age": max(
+                    (now - e.created_at for e in self.entries.values()), default=None
+                ),
+            }
+
+
+def unit(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -1,31 +1,140 @@
+from contextlib import AsyncExitStack, asynccontextmanager
+import asyncio
+import json
+import logging
 import os
 import re
+import tempfile
+import time
 
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 from paperqa import Settings
+from paperqa.llms import EmbeddingModel, LLMModel
+from admission import AdmissionControl, Overloaded
+from jobs import JobQueue
 from quote_docs import (
     CONTEXT_INNER_PROMPT_WITH_QUOTE,
+    AnswerQuoteSettings,
     example_citation_quote,
     point_form_json_system_prompt_with_quote,
     qa_quote_prompt,
     PromptQuoteSettings,
 )
+from scheduler import RateLimit, llm_scheduler
+from single_flight import SingleFlight, normalize_question
+from tracing import collect_trace, metrics
 from upload_docs import UploadDocs
+from utils import AnswerQuotesFormatted, ChunkFilter
 
 
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
+# Gemini 1.5 Flash pay-as-you-go quota, shared by every request this process serves
+llm_scheduler.set_limit(
+    "gemini/gemini-1.5-flash-002",
+    RateLimit(requests_per_minute=2000, tokens_per_minute=4_000_000),
+)
+
 docs = UploadDocs(
     supabase_url=os.environ["SUPABASE_URL"],
     supabase_service_key=os.environ["SUPABASE_SERVICE_KEY"],
+    # questions this similar to an earlier one get its answer, "none" disables it
+    answer_cache_threshold=(
+        None
+        if os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95").lower() == "none"
+        else float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+    ),
+    # load the chunk digests made by `jobs.py` workers run with the same setting
+    chunk_digests=os.environ.get("CHUNK_DIGESTS") == "1",
+    # "ivfpq" searches large corpora approximately, see ann_index.py
+    ann_backend=os.environ.get("ANN_BACKEND") or None,
+    # load the index from a `snapshot.py export` instead of paging through the tables
+    snapshot_path=os.environ.get("SNAPSHOT_PATH") or None,
+)
+
+# identical questions in flight are answered once, also across uvicorn workers
+single_flight = SingleFlight(
+    lock_dir=os.environ.get(
+        "SINGLE_FLIGHT_DIR", os.path.join(tempfile.gettempdir(), "didact-single-flight")
+    )
+)
+
+# queries beyond these are turned away with a 503, rather than all slowing down together
+admission = AdmissionControl(
+    max_in_flight=int(os.environ.get("MAX_QUERIES_IN_FLIGHT", 32)),
+    max_queued=int(os.environ.get("MAX_QUERIES_QUEUED", 64)),
+    queue_timeout=float(os.environ.get("QUERY_QUEUE_TIMEOUT", 5)),
 )
+# seconds a query may take, including its time in the queue
+QUERY_TIMEOUT = float(os.environ.get("QUERY_TIMEOUT", 60))
+# a batch takes a single admission slot, so its size and duration are capped too
+MAX_BATCH_QUERIES = int(os.environ.get("MAX_BATCH_QUERIES", 32))
+BATCH_QUERY_TIMEOUT = float(os.environ.get("BATCH_QUERY_TIMEOUT", 300))
+
+# uploads are queued here and run by `python jobs.py` workers, off the query path
+job_queue = JobQueue(os.environ.get("JOBS_DB", "jobs/jobs.sqlite"))
+# larger documents submitted to /jobs are turned away with a 413
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", 100)) * 2**20
+
+
+# LiteLLM models hold their routers and HTTP clients, so they are built once per settings
+models: dict[str, tuple[LLMModel, LLMModel, EmbeddingModel]] = {}
+
+readiness = {"ready": False, "error": None, "warm_seconds": None}
+
+
+def get_models(settings: Settings) -> tuple[LLMModel, LLMModel, EmbeddingModel]:
+    if settings.md5 not in models:
+        models[settings.md5] = (
+            settings.get_llm(),
+            settings.get_summary_llm(),
+            settings.get_embedding_model(),
+        )
+    return models[settings.md5]
+
+
+async def prewarm(retry_interval: float = 30.0) -> None:
+    """Build the models, load the index and open connections, retrying until it works."""
+    settings = query_settings()
+    while True:
+        start = time.monotonic()
+        try:
+            _, _, embedding_model = get_models(settings)
+            await docs.awarm(settings, embedding_model=embedding_model)
+        except Exception as e:
+            logger.exception("Prewarming failed")
+            readiness["error"] = repr(e)
+            await asyncio.sleep(retry_interval)
+        else:
+            readiness.update(
+                ready=True, error=None, warm_seconds=round(time.monotonic() - start, 3)
+            )
+            logger.info(f"Warm after {readiness['warm_seconds']}s")
+            return
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm in the background, so /healthz answers while /readyz holds traffic back
+    task = None
+    if os.environ.get("PREWARM", "1") == "0":
+        readiness["ready"] = True
+    else:
+        task = asyncio.create_task(prewarm())
+    yield
+    if task is not None:
+        task.cancel()
+    await docs.aclose()
 
 
-app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
+app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None, lifespan=lifespan)
 origins = [
     # "http://localhost",
     # "http://localhost:8080",
@@ -48,25 +157,173 @@ app.add_middleware(
 
 class QueryPayload(BaseModel):
     query: str
+    filters: ChunkFilter | None = None
+    # include per-stage timings and context packing stats in the response
+    timings: bool = False
+    # seconds, picks a faster mode of answering when full summarization would take longer
+    latency_budget: float | None = None
+    # answer from the chunk digests made at upload, without summarizing for the question,
+    # ignored unless the API runs with CHUNK_DIGESTS
+    fast: bool = False
+
+
+def query_settings() -> Settings:
+    return Settings(
+        llm="gemini/gemini-1.5-flash-002",
+        summary_llm="gemini/gemini-1.5-flash-002",
+        embedding="gemini/text-embedding-004",
+        answer=AnswerQuoteSettings(answer_context_token_budget=3000),
+        prompts=PromptQuoteSettings(
+            summary_json_system=point_form_json_system_prompt_with_quote,
+            context_inner=CONTEXT_INNER_PROMPT_WITH_QUOTE,
+            qa=qa_quote_prompt,
+            example_citation_quote=example_citation_quote,
+        ),
+    )
+
+
+async def cancel_on_disconnect(request: Request, task: asyncio.Future, poll_interval: float = 0.5):
+    """Await `task`, cancelling it if the client disconnects first."""
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info("Client disconnected, cancelling its query")
+                task.cancel()
+                # nobody is left to read it
+                return JSONResponse(status_code=499, content={"detail": "Client closed request"})
+    finally:
+        task.cancel()
 
 
 @app.post("/query")
-def send_otp(payload: QueryPayload):
-    response = docs.query(
-        payload.query,
-        settings=Settings(
-            llm="gemini/gemini-1.5-flash-002",
-            summary_llm="gemini/gemini-1.5-flash-002",
-            embedding="gemini/text-embedding-004",
-            prompts=PromptQuoteSettings(
-                summary_json_system=point_form_json_system_prompt_with_quote,
-                context_inner=CONTEXT_INNER_PROMPT_WITH_QUOTE,
-                qa=qa_quote_prompt,
-                example_citation_quote=example_citation_quote,
+async def send_otp(payload: QueryPayload, request: Request):
+    settings = query_settings()
+    # digests are only made with CHUNK_DIGESTS, otherwise every context is summarized
+    settings.answer.evidence_from_digests = payload.fast and docs.chunk_digests
+    deadline = asyncio.get_running_loop().time() + QUERY_TIMEOUT
+    key = json.dumps(
+        [
+            normalize_question(payload.query),
+            settings.md5,
+            payload.filters.cache_key() if payload.filters else None,
+            payload.timings,
+            payload.latency_budget,
+        ],
+        sort_keys=True,
+    )
+    try:
+        # identical questions share one answer, it is cancelled once all their clients left
+        return await cancel_on_disconnect(
+            request,
+            asyncio.ensure_future(
+                single_flight.run(key, lambda: answer_query(payload, settings, deadline))
             ),
         )
-    )
+    except Overloaded as e:
+        return JSONResponse(
+            status_code=503, content={"detail": f"Overloaded, {e}"}, headers={"Retry-After": "1"}
+        )
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail="Query timed out") from None
+
+
+async def answer_query(payload: QueryPayload, settings: Settings, deadline: float) -> dict:
+    llm_model, summary_llm_model, embedding_model = get_models(settings)
+    async with admission.admit():
+        with collect_trace() as trace:
+            response = await docs.aquery(
+                payload.query,
+                settings=settings,
+                llm_model=llm_model,
+                summary_llm_model=summary_llm_model,
+                embedding_model=embedding_model,
+                filters=payload.filters,
+                deadline=deadline,
+                latency_budget=payload.latency_budget,
+            )
+
+    result = format_response(response)
+    if payload.timings:
+        result["timings"] = trace.timings()
+        result["packing"] = response.packing.model_dump() if response.packing else None
+    return result
+
 
+class BatchQueryPayload(BaseModel):
+    queries: list[str]
+    filters: ChunkFilter | None = None
+
+
+@app.post("/query/batch")
+async def batch_query(payload: BatchQueryPayload):
+    """Streams one JSON line per question, in the order they finish.
+
+    Questions still unanswered after BATCH_QUERY_TIMEOUT get an error line.
+    """
+    if len(payload.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(
+            status_code=400, detail=f"Batches are limited to {MAX_BATCH_QUERIES} questions"
+        )
+    settings = query_settings()
+    llm_model, summary_llm_model, embedding_model = get_models(settings)
+    deadline = asyncio.get_running_loop().time() + BATCH_QUERY_TIMEOUT
+
+    slot = AsyncExitStack()
+    try:
+        await slot.enter_async_context(admission.admit())
+    except Overloaded as e:
+        return JSONResponse(
+            status_code=503, content={"detail": f"Overloaded, {e}"}, headers={"Retry-After": "1"}
+        )
+
+    lines: asyncio.Queue[str | None] = asyncio.Queue()
+
+    async def answer() -> None:
+        # a task holds the slot, so it is released even if the response never streams
+        async with slot:
+            try:
+                async for index, response in docs.aquery_batch(
+                    payload.queries,
+                    settings=settings,
+                    llm_model=llm_model,
+                    summary_llm_model=summary_llm_model,
+                    embedding_model=embedding_model,
+                    filters=payload.filters,
+                    deadline=deadline,
+                ):
+                    if isinstance(response, Exception):
+                        line = {
+                            "index": index,
+                            "question": payload.queries[index],
+                            "error": "Query timed out"
+                            if isinstance(response, TimeoutError)
+                            else str(response),
+                        }
+                    else:
+                        line = {"index": index, **format_response(response)}
+                    lines.put_nowait(json.dumps(line) + "\n")
+            except Exception:
+                logger.exception("Batch query failed")
+            finally:
+                lines.put_nowait(None)
+
+    task = asyncio.ensure_future(answer())
+
+    async def stream():
+        try:
+            while (line := await lines.get()) is not None:
+                yield line
+        finally:
+            # stops the batch when the client leaves early
+            task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def format_response(response: AnswerQuotesFormatted) -> dict:
     # Convert citations into <cite> tags
     docnames = "|".join(set(b.text.doc.docname for b in response.bib.values()))
     citation_group_pattern = re.compile(f"\\(({docnames}) pages \\d+-\\d+( quote\\d+(, quote\\d+)*)?((,|;) ({docnames}) pages \\d+-\\d+( quote\\d+((,|;) quote\\d+)*)?)*\\)")
@@ -85,24 +342,123 @@ def send_otp(payload: QueryPayload):
         new_text = re.sub(citation_single_pattern, replace_individual_citations, text)
         return f"<cite>{new_text}</cite>"
 
-    response.answer = re.sub(citation_group_pattern, replace_with_tag, response.answer.strip())
+    answer_text = re.sub(citation_group_pattern, replace_with_tag, response.answer.strip())
 
     period_citation_pattern = re.compile(f"\\.\\s*?(?P<citation><cite>.*?</cite>)")
     def move_period_mark(match: re.Match):
         return f"{match.groupdict()['citation']}."
     
-    response.answer = re.sub(period_citation_pattern, move_period_mark, response.answer)
+    answer_text = re.sub(period_citation_pattern, move_period_mark, answer_text)
+
+    # full, reduced, digest, skip_summary or cache_only, see latency_budget.plan_query
+    mode = response.plan.mode if response.plan else "full"
+    if response.digested_contexts:
+        mode = "digest"
+    elif mode == "digest":
+        # no retrieved chunk had a digest, so all of them were summarized
+        mode = "full"
 
     # Format response
     return {
         "question": response.question,
-        "text": response.answer,
+        "text": answer_text,
+        "mode": mode,
+        # the question it was answered for and how old the answer is, when reused
+        "cached": response.cached.model_dump() if response.cached else None,
         "references": [
             {
                 "id": b.text.name,
                 "value": b.text.doc.citation,
                 "pages": b.text.pages,
-                "quotes": b.points,
+                "quotes": (b.model_extra or {}).get("points") or [],
             } for b in response.bib.values()
         ]
     }
+
+
+@app.post("/jobs")
+async def submit_job(
+    request: Request,
+    filename: str,
+    title: str | None = None,
+    abstract: str | None = None,
+    citation: str | None = None,
+    priority: int = 0,
+):
+    """Queue a document for ingestion, the request body is the raw file."""
+    too_large = HTTPException(
+        status_code=413, detail=f"Documents are limited to {MAX_UPLOAD_BYTES} bytes"
+    )
+    if int(request.headers.get("content-length") or 0) > MAX_UPLOAD_BYTES:
+        raise too_large
+    # the header may be missing or wrong, so the body is counted as it arrives
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise too_large
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty document")
+    params = {"title": title, "abstract": abstract, "citation": citation}
+    # writes the file and the queue database, which can wait on the lock
+    job_id = await asyncio.to_thread(
+        job_queue.submit_file,
+        filename,
+        bytes(data),
+        params={k: v for k, v in params.items() if v is not None},
+        priority=priority,
+    )
+    return {"id": job_id}
+
+
+@app.get("/jobs")
+def list_jobs(status: str | None = None, limit: int = 100):
+    return {
+        "counts": job_queue.counts(),
+        "jobs": [j.model_dump(mode="json") for j in job_queue.recent(status, limit)],
+    }
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.model_dump(mode="json")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
+
+
+@app.get("/healthz")
+def healthz():
+    """Liveness, the process is up and serving requests."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    """Readiness, the index is loaded and connections are open."""
+    if not readiness["ready"]:
+        return JSONResponse(
+            status_code=503, content={"status": "warming", "error": readiness["error"]}
+        )
+    status = {
+        "status": "ready",
+        "warm_seconds": readiness["warm_seconds"],
+        "queries_in_flight": admission.in_flight,
+        "queries_queued": admission.queued,
+        "queries_rejected": admission.rejected,
+        "answer_cache": docs.answer_cache.stats(),
+    }
+    # without prewarming the index loads with the first query
+    if docs.store.loaded:
+        chunks = docs.store.chunks
+        status |= {
+            "chunks": len(chunks),
+            "documents": len(chunks.documents),
+            "embedding_version": chunks.embedding_version,
+        }
+    return status
@@ -0,0 +1,254 @@
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import patch
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from paperqa import Settings
+from paperqa.settings import AnswerSettings, ParsingSettings
+
+from fake_postgrest import FAKE_SERVICE_KEY, FakePostgREST
+from fakes import (
+    FakeEmbeddingModel,
+    FakeLLMModel,
+    synthetic_corpus,
+    synthetic_questions,
+    write_synthetic_documents,
+)
+from quote_docs import (
+    CONTEXT_INNER_PROMPT_WITH_QUOTE,
+    example_citation_quote,
+    point_form_json_system_prompt_with_quote,
+    qa_quote_prompt,
+    PromptQuoteSettings,
+)
+from tracing import metrics
+from upload_docs import UploadDocs
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict[str, float]:
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "n": len(latencies),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "throughput": len(latencies) / elapsed,
+    }
+
+
+async def measure(
+    fn: Callable[[int], Awaitable], iterations: int, concurrency: int
+) -> dict[str, float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await fn(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(iterations)])
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def measure_sync(fn: Callable[[int], object], iterations: int, concurrency: int) -> dict[str, float]:
+    latencies = []
+
+    def one(i: int):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(iterations)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_settings(evidence_k: int) -> Settings:
+    return Settings(
+        prompts=PromptQuoteSettings(
+            summary_json_system=point_form_json_system_prompt_with_quote,
+            context_inner=CONTEXT_INNER_PROMPT_WITH_QUOTE,
+            qa=qa_quote_prompt,
+            example_citation_quote=example_citation_quote,
+        ),
+        # keep ingestion offline, DocMetadataClient would call Crossref/Semantic Scholar
+        parsing=ParsingSettings(use_doc_details=False),
+        answer=AnswerSettings(evidence_k=evidence_k),
+    )
+
+
+def seed(fake: FakePostgREST, size: int, ndim: int) -> None:
+    for documents, chunks in synthetic_corpus(size, ndim=ndim):
+        fake.insert("documents", documents)
+        fake.insert("chunks", chunks)
+
+
+async def bench_size(size: int, args: argparse.Namespace) -> dict[str, dict[str, float]]:
+    results: dict[str, dict[str, float]] = {}
+    with FakePostgREST(latency=args.db_latency, max_rows=args.max_rows) as fake:
+        start = time.perf_counter()
+        seed(fake, size, args.ndim)
+        print(f"  seeded {size} chunks in {time.perf_counter() - start:.1f}s")
+
+        embedding_model = FakeEmbeddingModel(ndim=args.ndim, latency=args.embedding_latency)
+        llm_model = FakeLLMModel(latency=args.llm_latency)
+        settings = bench_settings(args.evidence_k)
+        questions = itertools.cycle(synthetic_questions(1000))
+
+        docs = UploadDocs(
+            supabase_url=fake.url,
+            supabase_service_key=FAKE_SERVICE_KEY,
+            lazy_text=args.lazy_text,
+        )
+
+        start = time.perf_counter()
+        await docs.retrieve_texts(next(questions), args.k, settings, embedding_model)
+        results["cold load"] = summarize([time.perf_counter() - start], time.perf_counter() - start)
+
+        results["retrieve_texts"] = await measure(
+            lambda _: docs.retrieve_texts(next(questions), args.k, settings, embedding_model),
+            args.iterations,
+            args.concurrency,
+        )
+        results["aget_evidence"] = await measure(
+            lambda _: docs.aget_evidence(
+                next(questions),
+                settings=settings,
+                embedding_model=embedding_model,
+                summary_llm_model=llm_model,
+            ),
+            args.iterations,
+            args.concurrency,
+        )
+        results["aquery"] = await measure(
+            lambda _: docs.aquery(
+                next(questions),
+                settings=settings,
+                llm_model=llm_model,
+                summary_llm_model=llm_model,
+                embedding_model=embedding_model,
+            ),
+            args.iterations,
+            args.concurrency,
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_synthetic_documents(Path(directory), args.uploads, seed=size)
+            results["aupload"] = await measure(
+                lambda i: docs.aupload(
+                    paths[i],
+                    settings=settings,
+                    llm_model=llm_model,
+                    embedding_model=embedding_model,
+                ),
+                args.uploads,
+                args.concurrency,
+            )
+
+        results["/query"] = bench_endpoint(fake, embedding_model, llm_model, questions, args)
+    return results
+
+
+def bench_endpoint(
+    fake: FakePostgREST,
+    embedding_model: FakeEmbeddingModel,
+    llm_model: FakeLLMModel,
+    questions,
+    args: argparse.Namespace,
+) -> dict[str, float]:
+    os.environ["SUPABASE_URL"] = fake.url
+    os.environ["SUPABASE_SERVICE_KEY"] = FAKE_SERVICE_KEY
+    from fastapi.testclient import TestClient
+
+    import api
+
+    api.docs = UploadDocs(
+        supabase_url=fake.url,
+        supabase_service_key=FAKE_SERVICE_KEY,
+        lazy_text=args.lazy_text,
+    )
+    client = TestClient(api.app)
+    # the endpoint builds its models from hard-coded Settings, swap in the stand-ins
+    with (
+        patch.object(Settings, "get_llm", lambda self: llm_model),
+        patch.object(Settings, "get_summary_llm", lambda self: llm_model),
+        patch.object(Settings, "get_embedding_model", lambda self: embedding_model),
+    ):
+        # first request pays for the cold load
+        client.post("/query", json={"query": next(questions)}).raise_for_status()
+        return measure_sync(
+            lambda _: client.post("/query", json={"query": next(questions)}).raise_for_status(),
+            args.iterations,
+            args.concurrency,
+        )
+
+
+def format_results(size: int, results: dict[str, dict[str, float]]) -> str:
+    lines = [
+        f"corpus={size} chunks",
+        f"{'stage':<16} {'n':>5} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>10}",
+    ]
+    for stage, r in results.items():
+        lines.append(
+            f"{stage:<16} {r['n']:>5} {r['p50_ms']:>10.1f} {r['p95_ms']:>10.1f}"
+            f" {r['p99_ms']:>10.1f} {r['throughput']:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def format_stages() -> str:
+    """Mean time per traced stage, across everything run since the last reset."""
+    lines = [f"{'traced stage':<24} {'n':>7} {'mean ms':>10} {'total s':>10}"]
+    for stage, histogram in sorted(metrics.stages.items()):
+        lines.append(
+            f"{stage:<24} {histogram.count:>7} {1000 * histogram.sum / histogram.count:>10.2f}"
+            f" {histogram.sum:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main(args: argparse.Namespace):
+    report = []
+    for size in args.sizes:
+        print(f"Benchmarking {size} chunks...")
+        metrics.reset()
+        results = asyncio.run(bench_size(size, args))
+        report.append(format_results(size, results) + "\n\n" + format_stages())
+        print(report[-1] + "\n")
+    if args.output:
+        Path(args.output).write_text("\n\n".join(report) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Offline latency/throughput benchmark against a local PostgREST fake and"
+            " deterministic embedding and LLM stand-ins."
+        )
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--ndim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--evidence-k", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--uploads", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per LLM call")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="seconds per embedding call")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds per PostgREST request")
+    parser.add_argument("--max-rows", type=int, default=1000, help="PostgREST db-max-rows")
+    parser.add_argument("--lazy-text", action="store_true")
+    parser.add_argument("--output", help="also write the report here, e.g. bench_output.txt")
+    main(parser.parse_args())
@@ -0,0 +1,149 @@
+from pathlib import Path
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from ann_index import ANNIndex, IVFPQIndex
+from bench_search import synthetic_store
+from chunk_store import ChunkStore, top_k
+
+
+def clustered(
+    count: int, centers: np.ndarray, spread: float, rng: np.random.Generator
+) -> np.ndarray:
+    vectors = centers[rng.integers(0, len(centers), count)]
+    return vectors + spread * rng.standard_normal(vectors.shape, dtype=np.float32)
+
+
+def clustered_store(
+    rows: int, ndim: int, clusters: int, spread: float, seed: int = 0
+) -> tuple[ChunkStore, np.ndarray]:
+    """A store of rows around `clusters` random centers, like embeddings of related topics.
+
+    Independent gaussian rows (`clusters=0`) have no neighbourhood structure and are
+    the worst case for any ANN index. Returns the store and the centers, to draw queries from.
+    """
+    if not clusters:
+        chunks = synthetic_store(rows, ndim, seed)
+        chunks.ids = [f"{row:032x}" for row in range(rows)]
+        return chunks, np.zeros((1, ndim), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, ndim), dtype=np.float32)
+    chunks = ChunkStore(capacity=rows)
+    chunks._reserve(rows, ndim)
+    for start in range(0, rows, 65536):
+        end = min(rows, start + 65536)
+        chunks.embeddings[start:end] = clustered(end - start, centers, spread, rng)
+    chunks.norms[:rows] = np.linalg.norm(chunks.embeddings[:rows], axis=1)
+    chunks.row_documents[:rows] = 0
+    chunks.ids = [f"{row:032x}" for row in range(rows)]
+    chunks.size = rows
+    return chunks, centers
+
+
+def measure(search, queries: np.ndarray) -> tuple[np.ndarray, float, np.ndarray]:
+    """Results, queries per second and p50/p95 latency in ms of one query at a time."""
+    results, latencies = [], []
+    start = time.perf_counter()
+    for query in queries:
+        begin = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    return np.stack(results), len(queries) / elapsed, np.percentile(latencies, [50, 95]) * 1000
+
+
+def recall(found: np.ndarray, expected: np.ndarray) -> float:
+    return float(
+        np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected, strict=True)])
+    )
+
+
+def main(
+    rows: int,
+    ndim: int,
+    k: int,
+    num_queries: int,
+    clusters: int,
+    spread: float,
+    nlist: int | None,
+    pq_m: int,
+    nprobes: list[int],
+    refines: list[int],
+):
+    print(f"Building {rows} x {ndim} float32 matrix around {clusters} clusters...")
+    chunks, centers = clustered_store(rows, ndim, clusters, spread)
+    queries = clustered(num_queries, centers, spread, np.random.default_rng(1))
+
+    expected, _ = top_k(chunks.matrix, chunks.norms[:rows], queries, k)
+    _, qps, (p50, p95) = measure(lambda q: chunks.search(q, k)[0], queries)
+
+    index = IVFPQIndex(nlist=nlist, pq_m=pq_m)
+    start = time.perf_counter()
+    index.train(chunks.matrix)
+    trained = time.perf_counter() - start
+    start = time.perf_counter()
+    index.add_missing(chunks)
+    added = time.perf_counter() - start
+    print(
+        f"ivfpq nlist={len(index.centroids)} pq_m={pq_m}:"
+        f" train {trained:.1f}s, add {added:.1f}s ({rows / added:.0f} rows/s)"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "index.npz"
+        start = time.perf_counter()
+        index.save(path, chunks)
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        ANNIndex.load(path, chunks)
+        print(
+            f"save {saved:.1f}s, load {time.perf_counter() - start:.1f}s,"
+            f" {path.stat().st_size / 2**20:.0f} MiB on disk"
+        )
+
+    print(f"k={k} queries={num_queries}")
+    print(f"{'search':>18} {'recall@k':>10} {'qps':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    print(f"{'exact':>18} {1.0:>10.3f} {qps:>10.1f} {p50:>10.1f} {p95:>10.1f}")
+    for nprobe in nprobes:
+        for refine in refines:
+            index.nprobe, index.refine = nprobe, refine
+            found, qps, (p50, p95) = measure(
+                lambda q: index.search(chunks, q, k)[0][0], queries
+            )
+            name = f"nprobe={nprobe} r={refine}"
+            print(
+                f"{name:>18} {recall(found, expected):>10.3f}"
+                f" {qps:>10.1f} {p50:>10.1f} {p95:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recall and throughput of the IVF-PQ index against exact search"
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--ndim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--clusters", type=int, default=1000)
+    # distance of rows from their cluster center, relative to the center's own spread
+    parser.add_argument("--spread", type=float, default=1.0)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--pq-m", type=int, default=48)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--refine", type=int, nargs="+", default=[4, 8])
+    args = parser.parse_args()
+    main(
+        args.rows,
+        args.ndim,
+        args.k,
+        args.queries,
+        args.clusters,
+        args.spread,
+        args.nlist,
+        args.pq_m,
+        args.nprobe,
+        args.refine,
+    )
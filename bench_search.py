@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import os
+import time
+
+import numpy as np
+
+from chunk_store import ChunkStore
+from sharded_search import ShardedSearch
+
+
+def synthetic_store(rows: int, ndim: int, seed: int = 0) -> ChunkStore:
+    rng = np.random.default_rng(seed)
+    chunks = ChunkStore(capacity=rows)
+    # build the columns directly, materializing text for a million rows is not the point here
+    chunks._reserve(rows, ndim)
+    for start in range(0, rows, 65536):
+        end = min(rows, start + 65536)
+        chunks.embeddings[start:end] = rng.standard_normal((end - start, ndim), dtype=np.float32)
+    chunks.norms[:rows] = np.linalg.norm(chunks.embeddings[:rows], axis=1)
+    chunks.row_documents[:rows] = 0
+    chunks.size = rows
+    return chunks
+
+
+async def run(chunks: ChunkStore, workers: int, queries: np.ndarray, k: int, concurrency: int):
+    engine = ShardedSearch(workers=workers)
+    # warm up the pool
+    await engine.search(chunks, queries[0], k)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(query):
+        async with semaphore:
+            start = time.perf_counter()
+            await engine.search(chunks, query, k)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(q) for q in queries])
+    elapsed = time.perf_counter() - start
+    engine.shutdown()
+    return len(queries) / elapsed, np.percentile(latencies, [50, 95]) * 1000
+
+
+def main(rows: int, ndim: int, k: int, num_queries: int, concurrency: int, workers: list[int]):
+    print(f"Building {rows} x {ndim} float32 matrix...")
+    chunks = synthetic_store(rows, ndim)
+    queries = np.random.default_rng(1).standard_normal((num_queries, ndim), dtype=np.float32)
+
+    # exact reference for a sanity check of the merge
+    expected, _ = chunks.search(queries[0], k)
+
+    print(f"cores={os.cpu_count()} k={k} queries={num_queries} concurrency={concurrency}")
+    print(f"{'workers':>8} {'qps':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for w in workers:
+        engine = ShardedSearch(workers=w, min_shard_rows=1)
+        got, _ = asyncio.run(engine.search(chunks, queries[0], k))
+        engine.shutdown()
+        assert np.array_equal(np.sort(got), np.sort(expected)), "sharded top-k differs from exact"
+        qps, (p50, p95) = asyncio.run(run(chunks, w, queries, k, concurrency))
+        print(f"{w:>8} {qps:>10.1f} {p50:>10.1f} {p95:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of sharded similarity search by worker count")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--ndim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, 4, 8, os.cpu_count() or 1}),
+    )
+    args = parser.parse_args()
+    main(args.rows, args.ndim, args.k, args.queries, args.concurrency, args.workers)
@@ -0,0 +1,243 @@
+from collections.abc import Sequence
+from datetime import datetime
+
+import numpy as np
+
+from paperqa.types import Doc
+
+from utils import ChunkFilter, TextPlus
+
+
+MISSING_PAGE_START = np.iinfo(np.int32).min
+
+
+class ChunkStore:
+    """Columnar storage for chunk rows.
+
+    Embeddings live in one float32 matrix, chunk texts in one utf-8 buffer with
+    offsets and pages in one int array with offsets. Every document has a single
+    shared `Doc`. `TextPlus` objects are only built for the rows that are returned.
+    """
+
+    def __init__(self, capacity: int = 0):
+        self.size = 0
+        self.ndim: int | None = None
+        # embedding version and model of the rows, None when loaded from the legacy column
+        self.embedding_version: str | None = None
+        self.embedding_model: str | None = None
+        # rows created before this are loaded, see SupabaseStore.refresh
+        self.synced_at: datetime | None = None
+        self.ids: list[str | None] = []
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+        self.norms = np.empty(0, dtype=np.float32)
+        self.row_documents = np.empty(0, dtype=np.int32)
+        # hashes of chunk names and texts, for excluding chunks without decoding them
+        self.name_hashes = np.empty(0, dtype=np.int64)
+        self.text_hashes = np.empty(0, dtype=np.int64)
+        # False for rows loaded without their text, see SupabaseStore.lazy_text
+        self.text_loaded = np.empty(0, dtype=bool)
+        self.text_offsets = np.zeros(1, dtype=np.int64)
+        self.text_buffer = bytearray()
+        self.page_offsets = np.zeros(1, dtype=np.int64)
+        self.pages = np.empty(0, dtype=np.int32)
+        # offset of each page into its chunk text, MISSING_PAGE_START for older rows
+        self.page_starts = np.empty(0, dtype=np.int32)
+        self.num_pages = 0
+        # summary and quotes made at upload, see UploadDocs.chunk_digests
+        self.digests: list[dict | None] = []
+        self.num_digests = 0  # rows with a digest
+
+        self.documents: list[Doc] = []
+        # (dockey, normalized authors, published_at) per document, used by filters
+        self.document_meta: list[tuple[str, list[str], datetime | None]] = []
+        self.document_index: dict[str, int] = {}
+        self.docnames: set[str] = set()
+        # dockeys of the documents read from the documents table, for noticing deletions
+        self.stored_documents: set[str] = set()
+        self._capacity = capacity
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _reserve(self, rows: int, ndim: int) -> None:
+        if self.ndim is None:
+            self.ndim = ndim
+            self.embeddings = np.empty((0, ndim), dtype=np.float32)
+        elif ndim != self.ndim:
+            raise ValueError(f"Expected {self.ndim}-dim embeddings, got {ndim}")
+        needed = self.size + rows
+        if needed <= len(self.norms):
+            return
+        capacity = max(needed, 2 * len(self.norms), self._capacity, 1024)
+        self.embeddings = np.resize(self.embeddings, (capacity, ndim))
+        self.norms = np.resize(self.norms, capacity)
+        self.row_documents = np.resize(self.row_documents, capacity)
+        self.name_hashes = np.resize(self.name_hashes, capacity)
+        self.text_hashes = np.resize(self.text_hashes, capacity)
+        self.text_loaded = np.resize(self.text_loaded, capacity)
+        self.text_offsets = np.resize(self.text_offsets, capacity + 1)
+        self.page_offsets = np.resize(self.page_offsets, capacity + 1)
+
+    def add_document(
+        self,
+        doc: Doc,
+        authors: list[str] | None = None,
+        published_at: datetime | None = None,
+    ) -> int:
+        """Register a document once, returning its index."""
+        if doc.dockey in self.document_index:
+            return self.document_index[doc.dockey]
+        index = len(self.documents)
+        self.documents.append(doc)
+        self.document_meta.append((doc.dockey, authors or [], published_at))
+        self.document_index[doc.dockey] = index
+        self.docnames.add(doc.docname)
+        return index
+
+    def extend(
+        self,
+        documents: Sequence[int],
+        texts: Sequence[str | None],
+        pages: Sequence[list[int]],
+        embeddings: np.ndarray | Sequence[Sequence[float]],
+        ids: Sequence[str | None] | None = None,
+        page_starts: Sequence[list[int] | None] | None = None,
+        digests: Sequence[dict | None] | None = None,
+    ) -> None:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        rows = len(documents)
+        if rows == 0:
+            return
+        self._reserve(rows, embeddings.shape[1])
+        start, end = self.size, self.size + rows
+
+        self.embeddings[start:end] = embeddings
+        self.norms[start:end] = np.linalg.norm(embeddings, axis=1)
+        self.row_documents[start:end] = documents
+        self.ids.extend(ids if ids is not None else [None] * rows)
+        self.digests.extend(digests if digests is not None else [None] * rows)
+        self.num_digests += sum(d is not None for d in self.digests[start:end])
+
+        offset = self.text_offsets[start]
+        for i, text in enumerate(texts):
+            encoded = (text or "").encode()
+            self.text_buffer += encoded
+            offset += len(encoded)
+            self.text_offsets[start + i + 1] = offset
+            self.text_hashes[start + i] = hash(text) if text is not None else 0
+            self.text_loaded[start + i] = text is not None
+
+        flat_pages = [p for row_pages in pages for p in row_pages]
+        flat_starts = [
+            s
+            for row_pages, row_starts in zip(pages, page_starts or [None] * rows, strict=True)
+            for s in (
+                row_starts
+                if row_starts and len(row_starts) == len(row_pages)
+                else [MISSING_PAGE_START] * len(row_pages)
+            )
+        ]
+        if self.num_pages + len(flat_pages) > len(self.pages):
+            capacity = max(self.num_pages + len(flat_pages), 2 * len(self.pages))
+            self.pages = np.resize(self.pages, capacity)
+            self.page_starts = np.resize(self.page_starts, capacity)
+        self.pages[self.num_pages : self.num_pages + len(flat_pages)] = flat_pages
+        self.page_starts[self.num_pages : self.num_pages + len(flat_pages)] = flat_starts
+        page_offset = self.page_offsets[start]
+        for i, row_pages in enumerate(pages):
+            page_offset += len(row_pages)
+            self.page_offsets[start + i + 1] = page_offset
+        self.num_pages += len(flat_pages)
+
+        self.size = end
+        for row in range(start, end):
+            self.name_hashes[row] = hash(self.name(row))
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self.embeddings[: self.size]
+
+    def text(self, row: int) -> str:
+        return self.text_buffer[
+            self.text_offsets[row] : self.text_offsets[row + 1]
+        ].decode()
+
+    def row_pages(self, row: int) -> list[int]:
+        return self.pages[self.page_offsets[row] : self.page_offsets[row + 1]].tolist()
+
+    def row_page_starts(self, row: int) -> list[int]:
+        starts = self.page_starts[self.page_offsets[row] : self.page_offsets[row + 1]]
+        if (starts == MISSING_PAGE_START).any():
+            return []
+        return starts.tolist()
+
+    def name(self, row: int) -> str:
+        doc = self.documents[self.row_documents[row]]
+        pages = self.row_pages(row)
+        if not pages:
+            return doc.docname
+        return doc.docname + " pages " + f"{pages[0]}-{pages[-1]}"
+
+    def materialize(self, row: int, text: str | None = None) -> TextPlus:
+        return TextPlus(
+            text=self.text(row) if text is None else text,
+            name=self.name(row),
+            doc=self.documents[self.row_documents[row]],
+            pages=self.row_pages(row),
+            page_starts=self.row_page_starts(row),
+            embedding=self.embeddings[row].tolist(),
+            digest=self.digests[row],
+        )
+
+    def filter_rows(self, filters: ChunkFilter | None) -> np.ndarray | None:
+        """Row indices allowed by `filters`, or None to search every row."""
+        if filters is None:
+            return None
+        # evaluate document-level conditions once per document, then broadcast to rows
+        document_mask = np.array(
+            [filters.matches_document(*meta) for meta in self.document_meta],
+            dtype=bool,
+        )
+        if not len(document_mask):
+            return np.empty(0, dtype=np.int64)
+        mask = document_mask[self.row_documents[: self.size]]
+        if filters.exclude_texts:
+            excluded = np.array([hash(t) for t in filters.exclude_texts], dtype=np.int64)
+            mask &= ~np.isin(self.name_hashes[: self.size], excluded)
+            mask &= ~np.isin(self.text_hashes[: self.size], excluded)
+        return np.flatnonzero(mask)
+
+    def search(
+        self, query: np.ndarray, k: int, rows: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Exact cosine top-k, returns row indices and scores sorted by descending score."""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        norms = self.norms[: self.size] if rows is None else self.norms[rows]
+        top, scores = top_k(matrix, norms, np.asarray(query).reshape(1, -1), k)
+        return (top[0] if rows is None else rows[top[0]]), scores[0]
+
+
+def top_k(
+    matrix: np.ndarray, norms: np.ndarray, queries: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Exact cosine top-k of each query against the rows of `matrix`.
+
+    Returns (len(queries), k) arrays of row positions and scores, sorted by descending score.
+    """
+    k = min(k, len(matrix))
+    if k == 0:
+        return (
+            np.empty((len(queries), 0), dtype=np.int64),
+            np.empty((len(queries), 0), dtype=np.float32),
+        )
+    queries = np.asarray(queries, dtype=np.float32)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (queries @ matrix.T) / (
+            np.linalg.norm(queries, axis=1, keepdims=True) * norms
+        )
+    scores = np.nan_to_num(scores, nan=-np.inf)
+    # partition first so only the top-k need sorting
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
@@ -0,0 +1,95 @@
+from collections.abc import Callable, Sequence
+import re
+
+from pydantic import BaseModel
+
+from paperqa.types import Context
+
+from scheduler import estimate_tokens
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class ContextPacking(BaseModel):
+    """What the packer kept and dropped for one answer prompt."""
+
+    contexts_kept: int = 0
+    contexts_dropped: int = 0
+    quotes_kept: int = 0
+    quotes_dropped: int = 0
+    tokens_used: int = 0
+    tokens_dropped: int = 0
+    token_budget: int | None = None
+
+
+def shingles(text: str, size: int = 5) -> set[tuple[str, ...]]:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def dedup_quotes(
+    contexts: Sequence[Context], max_overlap: float = 0.8
+) -> tuple[list[Context], int]:
+    """Drop quotes that repeat quotes of higher-ranked contexts.
+
+    Adjacent chunks overlap, so summaries of neighbouring chunks often quote the same
+    sentence, whole or cut at the chunk boundary. A quote is dropped when at least
+    `max_overlap` of its 5-word shingles were already quoted. Returns copies of the
+    contexts, in the same order, and the number of quotes dropped.
+    """
+    seen: set[tuple[str, ...]] = set()
+    deduped = []
+    dropped = 0
+    for c in contexts:
+        points = (c.model_extra or {}).get("points")
+        if not points:
+            deduped.append(c)
+            continue
+        kept = []
+        for p in points:
+            quote_shingles = shingles(str(p.get("quote") or ""))
+            if not quote_shingles or (
+                len(quote_shingles & seen) >= max_overlap * len(quote_shingles)
+            ):
+                dropped += 1
+                continue
+            seen |= quote_shingles
+            kept.append(p)
+        c = c.model_copy()
+        c.points = kept
+        deduped.append(c)
+    return deduped, dropped
+
+
+def pack_contexts(
+    contexts: Sequence[Context],
+    render: Callable[[Context], str],
+    token_budget: int | None = None,
+) -> tuple[list[Context], list[str], ContextPacking]:
+    """Deduplicate quotes, then fill the prompt greedily by score up to `token_budget`.
+
+    `contexts` must already be sorted best first. A context that does not fit is
+    skipped and smaller ones after it may still be packed. The best context is always
+    kept, so there is something to answer from. Returns the kept contexts, their
+    rendered strings and a report of what was dropped.
+    """
+    contexts, quotes_dropped = dedup_quotes(contexts)
+    report = ContextPacking(quotes_dropped=quotes_dropped, token_budget=token_budget)
+    kept, rendered = [], []
+    for c in contexts:
+        text = render(c)
+        tokens = estimate_tokens(text)
+        if token_budget is not None and kept and report.tokens_used + tokens > token_budget:
+            report.contexts_dropped += 1
+            report.tokens_dropped += tokens
+            report.quotes_dropped += len((c.model_extra or {}).get("points") or [])
+            continue
+        kept.append(c)
+        rendered.append(text)
+        report.tokens_used += tokens
+        report.quotes_kept += len((c.model_extra or {}).get("points") or [])
+    report.contexts_kept = len(kept)
+    return kept, rendered, report
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+import logging
+
+from postgrest.exceptions import APIError
+from pydantic import BaseModel
+from supabase._async.client import AsyncClient
+
+logger = logging.getLogger(__name__)
+
+
+# vectors in the `chunks.text_emb` and `documents.abstract_emb` columns
+LEGACY_VERSION = "legacy"
+
+
+class EmbeddingVersion(BaseModel):
+    version: str
+    model: str
+    ndim: int | None = None
+    # backfilling -> complete -> retired
+    status: str = "backfilling"
+    # last chunk and document ids backfilled, for resuming
+    chunk_cursor: str | None = None
+    document_cursor: str | None = None
+    created_at: datetime | None = None
+    completed_at: datetime | None = None
+
+
+async def fetch_versions(supabase: AsyncClient) -> list[EmbeddingVersion]:
+    try:
+        response = await supabase.table("embedding_versions").select("*").execute()
+    except APIError as e:
+        # deployments without versioned embeddings only have the legacy columns
+        logger.debug(f"No embedding versions: {e.message}")
+        return []
+    return [EmbeddingVersion(**row) for row in response.data]
+
+
+async def fetch_active_version(supabase: AsyncClient) -> EmbeddingVersion | None:
+    """The version queries should use, None for the legacy columns."""
+    try:
+        response = (
+            await supabase.table("embedding_config")
+            .select("active_version")
+            .eq("id", 1)
+            .execute()
+        )
+    except APIError as e:
+        logger.debug(f"No embedding config: {e.message}")
+        return None
+    if not response.data or response.data[0].get("active_version") in (None, LEGACY_VERSION):
+        return None
+    active = response.data[0]["active_version"]
+    for version in await fetch_versions(supabase):
+        if version.version == active:
+            return version
+    raise ValueError(f"Active embedding version {active} is not registered")
+
+
+async def activate_version(supabase: AsyncClient, version: str, force: bool = False) -> None:
+    """Point queries at `version`, a single row update so readers switch atomically."""
+    if version != LEGACY_VERSION:
+        versions = {v.version: v for v in await fetch_versions(supabase)}
+        if version not in versions:
+            raise ValueError(f"Unknown embedding version {version}")
+        if versions[version].status != "complete" and not force:
+            raise ValueError(
+                f"Embedding version {version} is {versions[version].status}, finish the"
+                " backfill first"
+            )
+    await (
+        supabase.table("embedding_config")
+        .upsert(
+            {
+                "id": 1,
+                "active_version": version,
+                "activated_at": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+        .execute()
+    )
@@ -0,0 +1,365 @@
+from collections.abc import Collection, Iterable
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+from uuid import uuid4
+import bisect
+import json
+import re
+import threading
+import time
+
+
+# A JWT-shaped key, supabase-py rejects keys that don't look like one
+FAKE_SERVICE_KEY = "fake.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.fake"
+
+
+def split_columns(select: str) -> list[str]:
+    """Split a PostgREST select string on top-level commas."""
+    columns, depth, current = [], 0, ""
+    for char in select:
+        if char == "," and depth == 0:
+            columns.append(current.strip())
+            current = ""
+            continue
+        depth += char == "("
+        depth -= char == ")"
+        current += char
+    if current.strip():
+        columns.append(current.strip())
+    return columns
+
+
+def parse_value(value: str):
+    if value == "null":
+        return None
+    if value in ("true", "false"):
+        return value == "true"
+    return value
+
+
+def compare(left, right) -> int:
+    if left is None or right is None:
+        return 0 if left is right else (-1 if left is None else 1)
+    try:
+        left, right = float(left), float(right)
+    except (TypeError, ValueError):
+        left, right = str(left), str(right)
+    return (left > right) - (left < right)
+
+
+def matches_filter(row: dict, column: str, expression: str) -> bool:
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    operator, _, criteria = expression.partition(".")
+    value = row.get(column)
+    if operator == "eq":
+        result = compare(value, parse_value(criteria)) == 0 and value is not None
+    elif operator == "neq":
+        result = compare(value, parse_value(criteria)) != 0
+    elif operator in ("gt", "gte", "lt", "lte"):
+        if value is None:
+            result = False
+        else:
+            c = compare(value, criteria)
+            result = {"gt": c > 0, "gte": c >= 0, "lt": c < 0, "lte": c <= 0}[operator]
+    elif operator == "in":
+        options = [o.strip('"') for o in criteria.strip("()").split(",") if o]
+        result = value is not None and str(value) in options
+    elif operator == "is":
+        result = value is parse_value(criteria)
+    elif operator in ("like", "ilike"):
+        pattern = "^" + re.escape(criteria).replace("\\*", ".*").replace("%", ".*") + "$"
+        flags = re.IGNORECASE if operator == "ilike" else 0
+        result = value is not None and re.match(pattern, str(value), flags) is not None
+    elif operator == "cs":
+        wanted = criteria.strip("{}").split(",")
+        result = value is not None and all(w in value for w in wanted)
+    else:
+        raise ValueError(f"Unsupported operator {operator}")
+    return result != negate
+
+
+class FakePostgREST:
+    """In-process stand-in for the PostgREST API behind Supabase.
+
+    Implements the subset of the API the supabase client uses against the `documents`
+    and `chunks` tables: select with embedded resources, filters, ordering, limit/offset,
+    exact counts, insert, upsert, update and delete.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        max_rows: int | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        missing_columns: Collection[str] = (),
+    ):
+        self.tables: dict[str, list[dict]] = {"documents": [], "chunks": []}
+        self.primary_keys: dict[str, dict] = {"documents": {}, "chunks": {}}
+        # rows sorted by id, rebuilt lazily after inserts, for keyset pagination
+        self._sorted: dict[str, tuple[list[str], list[dict]]] = {}
+        self.latency = latency
+        # mirrors PostgREST's db-max-rows, which silently truncates responses
+        self.max_rows = max_rows
+        # "table.column" of migrations not applied, reading or writing them is an error
+        self.missing_columns = set(missing_columns)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakePostgREST":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def insert(self, table: str, rows: list[dict], upsert: bool = False) -> list[dict]:
+        inserted = []
+        with self.lock:
+            for row in rows:
+                # pgvector columns come back as strings
+                row = {
+                    k: json.dumps(v)
+                    if k.endswith(("_emb", "embedding")) and isinstance(v, list)
+                    else v
+                    for k, v in row.items()
+                }
+                row.setdefault("id", str(uuid4()))
+                row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+                existing = self.primary_keys.setdefault(table, {}).get(row["id"])
+                if existing is not None:
+                    if not upsert:
+                        raise KeyError(row["id"])
+                    existing.update(row)
+                    inserted.append(existing)
+                    continue
+                self.tables.setdefault(table, []).append(row)
+                self.primary_keys[table][row["id"]] = row
+                inserted.append(row)
+            self._sorted.pop(table, None)
+        return inserted
+
+    def _candidates(self, table: str, filters: list[tuple[str, str]]) -> list[dict]:
+        """Rows that may match `filters`, narrowed with the id index where possible."""
+        for column, expression in filters:
+            if column == "id" and expression.startswith("in."):
+                ids = [i.strip('"') for i in expression[4:-1].split(",") if i]
+                keys = self.primary_keys.get(table, {})
+                return sorted((keys[i] for i in ids if i in keys), key=lambda r: r["id"])
+        if table not in self._sorted:
+            rows = sorted(self.tables.get(table, []), key=lambda r: r["id"])
+            self._sorted[table] = ([r["id"] for r in rows], rows)
+        ids, rows = self._sorted[table]
+        lower, upper = 0, len(rows)
+        for column, expression in filters:
+            if column != "id":
+                continue
+            operator, _, value = expression.partition(".")
+            if operator == "gt":
+                lower = max(lower, bisect.bisect_right(ids, value))
+            elif operator == "gte":
+                lower = max(lower, bisect.bisect_left(ids, value))
+            elif operator == "lt":
+                upper = min(upper, bisect.bisect_left(ids, value))
+            elif operator == "lte":
+                upper = min(upper, bisect.bisect_right(ids, value))
+        return rows[lower:upper]
+
+    def _project(self, row: dict, columns: list[str]) -> dict:
+        projected = {}
+        for column in columns:
+            if column == "*":
+                projected.update(row)
+                continue
+            match = re.match(r"(\w+)\((.*)\)$", column)
+            if match is None:
+                projected[column] = row.get(column)
+                continue
+            name, inner = match.groups()
+            # embedded resource through a foreign key column named after the table
+            target = self.primary_keys.get(name + "s", {}).get(row.get(name))
+            projected[name] = (
+                None if target is None else self._project(target, split_columns(inner))
+            )
+        return projected
+
+    def select(self, table: str, params: list[tuple[str, str]]) -> tuple[list[dict], int]:
+        select = "*"
+        order, limit, offset = None, None, 0
+        filters = []
+        for key, value in params:
+            if key == "select":
+                select = value
+            elif key == "order":
+                order = value
+            elif key == "limit":
+                limit = int(value)
+            elif key == "offset":
+                offset = int(value)
+            else:
+                filters.append((key, value))
+        with self.lock:
+            rows = [
+                r
+                for r in self._candidates(table, filters)
+                if all(matches_filter(r, c, e) for c, e in filters)
+            ]
+        # candidates already come back sorted by id
+        if order and order not in ("id", "id.asc"):
+            for clause in reversed(order.split(",")):
+                column, _, direction = clause.partition(".")
+                rows = sorted(
+                    rows,
+                    key=lambda r: (r.get(column) is None, r.get(column) or ""),
+                    reverse=direction.startswith("desc"),
+                )
+        total = len(rows)
+        if self.max_rows is not None:
+            limit = self.max_rows if limit is None else min(limit, self.max_rows)
+        rows = rows[offset : None if limit is None else offset + limit]
+        columns = split_columns(select)
+        return [self._project(r, columns) for r in rows], total
+
+    def _filtered(self, table: str, params: list[tuple[str, str]]) -> list[dict]:
+        filters = [(k, v) for k, v in params if k not in ("select", "on_conflict")]
+        return [
+            r
+            for r in self.tables.get(table, [])
+            if all(matches_filter(r, c, e) for c, e in filters)
+        ]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _table(self) -> tuple[str, list[tuple[str, str]]]:
+                parsed = urlparse(self.path)
+                return parsed.path.rsplit("/", 1)[-1], parse_qsl(parsed.query)
+
+            def _body(self):
+                return json.loads(self.raw_body) if self.raw_body else None
+
+            def _send(self, status: int, payload=None, headers: dict | None = None) -> None:
+                body = b"" if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _begin(self) -> None:
+                # always drain the body, the client sends `{}` even on GET
+                length = int(self.headers.get("Content-Length") or 0)
+                self.raw_body = self.rfile.read(length) if length else b""
+                fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+            def _missing_column(self, table: str, columns: Iterable[str]) -> bool:
+                for column in columns:
+                    if f"{table}.{column}" in fake.missing_columns:
+                        self._send(
+                            400,
+                            {
+                                "code": "42703",
+                                "details": None,
+                                "hint": None,
+                                "message": f"column {table}.{column} does not exist",
+                            },
+                        )
+                        return True
+                return False
+
+            def do_GET(self) -> None:
+                self._begin()
+                table, params = self._table()
+                if self._missing_column(table, split_columns(dict(params).get("select", ""))):
+                    return
+                rows, total = fake.select(table, params)
+                headers = {}
+                if "count=exact" in (self.headers.get("Prefer") or ""):
+                    offset = dict(params).get("offset", "0")
+                    end = int(offset) + len(rows) - 1
+                    headers["Content-Range"] = f"{offset}-{end}/{total}"
+                self._send(200, rows, headers)
+
+            do_HEAD = do_GET
+
+            def do_POST(self) -> None:
+                self._begin()
+                table, params = self._table()
+                body = self._body()
+                rows = body if isinstance(body, list) else [body]
+                if self._missing_column(table, {column for row in rows for column in row}):
+                    return
+                upsert = "merge-duplicates" in (self.headers.get("Prefer") or "")
+                try:
+                    inserted = fake.insert(table, rows, upsert=upsert)
+                except KeyError:
+                    self._send(
+                        409,
+                        {
+                            "code": "23505",
+                            "details": None,
+                            "hint": None,
+                            "message": (
+                                "duplicate key value violates unique constraint"
+                                f' "{table}_pkey"'
+                            ),
+                        },
+                    )
+                    return
+                self._send(201, inserted)
+
+            def do_PATCH(self) -> None:
+                self._begin()
+                table, params = self._table()
+                body = self._body() or {}
+                with fake.lock:
+                    rows = fake._filtered(table, params)
+                    for row in rows:
+                        row.update(body)
+                self._send(200, rows)
+
+            def do_DELETE(self) -> None:
+                self._begin()
+                table, params = self._table()
+                with fake.lock:
+                    rows = fake._filtered(table, params)
+                    ids = {r["id"] for r in rows}
+                    fake.tables[table] = [
+                        r for r in fake.tables.get(table, []) if r["id"] not in ids
+                    ]
+                    for i in ids:
+                        fake.primary_keys[table].pop(i, None)
+                    fake._sorted.pop(table, None)
+                self._send(200, rows)
+
+        return Handler
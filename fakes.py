@@ -0,0 +1,231 @@
+from collections.abc import AsyncIterable, Iterable, Iterator
+from pathlib import Path
+from uuid import UUID, uuid5
+import asyncio
+import hashlib
+import json
+import random
+import re
+
+import numpy as np
+
+from paperqa.clients.client_models import DOIOrTitleBasedProvider, DOIQuery, TitleAuthorQuery
+from paperqa.llms import Chunk, EmbeddingModel, LLMModel
+from paperqa.types import DocDetails
+
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+NAMESPACE_SYNTHETIC = UUID("0f8d3f5e-52ce-4c4b-9d57-7c2f0b1b9a61")
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ro", "su", "ta", "vi", "ze", "po", "da", "gu"]
+AUTHORS = ["Tan", "Lim", "Wong", "Smith", "Garcia", "Okafor", "Novak", "Silva", "Ito", "Khan"]
+
+
+def word_vector(word: str, ndim: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.md5(word.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(ndim).astype(np.float32)
+
+
+def bag_of_words_embedding(text: str, ndim: int) -> np.ndarray:
+    vector = np.zeros(ndim, dtype=np.float32)
+    for word in WORD_PATTERN.findall(text.lower()):
+        vector += word_vector(word, ndim)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class FakeEmbeddingModel(EmbeddingModel):
+    """Deterministic bag-of-words embeddings, texts that share words end up close together."""
+
+    name: str = "fake-embedding"
+    ndim: int = 768
+    latency: float = 0.0
+    calls: int = 0
+
+    async def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [bag_of_words_embedding(text, self.ndim).tolist() for text in texts]
+
+
+class FakeLLMModel(LLMModel):
+    """Deterministic LLM stand-in that answers each of our prompts with well-formed output.
+
+    Citation prompts get the first line of the excerpt, JSON prompts get a summary with a
+    quote taken from the excerpt and the answer prompt cites the first valid key.
+    """
+
+    name: str = "fake-llm"
+    llm_type: str | None = "chat"
+    latency: float = 0.0
+    calls: int = 0
+
+    def respond(self, messages: list[dict[str, str]]) -> str:
+        prompt = messages[-1]["content"]
+        system = messages[0]["content"] if len(messages) > 1 else ""
+        if prompt.rstrip().endswith("Citation:"):
+            text = prompt.split("\n\n", 1)[-1]
+            return text.strip().split("\n", 1)[0].strip()
+        if prompt.rstrip().endswith("Citation JSON:"):
+            fields = {"title": "Synthetic Document", "authors": ["Synthetic Author"], "doi": None}
+            if prompt.startswith("Provide the citation"):
+                text = prompt.split("\n\n", 1)[-1]
+                fields["citation"] = text.strip().split("\n", 1)[0].strip()
+            return json.dumps(fields)
+        if "JSON" in system:
+            excerpt = prompt.split("\n\n----\n\n")[1] if "----" in prompt else prompt
+            sentence = excerpt.split(". ")[0][:200].strip()
+            return json.dumps(
+                {
+                    "summary": f"The excerpt discusses {sentence}.",
+                    "relevance_score": random.Random(prompt).randint(1, 10),
+                    "points": [{"quote": sentence, "point": sentence}],
+                }
+            )
+        keys = re.findall(r"Valid Keys: ([^,\n]+)", prompt)
+        cited = f" ({keys[0].strip()})" if keys else ""
+        return f"This is a synthetic answer based on the provided context{cited}."
+
+    async def achat(self, messages: Iterable[dict[str, str]]) -> Chunk:
+        messages = list(messages)
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        text = self.respond(messages)
+        return Chunk(
+            text=text,
+            prompt_tokens=sum(len(m["content"]) // 4 for m in messages),
+            completion_tokens=len(text) // 4,
+        )
+
+    async def achat_iter(self, messages: Iterable[dict[str, str]]) -> AsyncIterable[Chunk]:
+        yield await self.achat(messages)
+
+
+class FakeMetadataProvider(DOIOrTitleBasedProvider):
+    """Offline stand-in for Crossref and Semantic Scholar, answering from `papers`."""
+
+    def __init__(self, papers: Iterable[DocDetails] = (), latency: float = 0.0):
+        self.papers = list(papers)
+        self.latency = latency
+        self.calls = 0
+
+    async def _query(self, query: DOIQuery | TitleAuthorQuery) -> DocDetails | None:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for paper in self.papers:
+            if isinstance(query, DOIQuery) and paper.doi == query.doi:
+                return paper.model_copy(deep=True)
+            if isinstance(query, TitleAuthorQuery) and (
+                WORD_PATTERN.findall(paper.title.lower())
+                == WORD_PATTERN.findall(query.title.lower())
+            ):
+                return paper.model_copy(deep=True)
+        return None
+
+
+def topic_words(topic: int, words_per_topic: int = 8) -> list[str]:
+    rng = random.Random(topic)
+    return [
+        "".join(rng.choice(SYLLABLES) for _ in range(3)) for _ in range(words_per_topic)
+    ]
+
+
+def synthetic_questions(count: int, num_topics: int = 100, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        words = topic_words(rng.randrange(num_topics))
+        questions.append(f"What is known about {' and '.join(rng.sample(words, 3))}?")
+    return questions
+
+
+def synthetic_text(topic: int, rng: random.Random, sentences: int = 12) -> str:
+    words = topic_words(topic)
+    return " ".join(
+        " ".join(rng.choice(words) for _ in range(12)).capitalize() + "."
+        for _ in range(sentences)
+    )
+
+
+def synthetic_corpus(
+    num_chunks: int,
+    chunks_per_document: int = 20,
+    ndim: int = 768,
+    num_topics: int = 100,
+    batch_size: int = 10000,
+    seed: int = 0,
+) -> Iterator[tuple[list[dict], list[dict]]]:
+    """Rows for the `documents` and `chunks` tables, in batches.
+
+    Every document is about one topic. Chunk embeddings are the topic's bag-of-words
+    embedding plus noise, so questions from `synthetic_questions` retrieve chunks of the
+    right topic without embedding every chunk text.
+    """
+    rng = np.random.default_rng(seed)
+    text_rng = random.Random(seed)
+    centroids = np.stack(
+        [bag_of_words_embedding(" ".join(topic_words(t)), ndim) for t in range(num_topics)]
+    )
+    documents: list[dict] = []
+    chunks: list[dict] = []
+    for start in range(0, num_chunks, chunks_per_document):
+        document_number = start // chunks_per_document
+        topic = document_number % num_topics
+        author = AUTHORS[document_number % len(AUTHORS)]
+        year = 1990 + document_number % 35
+        citation = f"{author}, Synthetic Document {document_number}, {year}"
+        dockey = str(uuid5(NAMESPACE_SYNTHETIC, citation))
+        documents.append(
+            {
+                "id": dockey,
+                "title": f"Synthetic Document {document_number}",
+                "abstract": synthetic_text(topic, text_rng, sentences=2),
+                "citation": citation,
+                "authors": [author],
+                "published_at": f"{year}-01-01T00:00:00+00:00",
+            }
+        )
+        count = min(chunks_per_document, num_chunks - start)
+        noise = rng.standard_normal((count, ndim), dtype=np.float32) * 0.02
+        embeddings = centroids[topic] + noise
+        for i in range(count):
+            chunks.append(
+                {
+                    "id": str(uuid5(NAMESPACE_SYNTHETIC, f"{dockey}/{i}")),
+                    "document": dockey,
+                    "pages": [i + 1, i + 2],
+                    "text": synthetic_text(topic, text_rng),
+                    "text_emb": json.dumps(np.round(embeddings[i], 5).tolist()),
+                }
+            )
+        if len(chunks) >= batch_size:
+            yield documents, chunks
+            documents, chunks = [], []
+    if chunks:
+        yield documents, chunks
+
+
+def write_synthetic_documents(directory: Path, count: int, pages: int = 6, seed: int = 0) -> list[Path]:
+    """PDFs for ingestion benchmarks, with their citation as the first line of page 1."""
+    import pymupdf
+
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        author = AUTHORS[i % len(AUTHORS)]
+        topic = rng.randrange(100)
+        pdf = pymupdf.open()
+        for page_number in range(pages):
+            page = pdf.new_page()
+            text = synthetic_text(topic, rng, sentences=20)
+            if page_number == 0:
+                text = f"{author}, Uploaded Synthetic Document {seed}-{i}, 2024\n\n{text}"
+            page.insert_textbox(page.rect + (50, 50, -50, -50), text, fontsize=9)
+        path = directory / f"synthetic-{seed}-{i}.pdf"
+        pdf.save(path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,344 @@
+from collections.abc import Awaitable, Callable
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+from uuid import uuid4
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import time
+
+from pydantic import BaseModel
+
+from upload_docs import DocumentRejected, UploadDocs
+
+logger = logging.getLogger(__name__)
+
+
+# aupload stages in order, with the share of the work done once each one starts
+UPLOAD_STAGES = {
+    "queued": 0.0,
+    "citation": 0.05,
+    "metadata": 0.15,
+    "parse": 0.25,
+    "embed": 0.45,
+    # only with UploadDocs.chunk_digests
+    "digest": 0.55,
+    "insert": 0.75,
+    "done": 1.0,
+}
+
+
+class Job(BaseModel):
+    id: str
+    status: str
+    priority: int
+    path: str
+    params: dict
+    stage: str
+    progress: float
+    attempts: int
+    error: str | None = None
+    worker: str | None = None
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+
+class JobQueue:
+    """Persistent ingestion queue in a local SQLite database.
+
+    Any number of API and worker processes can share the database file. Jobs are claimed
+    in a write transaction, highest priority first, so each one runs on a single worker.
+    Running jobs heartbeat, and jobs whose worker stopped heartbeating are requeued, or
+    failed once they used up their attempts. Files of finished jobs are removed.
+    """
+
+    def __init__(self, path: Path | str, max_attempts: int = 3, stale_after: float = 300.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # documents submitted as bytes are kept here until their job is done
+        self.files_dir = self.path.parent / "files"
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        with self.connect() as db:
+            db.execute("pragma journal_mode=wal")
+            db.execute(
+                """
+                create table if not exists jobs (
+                    id text primary key,
+                    status text not null default 'queued',
+                    priority integer not null default 0,
+                    path text not null,
+                    params text not null default '{}',
+                    stage text not null default 'queued',
+                    progress real not null default 0,
+                    attempts integer not null default 0,
+                    error text,
+                    worker text,
+                    created_at real not null,
+                    started_at real,
+                    finished_at real,
+                    heartbeat_at real
+                )
+                """
+            )
+            db.execute(
+                "create index if not exists jobs_queue on jobs (status, priority desc, created_at)"
+            )
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        data = dict(row)
+        data["params"] = json.loads(data["params"])
+        for column in ("created_at", "started_at", "finished_at"):
+            if data[column] is not None:
+                data[column] = datetime.fromtimestamp(data[column], tz=timezone.utc)
+        data.pop("heartbeat_at")
+        return Job(**data)
+
+    def submit(self, path: Path | str, params: dict | None = None, priority: int = 0) -> str:
+        job_id = str(uuid4())
+        with self.connect() as db:
+            db.execute(
+                "insert into jobs (id, priority, path, params, created_at) values (?, ?, ?, ?, ?)",
+                (job_id, priority, str(path), json.dumps(params or {}), time.time()),
+            )
+        return job_id
+
+    def submit_file(
+        self, filename: str, data: bytes, params: dict | None = None, priority: int = 0
+    ) -> str:
+        directory = self.files_dir / str(uuid4())
+        directory.mkdir(parents=True)
+        path = directory / Path(filename).name
+        path.write_bytes(data)
+        return self.submit(path, params, priority)
+
+    def remove_file(self, job: Job) -> None:
+        self._remove_path(job.path)
+
+    def _remove_path(self, path: str) -> None:
+        path = Path(path).resolve()
+        if path.is_relative_to(self.files_dir.resolve()):
+            shutil.rmtree(path.parent, ignore_errors=True)
+
+    def get(self, job_id: str) -> Job | None:
+        with self.connect() as db:
+            row = db.execute("select * from jobs where id = ?", (job_id,)).fetchone()
+        return None if row is None else self._job(row)
+
+    def recent(self, status: str | None = None, limit: int = 100) -> list[Job]:
+        with self.connect() as db:
+            rows = db.execute(
+                "select * from jobs where ? is null or status = ?"
+                " order by created_at desc limit ?",
+                (status, status, limit),
+            ).fetchall()
+        return [self._job(r) for r in rows]
+
+    def counts(self) -> dict[str, int]:
+        with self.connect() as db:
+            rows = db.execute("select status, count(*) from jobs group by status").fetchall()
+        return {status: count for status, count in rows}
+
+    def claim(self, worker: str) -> Job | None:
+        now = time.time()
+        with self.connect() as db:
+            # take the write lock up front so two workers never claim the same job
+            db.execute("begin immediate")
+            try:
+                stale = now - self.stale_after
+                lost = db.execute(
+                    "update jobs set status = 'failed', worker = null, finished_at = ?,"
+                    " error = 'worker lost while running the job'"
+                    " where status = 'running' and heartbeat_at < ? and attempts >= ?"
+                    " returning path",
+                    (now, stale, self.max_attempts),
+                ).fetchall()
+                db.execute(
+                    "update jobs set status = 'queued', worker = null"
+                    " where status = 'running' and heartbeat_at < ?",
+                    (stale,),
+                )
+                row = db.execute(
+                    "select * from jobs where status = 'queued'"
+                    " order by priority desc, created_at limit 1"
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "update jobs set status = 'running', worker = ?,"
+                        " attempts = attempts + 1, stage = 'queued', progress = 0,"
+                        " started_at = ?, heartbeat_at = ?, error = null where id = ?",
+                        (worker, now, now, row["id"]),
+                    )
+                db.execute("commit")
+            except BaseException:
+                db.execute("rollback")
+                raise
+        for job in lost:
+            self._remove_path(job["path"])
+        return None if row is None else self.get(row["id"])
+
+    def heartbeat(self, job_ids: list[str]) -> None:
+        if not job_ids:
+            return
+        with self.connect() as db:
+            db.execute(
+                f"update jobs set heartbeat_at = ? where id in ({','.join('?' * len(job_ids))})",
+                (time.time(), *job_ids),
+            )
+
+    def set_stage(self, job_id: str, stage: str) -> None:
+        with self.connect() as db:
+            # a late update doesn't overwrite the stage of a finished job
+            db.execute(
+                "update jobs set stage = ?, progress = ?, heartbeat_at = ?"
+                " where id = ? and status = 'running'",
+                (stage, UPLOAD_STAGES.get(stage, 0.0), time.time(), job_id),
+            )
+
+    def complete(self, job_id: str) -> None:
+        with self.connect() as db:
+            db.execute(
+                "update jobs set status = 'done', stage = 'done', progress = 1,"
+                " finished_at = ? where id = ?",
+                (time.time(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str, retry: bool = True) -> None:
+        with self.connect() as db:
+            row = db.execute(
+                "update jobs set status = case when ? and attempts < ? then 'queued'"
+                " else 'failed' end, error = ?, worker = null, finished_at = ? where id = ?"
+                " returning status, path",
+                (retry, self.max_attempts, error, time.time(), job_id),
+            ).fetchone()
+        if row is not None and row["status"] == "failed":
+            self._remove_path(row["path"])
+
+
+async def run_worker(
+    queue: JobQueue,
+    upload: Callable[[Job, Callable[[str], None]], Awaitable],
+    concurrency: int = 2,
+    poll_interval: float = 1.0,
+    heartbeat_interval: float = 30.0,
+    worker: str | None = None,
+) -> None:
+    """Claim and run jobs until cancelled, with at most `concurrency` at a time.
+
+    Queue calls can wait on the database lock, so they run on worker threads. Stages
+    reported by uploads are written once per poll, the latest one for each job.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    running: dict[str, asyncio.Task] = {}
+    stages: dict[str, str] = {}
+    last_heartbeat = time.monotonic()
+
+    async def run(job: Job) -> None:
+        try:
+            await upload(job, partial(stages.__setitem__, job.id))
+        except DocumentRejected as e:
+            logger.warning(f"Job {job.id} failed: {e}")
+            await asyncio.to_thread(queue.fail, job.id, str(e), retry=False)
+        except Exception as e:
+            logger.exception(f"Job {job.id} failed")
+            await asyncio.to_thread(queue.fail, job.id, repr(e))
+        else:
+            await asyncio.to_thread(queue.complete, job.id)
+            await asyncio.to_thread(queue.remove_file, job)
+        finally:
+            stages.pop(job.id, None)
+
+    def write_stages(updates: dict[str, str]) -> None:
+        for job_id, stage in updates.items():
+            queue.set_stage(job_id, stage)
+
+    try:
+        while True:
+            while (
+                len(running) < concurrency
+                and (job := await asyncio.to_thread(queue.claim, worker)) is not None
+            ):
+                logger.info(f"Running job {job.id} ({job.path})")
+                running[job.id] = asyncio.create_task(run(job))
+                running[job.id].add_done_callback(lambda _, i=job.id: running.pop(i, None))
+            if stages:
+                updates = dict(stages)
+                stages.clear()
+                await asyncio.to_thread(write_stages, updates)
+            if time.monotonic() - last_heartbeat > heartbeat_interval:
+                await asyncio.to_thread(queue.heartbeat, list(running))
+                last_heartbeat = time.monotonic()
+            await asyncio.sleep(poll_interval)
+    finally:
+        for task in running.values():
+            task.cancel()
+
+
+def upload_job(docs, settings) -> Callable[[Job, Callable[[str], None]], Awaitable]:
+    async def upload(job: Job, progress_callback: Callable[[str], None]) -> None:
+        await docs.aupload(
+            Path(job.path),
+            settings=settings,
+            progress_callback=progress_callback,
+            **job.params,
+        )
+
+    return upload
+
+
+def main(args: argparse.Namespace):
+    from dotenv import load_dotenv
+
+    from paperqa import Settings
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    docs = UploadDocs(
+        supabase_url=os.environ["SUPABASE_URL"],
+        supabase_service_key=os.environ["SUPABASE_SERVICE_KEY"],
+        chunk_digests=os.environ.get("CHUNK_DIGESTS") == "1",
+    )
+    settings = Settings(
+        llm="gemini/gemini-1.5-flash-002",
+        summary_llm="gemini/gemini-1.5-flash-002",
+        embedding="gemini/text-embedding-004",
+    )
+
+    async def work() -> None:
+        try:
+            await run_worker(
+                JobQueue(args.db),
+                upload_job(docs, settings),
+                concurrency=args.concurrency,
+                poll_interval=args.poll_interval,
+            )
+        finally:
+            await docs.aclose()
+
+    asyncio.run(work())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ingestion jobs from the local job queue.")
+    parser.add_argument("--db", default=os.environ.get("JOBS_DB", "jobs/jobs.sqlite"))
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    main(parser.parse_args())
@@ -0,0 +1,73 @@
+from typing import Literal
+import math
+
+from pydantic import BaseModel
+
+from tracing import metrics
+
+
+# full: summarize evidence_k chunks, reduced: summarize fewer, digest: the summaries made
+# at upload, skip_summary: raw chunks straight into the answer prompt, cache_only: no LLM
+# calls, a recent answer or none
+QueryMode = Literal["full", "reduced", "digest", "skip_summary", "cache_only"]
+
+# seconds, used until a stage has been observed in this process
+DEFAULT_LATENCIES = {"retrieve_texts": 0.5, "evidence.summary": 3.0, "answer": 5.0}
+
+
+class QueryPlan(BaseModel):
+    """How a query is answered within its latency budget."""
+
+    mode: QueryMode
+    evidence_k: int
+    budget: float
+    # seconds, from the recent latencies of each stage
+    estimated: float | None = None
+
+
+def stage_latency(stage: str) -> float:
+    observed = metrics.recent_latency(stage)
+    return DEFAULT_LATENCIES[stage] if observed is None else observed
+
+
+def plan_query(
+    budget: float,
+    evidence_k: int,
+    max_concurrent_requests: int,
+    min_evidence_k: int = 2,
+    digested: float = 0.0,
+) -> QueryPlan:
+    """The most thorough mode expected to finish within `budget` seconds.
+
+    Summaries run `max_concurrent_requests` at a time, so a query takes about retrieval,
+    one summary per wave of summaries and the answer. `digested` is the share of chunks
+    summarized at upload, in digest mode only the rest are summarized for the question.
+    """
+    retrieval = stage_latency("retrieve_texts")
+    summary = stage_latency("evidence.summary")
+    answer = stage_latency("answer")
+
+    def estimate(k: int) -> float:
+        return retrieval + math.ceil(k / max(max_concurrent_requests, 1)) * summary + answer
+
+    if estimate(evidence_k) <= budget:
+        return QueryPlan(
+            mode="full", evidence_k=evidence_k, budget=budget, estimated=estimate(evidence_k)
+        )
+    for k in range(evidence_k - 1, min_evidence_k - 1, -1):
+        if estimate(k) <= budget:
+            return QueryPlan(mode="reduced", evidence_k=k, budget=budget, estimated=estimate(k))
+    if digested > 0:
+        undigested = estimate(math.ceil(evidence_k * (1 - digested)))
+        if undigested <= budget:
+            return QueryPlan(
+                mode="digest", evidence_k=evidence_k, budget=budget, estimated=undigested
+            )
+    if retrieval + answer <= budget:
+        return QueryPlan(
+            mode="skip_summary",
+            evidence_k=evidence_k,
+            budget=budget,
+            estimated=retrieval + answer,
+        )
+    return QueryPlan(mode="cache_only", evidence_k=0, budget=budget)
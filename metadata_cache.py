@@ -0,0 +1,167 @@
+from collections.abc import Collection, Sequence
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+import asyncio
+import logging
+import re
+import sqlite3
+import time
+
+import aiohttp
+
+from paperqa.clients import DEFAULT_CLIENTS, DocMetadataClient
+from paperqa.clients.client_models import MetadataPostProcessor, MetadataProvider
+from paperqa.types import DocDetails
+
+from scheduler import TokenBucket
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def normalize_words(text: str) -> str:
+    return " ".join(WORD_PATTERN.findall(text.lower()))
+
+
+def metadata_keys(
+    doi: str | None = None,
+    title: str | None = None,
+    authors: Sequence[str] | None = None,
+    fields: Collection[str] | None = None,
+) -> list[str]:
+    """Cache keys for a lookup, the DOI first since it is the more specific one.
+
+    Title lookups are scored against the authors and only `fields` are fetched, so both
+    are part of the keys.
+    """
+    suffix = f"|fields:{','.join(sorted(fields))}" if fields else ""
+    keys = []
+    if doi:
+        doi = re.sub(r"^https?://(dx\.)?doi\.org/", "", doi.strip().lower())
+        keys.append(f"doi:{doi}{suffix}")
+    if title:
+        by = f"|authors:{';'.join(normalize_words(a) for a in authors)}" if authors else ""
+        keys.append(f"title:{normalize_words(title)}{by}{suffix}")
+    return keys
+
+
+class CachedMetadataClient(DocMetadataClient):
+    """DocMetadataClient with a persistent cache of results and misses.
+
+    Results are stored in SQLite under their DOI and normalized title, lookups that
+    found nothing are remembered for `negative_ttl` seconds. Concurrent lookups of the
+    same document are made once, and lookups that reach the providers are rate limited
+    and share one HTTP session per event loop, so concurrent uploads can use one client.
+    """
+
+    def __init__(
+        self,
+        path: Path | str,
+        clients: (
+            Collection[type[MetadataPostProcessor | MetadataProvider]]
+            | Sequence[Collection[type[MetadataPostProcessor | MetadataProvider]]]
+        ) = DEFAULT_CLIENTS,
+        lookups_per_second: float = 2.0,
+        # providers also report errors as not found, so misses are retried after a day
+        negative_ttl: float = 24 * 3600,
+    ):
+        super().__init__(clients=clients)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.negative_ttl = negative_ttl
+        self.bucket = TokenBucket(lookups_per_second, max(lookups_per_second, 1))
+        self.single_flight = SingleFlight()
+        self._session_loop: asyncio.AbstractEventLoop | None = None
+        self.hits = self.misses = 0
+        with self.connect() as db:
+            db.execute("pragma journal_mode=wal")
+            db.execute(
+                """
+                create table if not exists metadata (
+                    key text primary key,
+                    details text,
+                    fetched_at real not null
+                )
+                """
+            )
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get(self, keys: list[str]) -> tuple[bool, DocDetails | None]:
+        """(found, details) for the first cached key, details is None for a cached miss."""
+        if not keys:
+            return False, None
+        with self.connect() as db:
+            rows = {
+                key: (details, fetched_at)
+                for key, details, fetched_at in db.execute(
+                    "select key, details, fetched_at from metadata"
+                    f" where key in ({','.join('?' * len(keys))})",
+                    keys,
+                )
+            }
+        for key in keys:
+            if key not in rows:
+                continue
+            details, fetched_at = rows[key]
+            if details is not None:
+                return True, DocDetails.model_validate_json(details)
+            if time.time() - fetched_at < self.negative_ttl:
+                return True, None
+        return False, None
+
+    def put(
+        self, keys: list[str], details: DocDetails | None, fields: Collection[str] | None = None
+    ) -> None:
+        if details is not None:
+            # found by title, the DOI lookup of the same paper is a hit too
+            keys = list(dict.fromkeys(keys + metadata_keys(doi=details.doi, fields=fields)))
+        value = None if details is None else details.model_dump_json()
+        with self.connect() as db:
+            db.executemany(
+                "insert or replace into metadata (key, details, fetched_at) values (?, ?, ?)",
+                [(key, value, time.time()) for key in keys],
+            )
+
+    async def _fetch(self, keys: list[str], kwargs: dict[str, Any]) -> DocDetails | None:
+        delay = self.bucket.reserve(1)
+        if delay:
+            await asyncio.sleep(delay)
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession()
+            self._session_loop = loop
+        details = await super().query(**kwargs)
+        self.put(keys, details, kwargs.get("fields"))
+        return details
+
+    async def query(self, **kwargs) -> DocDetails | None:
+        keys = metadata_keys(
+            kwargs.get("doi"), kwargs.get("title"), kwargs.get("authors"), kwargs.get("fields")
+        )
+        if not keys:
+            return await super().query(**kwargs)
+        found, details = self.get(keys)
+        if found:
+            self.hits += 1
+            return details
+        self.misses += 1
+        details = await self.single_flight.run(keys[0], lambda: self._fetch(keys, kwargs))
+        # callers modify the details they get back
+        return None if details is None else details.model_copy(deep=True)
+
+    async def close(self) -> None:
+        """Close the HTTP session, a later lookup opens a new one."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
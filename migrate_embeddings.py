@@ -0,0 +1,270 @@
+"""Re-embed stored chunk text and abstracts with a new embedding model.
+
+    python migrate_embeddings.py backfill --version v2 --model gemini/text-embedding-005
+    python migrate_embeddings.py status
+    python migrate_embeddings.py activate v2
+
+Backfills read the text already in the database, so no document is parsed again. They
+page through each table by id and store the last id after every batch, so an
+interrupted backfill resumes where it stopped. Queries keep using the active version
+until `activate` points them at the new one.
+"""
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import logging
+import os
+
+from supabase._async.client import create_client as create_async_client, AsyncClient
+
+from paperqa.llms import EmbeddingModel, embedding_model_factory
+
+from embedding_versions import (
+    LEGACY_VERSION,
+    EmbeddingVersion,
+    activate_version,
+    fetch_active_version,
+    fetch_versions,
+)
+from scheduler import TokenBucket, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+# (source table, text column, target table, foreign key, cursor field)
+BACKFILLS = [
+    ("chunks", "text", "chunk_embeddings", "chunk", "chunk_cursor"),
+    ("documents", "abstract", "document_embeddings", "document", "document_cursor"),
+]
+
+
+class Throttle:
+    """Requests and tokens per minute limits for the embedding calls."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float | None = None):
+        self.requests = TokenBucket(requests_per_minute / 60, max(requests_per_minute / 60, 1))
+        self.tokens = (
+            TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60)
+            if tokens_per_minute
+            else None
+        )
+
+    async def wait(self, texts: list[str]) -> None:
+        delay = self.requests.reserve(1)
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.reserve(estimate_tokens(*texts)))
+        if delay:
+            await asyncio.sleep(delay)
+
+
+async def register_version(
+    supabase: AsyncClient, version: str, model: str
+) -> EmbeddingVersion:
+    existing = {v.version: v for v in await fetch_versions(supabase)}
+    if version in existing:
+        if existing[version].model != model:
+            raise ValueError(
+                f"Version {version} already uses {existing[version].model}, pick a new name"
+            )
+        return existing[version]
+    created = EmbeddingVersion(
+        version=version, model=model, created_at=datetime.now(timezone.utc)
+    )
+    await (
+        supabase.table("embedding_versions")
+        .insert(created.model_dump(mode="json", exclude_none=True))
+        .execute()
+    )
+    return created
+
+
+async def update_version(supabase: AsyncClient, version: str, **values) -> None:
+    await supabase.table("embedding_versions").update(values).eq("version", version).execute()
+
+
+async def embed_rows(
+    supabase: AsyncClient,
+    version: EmbeddingVersion,
+    model: EmbeddingModel,
+    throttle: Throttle,
+    rows: list[dict],
+    text_column: str,
+    target: str,
+    foreign_key: str,
+) -> None:
+    texts = [row[text_column] for row in rows]
+    await throttle.wait(texts)
+    embeddings = await model.embed_documents(texts=texts)
+    if version.ndim is None:
+        version.ndim = len(embeddings[0])
+        await update_version(supabase, version.version, ndim=version.ndim)
+    await (
+        supabase.table(target)
+        .upsert(
+            [
+                {foreign_key: row["id"], "version": version.version, "embedding": e}
+                for row, e in zip(rows, embeddings, strict=True)
+            ],
+            on_conflict=f"{foreign_key},version",
+        )
+        .execute()
+    )
+
+
+async def count_rows(supabase: AsyncClient, table: str, text_column: str) -> int:
+    response = await (
+        supabase.table(table)
+        .select("id", count="exact")
+        .not_.is_(text_column, "null")
+        .limit(1)
+        .execute()
+    )
+    return response.count or 0
+
+
+async def backfill(
+    supabase: AsyncClient,
+    version: EmbeddingVersion,
+    model: EmbeddingModel,
+    throttle: Throttle,
+    batch_size: int = 100,
+) -> None:
+    for table, text_column, target, foreign_key, cursor_field in BACKFILLS:
+        total = await count_rows(supabase, table, text_column)
+        done = 0
+        cursor = getattr(version, cursor_field)
+        while True:
+            request = (
+                supabase.table(table)
+                .select(f"id,{text_column}")
+                .not_.is_(text_column, "null")
+            )
+            if cursor is not None:
+                request = request.gt("id", cursor)
+            rows = (await request.order("id").limit(batch_size).execute()).data
+            if not rows:
+                break
+            await embed_rows(
+                supabase, version, model, throttle, rows, text_column, target, foreign_key
+            )
+            cursor = rows[-1]["id"]
+            setattr(version, cursor_field, cursor)
+            await update_version(supabase, version.version, **{cursor_field: cursor})
+            done += len(rows)
+            logger.info(f"{table}: {done} embedded this run, {total} in total")
+
+        # ids are random, rows inserted during the backfill may sort before the cursor
+        await catch_up(
+            supabase, version, model, throttle, batch_size, table, text_column, target, foreign_key
+        )
+
+    await update_version(
+        supabase,
+        version.version,
+        status="complete",
+        completed_at=datetime.now(timezone.utc).isoformat(),
+    )
+    logger.info(f"Version {version.version} is complete, activate it to switch queries over")
+
+
+async def catch_up(
+    supabase: AsyncClient,
+    version: EmbeddingVersion,
+    model: EmbeddingModel,
+    throttle: Throttle,
+    batch_size: int,
+    table: str,
+    text_column: str,
+    target: str,
+    foreign_key: str,
+) -> None:
+    """Embed rows created since the version was registered that have no vector yet."""
+    after = None
+    while True:
+        request = (
+            supabase.table(table)
+            .select(f"id,{text_column}")
+            .not_.is_(text_column, "null")
+            .gte("created_at", version.created_at.isoformat())
+        )
+        if after is not None:
+            request = request.gt("id", after)
+        rows = (await request.order("id").limit(batch_size).execute()).data
+        if not rows:
+            return
+        after = rows[-1]["id"]
+        # uploads write vectors for backfilling versions too, most rows already have one
+        existing = (
+            await supabase.table(target)
+            .select(foreign_key)
+            .eq("version", version.version)
+            .in_(foreign_key, [row["id"] for row in rows])
+            .execute()
+        ).data
+        existing_ids = {row[foreign_key] for row in existing}
+        missing = [row for row in rows if row["id"] not in existing_ids]
+        if missing:
+            logger.info(f"{table}: catching up {len(missing)} rows")
+            await embed_rows(
+                supabase, version, model, throttle, missing, text_column, target, foreign_key
+            )
+
+
+async def status(supabase: AsyncClient) -> None:
+    active = await fetch_active_version(supabase)
+    print(f"active: {active.version if active else LEGACY_VERSION}")
+    for version in await fetch_versions(supabase):
+        print(
+            f"{version.version}: {version.model}, {version.status}, ndim {version.ndim},"
+            f" chunk cursor {version.chunk_cursor}"
+        )
+
+
+async def main(args: argparse.Namespace):
+    supabase = await create_async_client(
+        os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
+    )
+    if args.command == "backfill":
+        version = await register_version(supabase, args.version, args.model)
+        if version.status != "backfilling":
+            logger.info(f"Version {version.version} is already {version.status}")
+            return
+        await backfill(
+            supabase,
+            version,
+            embedding_model_factory(args.model),
+            Throttle(args.requests_per_minute, args.tokens_per_minute),
+            batch_size=args.batch_size,
+        )
+    elif args.command == "status":
+        await status(supabase)
+    elif args.command == "activate":
+        await activate_version(supabase, args.version, force=args.force)
+        logger.info(f"Queries now use version {args.version}")
+    elif args.command == "retire":
+        active = await fetch_active_version(supabase)
+        if args.version == (active.version if active else LEGACY_VERSION):
+            raise ValueError("Can't retire the active version")
+        await update_version(supabase, args.version, status="retired")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="embed stored text with a new model")
+    backfill_parser.add_argument("--version", required=True)
+    backfill_parser.add_argument("--model", required=True)
+    backfill_parser.add_argument("--batch-size", type=int, default=100)
+    backfill_parser.add_argument("--requests-per-minute", type=float, default=300)
+    backfill_parser.add_argument("--tokens-per-minute", type=float, default=None)
+    commands.add_parser("status", help="show the active version and backfill progress")
+    activate_parser = commands.add_parser("activate", help="switch queries to a version")
+    activate_parser.add_argument("version")
+    activate_parser.add_argument("--force", action="store_true")
+    retire_parser = commands.add_parser("retire", help="stop writing vectors for a version")
+    retire_parser.add_argument("version")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+import gzip
+import hashlib
+import logging
+import os
+
+from paperqa.readers import chunk_code_text, chunk_pdf, chunk_text, read_doc
+from paperqa.types import Doc, ParsedText, Text
+
+logger = logging.getLogger(__name__)
+
+
+def package_version(name: str) -> str:
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+# parsed pages only change when the parsers do
+PARSER_VERSION = f"paper-qa-{package_version('paper-qa')}/pymupdf-{package_version('pymupdf')}"
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """On-disk cache of parsed page text, keyed by file content hash and parser settings.
+
+    Entries are gzipped `ParsedText` JSON, so chunking with different sizes, retried
+    uploads and the citation peek never parse the same file twice. The most recent
+    entries are also kept in memory.
+    """
+
+    def __init__(self, directory: Path | str, memory_entries: int = 16):
+        self.directory = Path(directory)
+        self.memory_entries = memory_entries
+        self._memory: OrderedDict[str, ParsedText] = OrderedDict()
+        # (path, size, mtime) -> content hash, so a file is hashed once per process
+        self._hashes: dict[tuple[str, int, int], str] = {}
+
+    def key(self, path: Path, page_size_limit: int | None) -> str:
+        stat = path.stat()
+        file_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+        if file_key not in self._hashes:
+            self._hashes[file_key] = file_hash(path)
+        settings = f"{PARSER_VERSION}/{path.suffix.lower()}/limit-{page_size_limit}"
+        return hashlib.sha256(
+            f"{self._hashes[file_key]}/{settings}".encode()
+        ).hexdigest()
+
+    def parse(self, path: Path | str, page_size_limit: int | None = None) -> ParsedText:
+        path = Path(path)
+        key = self.key(path, page_size_limit)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        entry = self.directory / key[:2] / f"{key}.json.gz"
+        parsed = None
+        if entry.exists():
+            try:
+                parsed = ParsedText.model_validate_json(gzip.decompress(entry.read_bytes()))
+            except (OSError, ValueError):
+                logger.warning(f"Ignoring unreadable parse cache entry {entry}")
+        if parsed is None:
+            parsed = read_doc(
+                path,
+                Doc(docname="", citation="", dockey=key),
+                parsed_text_only=True,
+                page_size_limit=page_size_limit,
+            )
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            temporary = entry.with_suffix(f".{os.getpid()}.tmp")
+            temporary.write_bytes(gzip.compress(parsed.model_dump_json().encode(), 3))
+            os.replace(temporary, entry)
+        self._memory[key] = parsed
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+        return parsed
+
+    def read_doc(
+        self,
+        path: Path | str,
+        doc: Doc,
+        chunk_chars: int = 3000,
+        overlap: int = 100,
+        page_size_limit: int | None = None,
+    ) -> list[Text]:
+        """Same as paperqa.readers.read_doc, with the parsing served from the cache."""
+        parsed = self.parse(path, page_size_limit)
+        str_path = str(path)
+        if chunk_chars == 0:
+            return [Text(text=parsed.reduce_content(), name=doc.docname, doc=doc)]
+        if str_path.endswith(".pdf"):
+            return chunk_pdf(parsed, doc, chunk_chars=chunk_chars, overlap=overlap)
+        if str_path.endswith((".txt", ".html")):
+            return chunk_text(parsed, doc, chunk_chars=chunk_chars, overlap=overlap)
+        return chunk_code_text(parsed, doc, chunk_chars=chunk_chars, overlap=overlap)
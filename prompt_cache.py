@@ -0,0 +1,94 @@
+from collections.abc import Callable
+from contextlib import contextmanager
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+import time
+
+from paperqa.llms import LLMModel
+from paperqa.types import LLMResult
+
+
+def sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class PromptCache:
+    """Persistent cache of LLM completions, keyed by model, prompt template and inputs.
+
+    Meant for deterministic ingestion prompts, so retried uploads and re-uploads of the
+    same text don't pay for the same completion twice.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as db:
+            db.execute("pragma journal_mode=wal")
+            db.execute(
+                """
+                create table if not exists completions (
+                    key text primary key,
+                    model text not null,
+                    text text not null,
+                    created_at real not null
+                )
+                """
+            )
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def key(model: str, prompt: str, data: dict, system_prompt: str | None = None) -> str:
+        return sha256(
+            json.dumps(
+                [
+                    model,
+                    sha256(prompt),
+                    sha256(system_prompt or ""),
+                    {k: sha256(str(v)) for k, v in data.items()},
+                ],
+                sort_keys=True,
+            )
+        )
+
+    def get(self, key: str) -> str | None:
+        with self.connect() as db:
+            row = db.execute("select text from completions where key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key: str, model: str, text: str) -> None:
+        with self.connect() as db:
+            db.execute(
+                "insert or replace into completions (key, model, text, created_at)"
+                " values (?, ?, ?, ?)",
+                (key, model, text, time.time()),
+            )
+
+    async def run_prompt(
+        self,
+        llm_model: LLMModel,
+        prompt: str,
+        data: dict,
+        cacheable: Callable[[str], bool] | None = None,
+        **kwargs,
+    ) -> tuple[LLMResult, bool]:
+        """`llm_model.run_prompt` through the cache, returns the result and whether it was cached.
+
+        Only completions `cacheable` accepts are stored and served, so one that failed to
+        parse is asked for again on the next upload instead of replayed forever.
+        """
+        key = self.key(llm_model.name, prompt, data, kwargs.get("system_prompt"))
+        if (text := self.get(key)) is not None and (cacheable is None or cacheable(text)):
+            return LLMResult(model=llm_model.name, name=kwargs.get("name"), text=text), True
+        result = await llm_model.run_prompt(prompt=prompt, data=data, **kwargs)
+        if cacheable is None or cacheable(result.text):
+            self.put(key, llm_model.name, result.text)
+        return result, False
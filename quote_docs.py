@@ -5,6 +5,7 @@ import re
 from paperqa.docs import Docs
 from paperqa.llms import EmbeddingModel, LLMModel
 from paperqa.settings import (
+    AnswerSettings,
     MaybeSettings,
     PromptSettings,
     get_settings,
@@ -51,8 +52,28 @@ Provide a summary of the relevant information that could help answer the questio
 where `summary` is relevant information from text - {summary_length} words, `relevance_score` is the relevance of `summary` to answer question (out of 10), and `points` is an array of `point` and `quote` pairs that supports the summary where each `quote` is an exact match quote (max 50 words) from the text that best supports the respective `point`. Make sure that the quote is an exact match without truncation or changes. Do not truncate the quote with any ellipsis.
 """  # noqa: E501
 
+# Question-independent version of point_form_json_system_prompt_with_quote, run once per chunk at upload
+digest_json_system_prompt_with_quote = """\
+Provide a summary of the key information in the excerpt, so that it can later be used to answer questions about it. Respond with the following JSON format:
+
+{{
+  "summary": "...",
+  "points": [
+    {{
+        "quote": "...",
+        "point": "..."
+    }}
+  ]
+}}
+
+where `summary` is the key information from text - {summary_length} words, and `points` is an array of `point` and `quote` pairs covering the main findings, claims and figures, where each `quote` is an exact match quote (max 50 words) from the text that best supports the respective `point`. Make sure that the quote is an exact match without truncation or changes. Do not truncate the quote with any ellipsis.
+"""  # noqa: E501
+
+digest_prompt = "Excerpt from {citation}\n\n----\n\n{text}\n\n----\n\n"
+
 CONTEXT_INNER_PROMPT_WITH_QUOTE = "{name}: {text}\n{quotes}\nFrom {citation}"
 
+# superseded by quote_locator.locate_quote, which finds quotes without an LLM call
 retrieve_relevant_quote_json_system_prompt = """\
 Retrieve a quote from the text that best supports the claim. Respond with the following JSON format:
 
@@ -139,6 +160,14 @@ class PromptQuoteSettings(PromptSettings):
         return v
 
 
+class AnswerQuoteSettings(AnswerSettings):
+    # estimated tokens of context in the answer prompt, None packs every source
+    answer_context_token_budget: int | None = None
+    # use the digests made at upload as evidence instead of summarizing for the question,
+    # chunks without one are still summarized
+    evidence_from_digests: bool = False
+
+
 class QuoteDocs(Docs):
 
     async def aquery(  # noqa: PLR0912
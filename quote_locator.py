@@ -0,0 +1,147 @@
+from collections import defaultdict
+from collections.abc import Sequence
+import re
+
+from pydantic import BaseModel
+
+from paperqa.types import Context, ParsedText, Text
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class QuoteSpan(BaseModel):
+    """Where a quote is in its chunk.
+
+    `start` and `end` are character offsets into the chunk text, `page_offset` is the
+    offset of `start` into the text of `page` when the chunk has page starts.
+    """
+
+    start: int
+    end: int
+    page: int | None = None
+    page_offset: int | None = None
+    # share of the quote's words found in the span, 1.0 for an exact match
+    score: float
+    exact: bool
+
+
+def words(text: str) -> tuple[list[str], list[tuple[int, int]]]:
+    matches = list(WORD_PATTERN.finditer(text))
+    return [m.group().lower() for m in matches], [m.span() for m in matches]
+
+
+def chunk_page_starts(parsed: ParsedText, chunk_chars: int, overlap: int) -> list[list[int]]:
+    """Offsets in each chunk's text where each of its pages starts.
+
+    Replays paperqa.readers.chunk_pdf over the page lengths, so the pages line up with
+    the ones in the chunk names. An offset is negative when the chunk starts partway
+    into the page. Like paperqa, `chunk_chars` of 0 is a single chunk of every page.
+    """
+    if not isinstance(parsed.content, dict):
+        return []
+    if chunk_chars == 0:
+        chunk_chars, overlap = sum(len(page_text) for page_text in parsed.content.values()), 0
+    elif chunk_chars <= overlap:
+        # chunks would never advance
+        raise ValueError(f"overlap ({overlap}) must be smaller than chunk_chars ({chunk_chars})")
+    starts: list[list[int]] = []
+    # document offsets of the pages in the current split and of the split itself
+    pages: list[int] = []
+    split_start = position = 0
+    for page_text in parsed.content.values():
+        pages.append(position)
+        position += len(page_text)
+        while position - split_start > chunk_chars:
+            starts.append([p - split_start for p in pages])
+            split_start += chunk_chars - overlap
+            pages = [pages[-1]]
+    if position - split_start > overlap or not starts:
+        starts.append([p - split_start for p in pages])
+    return starts
+
+
+def locate_quote(
+    quote: str,
+    text: str,
+    pages: Sequence[int] = (),
+    page_starts: Sequence[int] = (),
+    min_score: float = 0.5,
+) -> QuoteSpan | None:
+    """Find `quote` in `text`, tolerating the edits LLMs make when quoting.
+
+    Matching is on lowercased words, so whitespace, punctuation and line breaks don't
+    matter. Word n-grams of the quote vote for their alignment with the text, and the
+    densest run of alignments is the span. Elided or reworded words only lower the
+    score, so truncated quotes and quotes with ellipses are still found.
+    """
+    quote_words, _ = words(quote)
+    text_words, text_spans = words(text)
+    if not quote_words or not text_words:
+        return None
+
+    n = min(3, len(quote_words))
+    index: dict[tuple[str, ...], list[int]] = defaultdict(list)
+    for i in range(len(text_words) - n + 1):
+        index[tuple(text_words[i : i + n])].append(i)
+
+    # (alignment, text position, quote position) of every shared n-gram
+    hits = []
+    for j in range(len(quote_words) - n + 1):
+        for i in index.get(tuple(quote_words[j : j + n]), ()):
+            hits.append((i - j, i, j))
+    if not hits:
+        return None
+    hits.sort()
+
+    # alignments may drift by a few words where the quote skips or adds some
+    drift = max(3, len(quote_words) // 5)
+    best: tuple[int, int, int] | None = None
+    lo = 0
+    for hi in range(len(hits)):
+        while hits[hi][0] - hits[lo][0] > drift:
+            lo += 1
+        window = hits[lo : hi + 1]
+        covered = len({q + k for _, _, q in window for k in range(n)})
+        if best is None or covered > best[0]:
+            best = (covered, lo, hi + 1)
+    covered, lo, hi = best
+    score = covered / len(quote_words)
+    if score < min_score:
+        return None
+
+    first = min(i for _, i, _ in hits[lo:hi])
+    last = max(i for _, i, _ in hits[lo:hi]) + n - 1
+    start, end = text_spans[first][0], text_spans[last][1]
+    span = QuoteSpan(
+        start=start,
+        end=end,
+        score=score,
+        exact=score == 1.0 and last - first + 1 == len(quote_words),
+    )
+    if page_starts and len(page_starts) == len(pages):
+        # the last page that starts at or before the quote
+        for page, page_start in zip(pages, page_starts, strict=True):
+            if page_start > start:
+                break
+            span.page, span.page_offset = page, start - page_start
+    elif len(pages) == 1:
+        span.page = pages[0]
+    return span
+
+
+def locate_context_quotes(context: Context, chunk: Text) -> None:
+    """Add the `location` in `chunk` to every quote point of `context`, None if not found.
+
+    `chunk` is the summarized text as retrieved, contexts only keep a plain `Text`.
+    """
+    for point in (context.model_extra or {}).get("points") or []:
+        if not isinstance(point, dict):
+            continue
+        span = locate_quote(
+            str(point.get("quote") or ""),
+            chunk.text,
+            pages=getattr(chunk, "pages", ()),
+            page_starts=getattr(chunk, "page_starts", ()),
+        )
+        point["location"] = None if span is None else span.model_dump()
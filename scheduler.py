@@ -0,0 +1,285 @@
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from typing import Any, TypeVar
+import asyncio
+import logging
+import math
+import threading
+import time
+
+from pydantic import BaseModel
+
+from paperqa.types import LLMResult
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RateLimit(BaseModel):
+    requests_per_minute: float | None = None
+    tokens_per_minute: float | None = None
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` per second, up to `capacity`.
+
+    Reservations may push the balance negative, the caller then waits until the debt is
+    refilled. That keeps reservations first come first served without a waiter queue.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.balance = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.balance = min(self.capacity, self.balance + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` and return how long to wait before using it, in seconds."""
+        self._refill()
+        self.balance -= amount
+        return max(0.0, -self.balance / self.rate)
+
+    def refund(self, amount: float) -> None:
+        self._refill()
+        self.balance = min(self.capacity, self.balance + amount)
+
+
+class ModelState:
+    def __init__(self, limit: RateLimit, concurrency: int):
+        self.set_limit(limit)
+        self.concurrency = float(concurrency)
+        self.in_flight = 0
+        # query id -> waiting futures, rotated for round-robin dispatch
+        self.queues: OrderedDict[Any, deque[asyncio.Future]] = OrderedDict()
+        # futures that were handed a slot but may not have woken up yet
+        self.granted: set[asyncio.Future] = set()
+        self.latency: float | None = None
+        self.decreased_at = -math.inf
+
+    def set_limit(self, limit: RateLimit) -> None:
+        self.requests = (
+            TokenBucket(limit.requests_per_minute / 60, limit.requests_per_minute / 60)
+            if limit.requests_per_minute
+            else None
+        )
+        # allow a full minute's tokens in one burst, a single summary can be large
+        self.tokens = (
+            TokenBucket(limit.tokens_per_minute / 60, limit.tokens_per_minute)
+            if limit.tokens_per_minute
+            else None
+        )
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    # litellm raises RateLimitError, other clients at least carry the status code
+    return (
+        getattr(e, "status_code", None) == 429  # noqa: PLR2004
+        or type(e).__name__ == "RateLimitError"
+    )
+
+
+def estimate_tokens(*texts: Any) -> int:
+    return sum(len(str(t)) for t in texts) // 4
+
+
+class LLMScheduler:
+    """Process-wide scheduler for LLM calls.
+
+    Per model it enforces request and token budgets with token buckets and keeps an
+    adaptive concurrency limit: it halves on 429s and when latency exceeds
+    `target_latency` on average, at most once per `cooldown` or average call latency,
+    and grows by one per window of successful calls (AIMD). Slots
+    are handed out round-robin across queries, so one query with many summaries cannot
+    starve the others.
+
+    State is guarded by a thread lock and waiters are woken through their own loop, so
+    one scheduler serves calls from every thread and event loop in the process.
+    """
+
+    def __init__(
+        self,
+        limits: dict[str, RateLimit] | None = None,
+        initial_concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_concurrency: int = 64,
+        target_latency: float | None = None,
+        max_retries: int = 4,
+        backoff: float = 1.0,
+        cooldown: float = 1.0,
+    ):
+        self.limits = dict(limits or {})
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.models: dict[str, ModelState] = {}
+
+    def set_limit(self, model: str, limit: RateLimit) -> None:
+        with self.lock:
+            self.limits[model] = limit
+            if model in self.models:
+                self.models[model].set_limit(limit)
+
+    def state(self, model: str) -> ModelState:
+        # callers hold self.lock
+        if model not in self.models:
+            self.models[model] = ModelState(
+                self.limits.get(model, RateLimit()), self.initial_concurrency
+            )
+        return self.models[model]
+
+    def _dispatch(self, state: ModelState) -> None:
+        while state.queues and state.in_flight < int(state.concurrency):
+            query_id, queue = state.queues.popitem(last=False)
+            future = queue.popleft()
+            if queue:
+                state.queues[query_id] = queue
+            if future.done():
+                continue
+            state.in_flight += 1
+            state.granted.add(future)
+            future.get_loop().call_soon_threadsafe(_wake, future)
+
+    async def _acquire(self, model: str, query_id: Any) -> None:
+        future = asyncio.get_running_loop().create_future()
+        with self.lock:
+            state = self.state(model)
+            state.queues.setdefault(query_id, deque()).append(future)
+            self._dispatch(state)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                # the slot may have been granted right before the cancellation
+                if future in state.granted:
+                    state.granted.discard(future)
+                    state.in_flight -= 1
+                    self._dispatch(state)
+            raise
+        with self.lock:
+            state.granted.discard(future)
+
+    def _release(self, model: str) -> None:
+        with self.lock:
+            state = self.state(model)
+            state.in_flight -= 1
+            self._dispatch(state)
+
+    def _reserve(self, model: str, tokens: int) -> float:
+        with self.lock:
+            state = self.state(model)
+            delay = 0.0
+            if state.requests is not None:
+                delay = max(delay, state.requests.reserve(1))
+            if state.tokens is not None:
+                delay = max(delay, state.tokens.reserve(tokens))
+            return delay
+
+    def _record(self, model: str, latency: float | None, rate_limited: bool = False) -> None:
+        with self.lock:
+            state = self.state(model)
+            if latency is not None:
+                state.latency = (
+                    latency if state.latency is None else 0.8 * state.latency + 0.2 * latency
+                )
+            slow = (
+                self.target_latency is not None
+                and state.latency is not None
+                and state.latency > self.target_latency
+            )
+            if rate_limited or slow:
+                # calls already in flight when the limit was cut still see the old load,
+                # so a burst of 429s or slow calls halves it once per round trip
+                now = time.monotonic()
+                if now - state.decreased_at < max(self.cooldown, state.latency or 0.0):
+                    return
+                state.decreased_at = now
+                state.concurrency = max(self.min_concurrency, state.concurrency / 2)
+                if slow:
+                    # start the average over so one slow spell halves only once
+                    state.latency = None
+                logger.info(
+                    f"Reduced {model} concurrency to {int(state.concurrency)}"
+                    + (" after a 429" if rate_limited else " as calls slowed down")
+                )
+            else:
+                # additive increase, one extra slot per window of successful calls
+                state.concurrency = min(
+                    self.max_concurrency, state.concurrency + 1 / state.concurrency
+                )
+                self._dispatch(state)
+
+    async def run(
+        self,
+        model: str,
+        fn: Callable[[], Awaitable[T]],
+        estimated_tokens: int = 0,
+        query_id: Any = None,
+    ) -> T:
+        """Run `fn` once a slot and the rate budget for `model` are available, retrying 429s."""
+        attempt = 0
+        while True:
+            await self._acquire(model, query_id)
+            try:
+                if delay := self._reserve(model, estimated_tokens):
+                    await asyncio.sleep(delay)
+                start = time.monotonic()
+                result = await fn()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self._record(model, None, rate_limited=True)
+            else:
+                self._record(model, time.monotonic() - start)
+                if isinstance(result, LLMResult):
+                    self._settle_tokens(model, estimated_tokens, result)
+                return result
+            finally:
+                self._release(model)
+            await asyncio.sleep(self.backoff * 2**attempt)
+            attempt += 1
+
+    def _settle_tokens(self, model: str, estimated_tokens: int, result: LLMResult) -> None:
+        # correct the token bucket by the difference between the estimate and actual usage
+        with self.lock:
+            state = self.state(model)
+            if state.tokens is None:
+                return
+            difference = estimated_tokens - (result.prompt_count + result.completion_count)
+            if difference > 0:
+                state.tokens.refund(difference)
+            else:
+                state.tokens.reserve(-difference)
+
+    def prompt_runner(self, runner: Callable, model: str, query_id: Any = None) -> Callable:
+        """Wrap a paperqa prompt runner, e.g. a partial of `LLMModel.run_prompt`."""
+
+        async def run(data: dict, callbacks=None, name: str | None = None) -> LLMResult:
+            # the prompt template and system prompt are bound in the partial
+            bound = [*getattr(runner, "args", ()), *getattr(runner, "keywords", {}).values()]
+            return await self.run(
+                model,
+                lambda: runner(data, callbacks, name),
+                estimated_tokens=estimate_tokens(*data.values(), *bound),
+                query_id=query_id,
+            )
+
+        return run
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+llm_scheduler = LLMScheduler()
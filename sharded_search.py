@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+
+import numpy as np
+
+from chunk_store import ChunkStore, top_k
+
+
+class ShardedSearch:
+    """Exact top-k over a ChunkStore, split into shards that are scored on a thread pool.
+
+    NumPy releases the GIL inside the matrix products, so threads score their shards in
+    parallel while reading the one shared embedding matrix without copying it. All work
+    runs off the asyncio loop, so other requests keep being served during a search.
+    """
+
+    def __init__(self, workers: int | None = None, min_shard_rows: int = 16384):
+        self.workers = workers or os.cpu_count() or 1
+        # below this many rows per shard the thread handoff costs more than it saves
+        self.min_shard_rows = min_shard_rows
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="sharded-search"
+        )
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    def _shards(self, size: int) -> list[tuple[int, int]]:
+        count = max(1, min(self.workers, size // self.min_shard_rows))
+        bounds = np.linspace(0, size, count + 1, dtype=np.int64)
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    @staticmethod
+    def _search_shard(
+        chunks: ChunkStore,
+        queries: np.ndarray,
+        k: int,
+        start: int,
+        end: int,
+        rows: np.ndarray | None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if rows is None:
+            top, scores = top_k(
+                chunks.embeddings[start:end], chunks.norms[start:end], queries, k
+            )
+            return top + start, scores
+        shard_rows = rows[start:end]
+        top, scores = top_k(
+            chunks.embeddings[shard_rows], chunks.norms[shard_rows], queries, k
+        )
+        return shard_rows[top], scores
+
+    async def search_batch(
+        self,
+        chunks: ChunkStore,
+        queries: np.ndarray,
+        k: int,
+        rows: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k rows for each query, as (len(queries), k) arrays sorted by descending score."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        size = len(chunks) if rows is None else len(rows)
+        # snapshot the size, rows appended during the search are not scored
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.executor, self._search_shard, chunks, queries, k, start, end, rows
+                )
+                for start, end in self._shards(size)
+            ]
+        )
+        # merge the per-shard top-k
+        candidates = np.concatenate([r for r, _ in results], axis=1)
+        scores = np.concatenate([s for _, s in results], axis=1)
+        k = min(k, candidates.shape[1])
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        return (
+            np.take_along_axis(candidates, order, axis=1),
+            np.take_along_axis(scores, order, axis=1),
+        )
+
+    async def search(
+        self,
+        chunks: ChunkStore,
+        query: np.ndarray,
+        k: int,
+        rows: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        top, scores = await self.search_batch(chunks, query, k, rows)
+        return top[0], scores[0]
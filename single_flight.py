@@ -0,0 +1,129 @@
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, coalescing then stays within the process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one.
+
+    Within a process, duplicates await the task of the first call. Across processes, the
+    first caller holds an exclusive flock on a per-key lock file in `lock_dir` and writes
+    its JSON result next to it, callers in other processes wait for the lock and reuse
+    that result when it was written while they waited. Without `lock_dir`, only calls
+    within the process are coalesced. The shared call is cancelled once every caller
+    waiting on it has been cancelled.
+    """
+
+    def __init__(
+        self,
+        lock_dir: Path | str | None = None,
+        poll_interval: float = 0.05,
+        result_ttl: float = 60.0,
+    ):
+        self.lock_dir = Path(lock_dir) if lock_dir is not None and fcntl is not None else None
+        if self.lock_dir is not None:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self.poll_interval = poll_interval
+        # results are only shared with calls that were waiting, then cleaned up
+        self.result_ttl = result_ttl
+        self.calls: dict[str, asyncio.Task] = {}
+        self.waiters: dict[str, int] = {}
+        self._last_cleanup = 0.0
+
+    async def run(self, key: str, fn: Callable[[], Awaitable]):
+        task = self.calls.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            # run as its own task, so the first caller going away doesn't cancel the others
+            task = asyncio.ensure_future(self._run_shared(key, fn))
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            logger.debug(f"Coalesced call {key}")
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiters[key] == 1 and not task.done():
+                logger.debug(f"Cancelled call {key}, nobody is waiting for it")
+                task.cancel()
+            raise
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # mark the exception retrieved, every waiter may have gone away
+            task.exception()
+
+    async def _run_shared(self, key: str, fn: Callable[[], Awaitable]):
+        if self.lock_dir is None:
+            return await fn()
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        result_path = self.lock_dir / f"{digest}.json"
+        started = time.time()
+        waited = False
+        with open(self.lock_dir / f"{digest}.lock", "a+") as lock_file:
+            # poll instead of blocking, so waiting stays cancellable and off the loop
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    await asyncio.sleep(self.poll_interval)
+            try:
+                if waited and (result := self._read_result(result_path, started)) is not None:
+                    logger.debug(f"Coalesced call {key} with another process")
+                    return result
+                result = await fn()
+                self._write_result(result_path, result)
+                return result
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_result(self, path: Path, since: float):
+        try:
+            if path.stat().st_mtime < since:
+                return None
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_result(self, path: Path, result) -> None:
+        temporary = path.with_suffix(f".{os.getpid()}.tmp")
+        temporary.write_text(json.dumps(result, default=str))
+        os.replace(temporary, path)
+        self._cleanup()
+
+    def _cleanup(self) -> None:
+        now = time.time()
+        if now - self._last_cleanup < self.result_ttl:
+            return
+        self._last_cleanup = now
+        # lock files stay, unlinking one could race with a process about to lock it
+        for path in self.lock_dir.glob("*.json"):
+            try:
+                if now - path.stat().st_mtime > self.result_ttl:
+                    path.unlink()
+            except OSError:
+                pass
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split()).rstrip("?.! ")
@@ -0,0 +1,325 @@
+"""Export the documents and chunks tables to a columnar snapshot, and import one.
+
+    python snapshot.py export snapshots/2026-10-19
+    python snapshot.py info snapshots/2026-10-19
+    python snapshot.py import snapshots/2026-10-19 --activate
+
+A snapshot is a directory of npz parts plus a manifest, see snapshot_format.py. Vectors
+of the active embedding version are exported with the rows. Export pages through each
+table once, with at most `--concurrency` parts of `--part-rows` rows in memory. Import
+upserts the parts one at a time in large batches, so it can be rerun after a failure.
+`SupabaseStore.snapshot_path` loads a snapshot straight into the search index instead.
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+import numpy as np
+from postgrest.exceptions import APIError
+from supabase._async.client import create_client as create_async_client, AsyncClient
+
+from embedding_versions import (
+    LEGACY_VERSION,
+    activate_version,
+    fetch_active_version,
+    fetch_versions,
+)
+from migrate_embeddings import register_version, update_version
+from snapshot_format import (
+    MANIFEST,
+    OPTIONAL_COLUMNS,
+    TABLES,
+    VECTORS,
+    SnapshotManifest,
+    TableSnapshot,
+    read_parts,
+    write_part,
+)
+from supabase_store import uuid_ranges
+
+logger = logging.getLogger(__name__)
+
+
+async def table_columns(supabase: AsyncClient, table: str) -> list[str]:
+    """The snapshot columns of `table`, without optional ones the deployment doesn't have."""
+    columns = []
+    for column in TABLES[table]:
+        if column in OPTIONAL_COLUMNS:
+            try:
+                await supabase.table(table).select(column).limit(1).execute()
+            except APIError as e:
+                logger.info(f"Skipping {table}.{column}: {e.message}")
+                continue
+        columns.append(column)
+    return columns
+
+
+async def fetch_vectors(
+    supabase: AsyncClient,
+    table: str,
+    foreign_key: str,
+    version: str,
+    first: str,
+    last: str,
+    page_size: int,
+) -> dict[str, str]:
+    """Vectors of `version` for the ids in [first, last]."""
+    vectors = {}
+    after = None
+    while True:
+        request = (
+            supabase.table(table)
+            .select(f"{foreign_key},embedding")
+            .eq("version", version)
+            .gte(foreign_key, first)
+            .lte(foreign_key, last)
+        )
+        if after is not None:
+            request = request.gt(foreign_key, after)
+        page = (await request.order(foreign_key).limit(page_size).execute()).data
+        # a short page isn't the last one when the server caps the page size
+        if not page:
+            return vectors
+        vectors.update({row.get(foreign_key): row.get("embedding") for row in page})
+        after = page[-1].get(foreign_key)
+
+
+async def export_table(
+    supabase: AsyncClient,
+    directory: Path,
+    table: str,
+    manifest: SnapshotManifest,
+    part_rows: int,
+    page_size: int,
+    partitions: int,
+    concurrency: int,
+) -> None:
+    columns = await table_columns(supabase, table)
+    legacy_column, vector_table, foreign_key = VECTORS[table]
+    legacy = manifest.embedding_version == LEGACY_VERSION
+    select = ",".join(columns + ([legacy_column] if legacy else []))
+    snapshot = manifest.tables[table] = TableSnapshot(columns=columns)
+    # each range holds at most one part in memory while it holds the semaphore
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def flush(rows: list[dict], vectors: list) -> None:
+        if manifest.ndim is None:
+            manifest.ndim = next(
+                (len(json.loads(v) if isinstance(v, str) else v) for v in vectors if v), None
+            )
+        name = f"{table}-{len(snapshot.parts):05d}.npz"
+        snapshot.parts.append(name)
+        snapshot.rows += len(rows)
+        await asyncio.to_thread(
+            write_part, directory / name, table, columns, rows, vectors, manifest.ndim or 0
+        )
+        logger.info(f"{table}: {snapshot.rows} rows exported")
+
+    async def export_range(lower: str | None, upper: str | None) -> None:
+        async with semaphore:
+            rows, vectors = [], []
+            after = None
+            while True:
+                request = supabase.table(table).select(select)
+                if lower is not None:
+                    request = request.gte("id", lower)
+                if upper is not None:
+                    request = request.lt("id", upper)
+                if after is not None:
+                    request = request.gt("id", after)
+                page = (await request.order("id").limit(page_size).execute()).data
+                if not page:
+                    break
+                if legacy:
+                    vectors.extend(row.pop(legacy_column, None) for row in page)
+                else:
+                    page_vectors = await fetch_vectors(
+                        supabase,
+                        vector_table,
+                        foreign_key,
+                        manifest.embedding_version,
+                        page[0]["id"],
+                        page[-1]["id"],
+                        page_size,
+                    )
+                    vectors.extend(page_vectors.get(row["id"]) for row in page)
+                rows.extend(page)
+                after = page[-1]["id"]
+                if len(rows) >= part_rows:
+                    await flush(rows, vectors)
+                    rows, vectors = [], []
+            if rows:
+                await flush(rows, vectors)
+
+    await asyncio.gather(
+        *[export_range(lower, upper) for lower, upper in uuid_ranges(partitions)]
+    )
+
+
+async def export_snapshot(
+    supabase: AsyncClient,
+    directory: Path | str,
+    part_rows: int = 50_000,
+    page_size: int = 1000,
+    partitions: int = 16,
+    concurrency: int = 4,
+) -> SnapshotManifest:
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    if (directory / MANIFEST).exists():
+        raise ValueError(f"{directory} already holds a snapshot")
+    version = await fetch_active_version(supabase)
+    manifest = SnapshotManifest(
+        exported_at=datetime.now(timezone.utc),
+        embedding_version=version.version if version else LEGACY_VERSION,
+        embedding_model=version.model if version else None,
+        ndim=version.ndim if version else None,
+    )
+    # chunks first, so the documents of every exported chunk, created before it, are exported
+    for table in reversed(TABLES):
+        await export_table(
+            supabase, directory, table, manifest, part_rows, page_size, partitions, concurrency
+        )
+    manifest.write(directory)
+    return manifest
+
+
+async def import_snapshot(
+    supabase: AsyncClient,
+    directory: Path | str,
+    batch_size: int = 500,
+    concurrency: int = 4,
+) -> SnapshotManifest:
+    """Upsert the snapshot into the tables, documents first for the chunk foreign keys."""
+    manifest = SnapshotManifest.read(directory)
+    legacy = manifest.embedding_version == LEGACY_VERSION
+    if not legacy:
+        existing = {v.version: v for v in await fetch_versions(supabase)}
+        if manifest.embedding_version not in existing:
+            await register_version(
+                supabase, manifest.embedding_version, manifest.embedding_model
+            )
+            await update_version(
+                supabase,
+                manifest.embedding_version,
+                status="complete",
+                ndim=manifest.ndim,
+                completed_at=datetime.now(timezone.utc).isoformat(),
+            )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upsert(table: str, rows: list[dict], matrix: np.ndarray, null: np.ndarray) -> None:
+        legacy_column, vector_table, foreign_key = VECTORS[table]
+        async with semaphore:
+            # lists of floats take several times the memory of the matrix, one batch at a time
+            vectors = [None if missing else v.tolist() for v, missing in zip(matrix, null)]
+            if legacy:
+                rows = [{**row, legacy_column: v} for row, v in zip(rows, vectors, strict=True)]
+            await supabase.table(table).upsert(rows).execute()
+            if not legacy and any(v is not None for v in vectors):
+                await (
+                    supabase.table(vector_table)
+                    .upsert(
+                        [
+                            {
+                                foreign_key: row["id"],
+                                "version": manifest.embedding_version,
+                                "embedding": v,
+                            }
+                            for row, v in zip(rows, vectors, strict=True)
+                            if v is not None
+                        ],
+                        on_conflict=f"{foreign_key},version",
+                    )
+                    .execute()
+                )
+
+    for table in TABLES:
+        done = 0
+        for rows, matrix, null in read_parts(directory, table, manifest):
+            await asyncio.gather(
+                *[
+                    upsert(
+                        table,
+                        rows[i : i + batch_size],
+                        matrix[i : i + batch_size],
+                        null[i : i + batch_size],
+                    )
+                    for i in range(0, len(rows), batch_size)
+                ]
+            )
+            done += len(rows)
+            logger.info(f"{table}: {done} of {manifest.tables[table].rows} rows imported")
+    return manifest
+
+
+def info(directory: Path | str) -> None:
+    manifest = SnapshotManifest.read(directory)
+    print(f"exported at: {manifest.exported_at.isoformat()}")
+    print(
+        f"embeddings: {manifest.embedding_version} ({manifest.embedding_model}),"
+        f" ndim {manifest.ndim}"
+    )
+    for table, snapshot in manifest.tables.items():
+        print(
+            f"{table}: {snapshot.rows} rows in {len(snapshot.parts)} parts,"
+            f" columns {', '.join(snapshot.columns)}"
+        )
+
+
+async def main(args: argparse.Namespace):
+    if args.command == "info":
+        info(args.directory)
+        return
+    supabase = await create_async_client(
+        os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]
+    )
+    if args.command == "export":
+        manifest = await export_snapshot(
+            supabase,
+            args.directory,
+            part_rows=args.part_rows,
+            page_size=args.page_size,
+            partitions=args.partitions,
+            concurrency=args.concurrency,
+        )
+        logger.info(
+            f"Exported {manifest.tables['chunks'].rows} chunks with"
+            f" {manifest.embedding_version} embeddings to {args.directory}"
+        )
+    elif args.command == "import":
+        manifest = await import_snapshot(
+            supabase, args.directory, batch_size=args.batch_size, concurrency=args.concurrency
+        )
+        if args.activate:
+            await activate_version(supabase, manifest.embedding_version)
+            logger.info(f"Queries now use version {manifest.embedding_version}")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the tables to a new snapshot")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--part-rows", type=int, default=50_000)
+    export_parser.add_argument("--page-size", type=int, default=1000)
+    export_parser.add_argument("--partitions", type=int, default=16)
+    export_parser.add_argument("--concurrency", type=int, default=4)
+    import_parser = commands.add_parser("import", help="upsert a snapshot into the tables")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--batch-size", type=int, default=500)
+    import_parser.add_argument("--concurrency", type=int, default=4)
+    import_parser.add_argument(
+        "--activate", action="store_true", help="point queries at the snapshot's embeddings"
+    )
+    info_parser = commands.add_parser("info", help="show what a snapshot holds")
+    info_parser.add_argument("directory")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,154 @@
+from collections.abc import Iterator
+from datetime import datetime
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+from pydantic import BaseModel
+
+from embedding_versions import LEGACY_VERSION
+
+
+# column -> kind, "text" and "json" are stored as one utf-8 buffer with offsets, "ints"
+# as one int32 array with offsets, every column with a mask of its null values
+TABLES: dict[str, dict[str, str]] = {
+    "documents": {
+        "id": "text",
+        "docname": "text",
+        "title": "text",
+        "abstract": "text",
+        "citation": "text",
+        "authors": "json",
+        "published_at": "text",
+        "created_at": "text",
+    },
+    "chunks": {
+        "id": "text",
+        "document": "text",
+        "pages": "ints",
+        "page_starts": "ints",
+        "text": "text",
+        "digest": "json",
+        "created_at": "text",
+    },
+}
+# added by later migrations (see NOTES.md), exported when the table has them
+OPTIONAL_COLUMNS = {"docname", "page_starts", "digest"}
+# (legacy vector column, table of versioned vectors, its foreign key) of each table
+VECTORS = {
+    "documents": ("abstract_emb", "document_embeddings", "document"),
+    "chunks": ("text_emb", "chunk_embeddings", "chunk"),
+}
+MANIFEST = "manifest.json"
+
+
+class TableSnapshot(BaseModel):
+    columns: list[str]
+    rows: int = 0
+    parts: list[str] = []
+
+
+class SnapshotManifest(BaseModel):
+    """Written last, a directory without one is an incomplete export."""
+
+    format: int = 1
+    # taken before the first read, rows created since may or may not be in the snapshot
+    exported_at: datetime
+    embedding_version: str = LEGACY_VERSION
+    embedding_model: str | None = None
+    ndim: int | None = None
+    tables: dict[str, TableSnapshot] = {}
+
+    @classmethod
+    def read(cls, directory: Path | str) -> "SnapshotManifest":
+        return cls.model_validate_json((Path(directory) / MANIFEST).read_text())
+
+    def write(self, directory: Path | str) -> None:
+        path = Path(directory) / MANIFEST
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(self.model_dump_json(indent=2))
+        os.replace(tmp, path)
+
+
+def encode_column(kind: str, values: list) -> dict[str, np.ndarray]:
+    null = np.array([value is None for value in values], dtype=bool)
+    if kind == "ints":
+        lengths = [len(value or []) for value in values]
+        data = np.fromiter(
+            (x for value in values for x in value or []), dtype=np.int32, count=sum(lengths)
+        )
+    else:
+        encoded = [
+            b"" if value is None else (value if kind == "text" else json.dumps(value)).encode()
+            for value in values
+        ]
+        lengths = [len(e) for e in encoded]
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return {"data": data, "offsets": offsets, "null": null}
+
+
+def decode_column(kind: str, data: np.ndarray, offsets: np.ndarray, null: np.ndarray) -> list:
+    bounds = zip(offsets[:-1].tolist(), offsets[1:].tolist(), null.tolist())
+    if kind == "ints":
+        return [None if missing else data[a:b].tolist() for a, b, missing in bounds]
+    buffer = data.tobytes()
+    values = [None if missing else buffer[a:b].decode() for a, b, missing in bounds]
+    if kind == "json":
+        return [None if value is None else json.loads(value) for value in values]
+    return values
+
+
+def vector_matrix(vectors: list, ndim: int) -> tuple[np.ndarray, np.ndarray]:
+    """(rows, ndim) float32 matrix and null mask of vectors as PostgREST returns them."""
+    matrix = np.zeros((len(vectors), ndim), dtype=np.float32)
+    null = np.ones(len(vectors), dtype=bool)
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            continue
+        # pgvector columns come back as strings
+        matrix[i] = json.loads(vector) if isinstance(vector, str) else vector
+        null[i] = False
+    return matrix, null
+
+
+def write_part(
+    path: Path, table: str, columns: list[str], rows: list[dict], vectors: list, ndim: int
+) -> None:
+    """One npz file of `rows`, with `vectors` (one per row, None if missing) as a matrix."""
+    arrays = {}
+    for column in columns:
+        for key, array in encode_column(
+            TABLES[table][column], [row.get(column) for row in rows]
+        ).items():
+            arrays[f"{column}.{key}"] = array
+    arrays["vector.data"], arrays["vector.null"] = vector_matrix(vectors, ndim)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def read_parts(
+    directory: Path | str, table: str, manifest: SnapshotManifest | None = None
+) -> Iterator[tuple[list[dict], np.ndarray, np.ndarray]]:
+    """(rows, vectors, null vector mask) of each part of `table`, one part in memory at a time."""
+    directory = Path(directory)
+    manifest = manifest or SnapshotManifest.read(directory)
+    snapshot = manifest.tables[table]
+    for name in snapshot.parts:
+        with np.load(directory / name, allow_pickle=False) as part:
+            values = {
+                column: decode_column(
+                    TABLES[table][column],
+                    part[f"{column}.data"],
+                    part[f"{column}.offsets"],
+                    part[f"{column}.null"],
+                )
+                for column in snapshot.columns
+            }
+            vectors, null = part["vector.data"], part["vector.null"]
+        rows = [dict(zip(values, row)) for row in zip(*values.values())]
+        yield rows, vectors, null
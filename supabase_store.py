@@ -1,95 +1,893 @@
-from collections.abc import Sequence
+from collections import OrderedDict
+from collections.abc import Callable, Collection, Sequence
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import asyncio
 import json
-import re
+import logging
+import time
 
-from supabase._async.client import create_client as create_async_client
+from postgrest.exceptions import APIError
+from supabase._async.client import create_client as create_async_client, AsyncClient
 import numpy as np
 
 from paperqa.llms import (
     EmbeddingModel,
     EmbeddingModes,
     NumpyVectorStore,
+    VectorStore,
     cosine_similarity,
+    embedding_model_factory,
 )
 from paperqa.types import (
     Doc,
     Embeddable,
 )
 
-from utils import TextPlus
+from ann_index import ANN_BACKENDS, ANNIndex
+from chunk_store import ChunkStore
+from embedding_versions import LEGACY_VERSION, EmbeddingVersion, fetch_active_version
+from sharded_search import ShardedSearch
+from snapshot_format import SnapshotManifest, read_parts
+from tracing import record_embedding, span, traced
+from utils import (
+    ChunkFilter,
+    TextPlus,
+    docname_from_citation,
+    normalize_authors,
+    parse_timestamp,
+    unique_docname,
+)
+
+logger = logging.getLogger(__name__)
+
+
+DOCUMENT_COLUMNS = ["id", "docname", "citation", "authors", "published_at"]
+# added by migrations (see NOTES.md), read and written only once the table has them
+MIGRATED_COLUMNS = {("documents", "docname"), ("chunks", "page_starts")}
+# Postgres undefined_column, what PostgREST answers when a selected column doesn't exist
+UNDEFINED_COLUMN = "42703"
+# rows created this long before a refresh are read again, for clock skew between the API
+# and the database and for inserts that commit after a later one
+SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def uuid_ranges(partitions: int) -> list[tuple[str | None, str | None]]:
+    """Split the uuid space into `partitions` contiguous [lower, upper) ranges."""
+    bounds = [
+        f"{i * 16**8 // partitions:08x}-0000-0000-0000-000000000000"
+        for i in range(1, partitions)
+    ]
+    return list(zip([None, *bounds], [*bounds, None]))
 
 
 class SupabaseStore(NumpyVectorStore):
     supabase_url: str
     supabase_service_key: str
+    # load only ids, pages and embeddings, and fetch chunk text for the rows a search returns
+    lazy_text: bool = False
+    text_cache_size: int = 4096
+    # rows per page and pages in flight when loading the chunks table
+    page_size: int = 1000
+    load_concurrency: int = 4
+    load_partitions: int = 16
+    # threads used to score shards of the embedding matrix, defaults to the core count
+    search_workers: int | None = None
+    # load the digests made at upload with the chunks, see UploadDocs.chunk_digests
+    load_digests: bool = False
+    # approximate search, a key of ann_index.ANN_BACKENDS or None to always search exactly.
+    # The index is built in the background after a load, exact search serves until then
+    ann_backend: str | None = None
+    ann_params: dict = {}
+    # smaller stores, and filters allowing fewer rows, are searched exactly
+    ann_min_rows: int = 100_000
+    # the index is saved here after a build and loaded from here on the next load
+    ann_path: Path | None = None
+    _ann: ANNIndex | None = None
+    # the store _ann indexes, a reload replaces the store and the index with it
+    _ann_chunks: ChunkStore | None = None
+    _ann_build: asyncio.Task | None = None
+    # load from this snapshot (see snapshot.py) and fetch only the chunks created since it
+    # was exported, when it holds the active embedding version
+    snapshot_path: Path | None = None
+    # seconds between checks for a newly activated embedding version, and for chunks and
+    # documents other processes inserted or deleted, None to never check
+    version_check_interval: float | None = 60.0
+    _chunks: ChunkStore | None = None
+    _client: AsyncClient | None = None
+    _client_loop: asyncio.AbstractEventLoop | None = None
+    _load_lock: asyncio.Lock | None = None
+    _load_lock_loop: asyncio.AbstractEventLoop | None = None
+    _search_engine: ShardedSearch | None = None
+    _refreshed_at: float = 0.0
+    _refresh: asyncio.Task | None = None
+    # dockeys of deleted documents, tombstoned in every ANN index built since
+    _deleted_documents: set[str] = set()
+    # models of embedding versions other than the one in the query settings
+    _embedding_models: dict[str, EmbeddingModel] = {}
+    # (table, column) -> whether the deployment has it, see has_column
+    _columns: dict[tuple[str, str], bool] = {}
+    # chunk id -> text, least recently used first
+    _text_cache: OrderedDict = OrderedDict()
+    # recent query embeddings, so answer cache lookups and retrieval embed a question once
+    query_embedding_cache_size: int = 1024
+    # (model, query) -> embedding, least recently used first
+    _query_embeddings: OrderedDict = OrderedDict()
 
-    async def similarity_search(
-        self, query: str, k: int, embedding_model: EmbeddingModel
-    ) -> tuple[Sequence[Embeddable], list[float]]:
-        supabase = await create_async_client(self.supabase_url, self.supabase_service_key)
-        
-        if not self.texts: 
+    @property
+    def search_engine(self) -> ShardedSearch:
+        if self._search_engine is None:
+            self._search_engine = ShardedSearch(workers=self.search_workers)
+        return self._search_engine
+
+    async def client(self) -> AsyncClient:
+        # clients hold connection pools bound to the event loop that created them,
+        # and the sync Docs wrappers run every call on a new loop
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = await create_async_client(self.supabase_url, self.supabase_service_key)
+            self._client_loop = loop
+        return self._client
+
+    async def has_column(self, table: str, column: str) -> bool:
+        """Whether the `table` has `column`, probed once, for columns added by migrations."""
+        if (table, column) not in self._columns:
+            supabase = await self.client()
+            try:
+                await supabase.table(table).select(column).limit(1).execute()
+            except APIError as e:
+                # anything else (timeouts, auth, outages) says nothing about the schema
+                if e.code != UNDEFINED_COLUMN:
+                    raise
+                logger.warning(
+                    f"{table}.{column} is missing, see NOTES.md for its migration: {e.message}"
+                )
+                self._columns[(table, column)] = False
+            else:
+                self._columns[(table, column)] = True
+        return self._columns[(table, column)]
+
+    async def select_columns(self, table: str, columns: list[str]) -> str:
+        """`columns` of `table` without the migrated ones it doesn't have yet."""
+        return ",".join(
+            [
+                column
+                for column in columns
+                if (table, column) not in MIGRATED_COLUMNS
+                or await self.has_column(table, column)
+            ]
+        )
+
+    @property
+    def chunks(self) -> ChunkStore:
+        if self._chunks is None:
+            self._chunks = ChunkStore()
+        return self._chunks
+
+    @property
+    def loaded(self) -> bool:
+        return self._chunks is not None
+
+    @property
+    def corpus_version(self) -> str:
+        """Changes whenever the searchable chunks change, for invalidating cached answers."""
+        return (
+            f"{self.chunks.embedding_version or LEGACY_VERSION}:{len(self.chunks)}"
+            f":{len(self._deleted_documents)}"
+        )
+
+    def clear(self) -> None:
+        super().clear()
+        self._chunks = None
+        self._text_cache = OrderedDict()
+
+    def add_texts_and_embeddings(
+        self, texts: Sequence[Embeddable], ids: Sequence[str] | None = None
+    ) -> None:
+        """Append `texts`, with the `ids` of their chunk rows when they are stored."""
+        VectorStore.add_texts_and_embeddings(self, texts)
+        texts = [TextPlus.from_text(t) if not isinstance(t, TextPlus) else t for t in texts]
+        if not texts:
+            return
+        start = len(self.chunks)
+        self.chunks.extend(
+            documents=[self.chunks.add_document(t.doc) for t in texts],
+            texts=[t.text for t in texts],
+            pages=[t.pages for t in texts],
+            embeddings=[t.embedding for t in texts],
+            ids=ids,
+            page_starts=[t.page_starts for t in texts],
+            digests=[t.digest for t in texts],
+        )
+        if (ann := self.ann) is not None:
+            rows = np.arange(start, len(self.chunks))
+            ann.add(rows, self.chunks.embeddings[rows])
+
+    def delete_documents(self, dockeys: Collection[str]) -> None:
+        """Record deleted documents and tombstone their rows in the approximate index.
+
+        Searches mask deleted documents with filters too, tombstones keep them out of
+        the candidates and out of the saved index.
+        """
+        dockeys = set(dockeys) - self._deleted_documents
+        if not dockeys:
+            return
+        self._deleted_documents = self._deleted_documents | set(dockeys)
+        if (ann := self.ann) is not None:
+            self._tombstone(ann, self.chunks, dockeys)
+
+    @staticmethod
+    def _tombstone(ann: ANNIndex, chunks: ChunkStore, dockeys: Collection[str]) -> None:
+        documents = [
+            chunks.document_index[dockey] for dockey in dockeys if dockey in chunks.document_index
+        ]
+        ann.delete(np.flatnonzero(np.isin(chunks.row_documents[: len(chunks)], documents)))
+
+    @property
+    def ann(self) -> ANNIndex | None:
+        """The approximate index of the loaded rows, None until one is built."""
+        if self._chunks is None or self._ann_chunks is not self._chunks:
+            return None
+        return self._ann
+
+    def _ann_file(self, chunks: ChunkStore) -> Path:
+        version = chunks.embedding_version or LEGACY_VERSION
+        return self.ann_path / f"{version}.{self.ann_backend}.npz"
+
+    def _build_ann(self, chunks: ChunkStore) -> ANNIndex:
+        """The saved index mapped onto `chunks`, or a newly trained one, on a worker thread."""
+        index = None
+        new = ANN_BACKENDS[self.ann_backend](**self.ann_params)
+        if self.ann_path is not None and (path := self._ann_file(chunks)).exists():
+            try:
+                index, meta = ANNIndex.load(path, chunks)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Could not load the ANN index at {path}: {e!r}")
+            else:
+                if meta["params"] != new.params or meta["ndim"] != chunks.ndim:
+                    logger.info(f"Rebuilding the ANN index at {path}, its parameters changed.")
+                    index = None
+        if index is None:
+            index = new
+            index.train(chunks.matrix)
+            index.add_missing(chunks)
+            logger.info(f"Built an ANN index of {len(index)} chunks.")
+        elif added := index.add_missing(chunks):
+            logger.info(f"Loaded the ANN index, {added} chunks were added since it was saved.")
+        if self.ann_path is not None and (index is new or added):
+            index.save(self._ann_file(chunks), chunks)
+        return index
+
+    async def _load_ann(self, chunks: ChunkStore) -> None:
+        try:
+            with span("ann.build", rows=len(chunks)):
+                index = await asyncio.to_thread(self._build_ann, chunks)
+            # rows uploaded and documents deleted during the build
+            index.add_missing(chunks)
+            self._tombstone(index, chunks, self._deleted_documents)
+        except Exception as e:
+            # searches stay exact until the next load
+            logger.warning(f"Building the ANN index failed: {e!r}")
+            index = None
+        self._ann, self._ann_chunks = index, chunks
+
+    def _maybe_build_ann(self) -> None:
+        chunks = self._chunks
+        if (
+            self.ann_backend is None
+            or chunks is None
+            or len(chunks) < self.ann_min_rows
+            or self._ann_chunks is chunks
+        ):
+            return
+        # a build on another loop, e.g. of a sync wrapper, was dropped with it
+        if (
+            self._ann_build is not None
+            and not self._ann_build.done()
+            and self._ann_build.get_loop() is asyncio.get_running_loop()
+        ):
+            return
+        self._ann_build = asyncio.ensure_future(self._load_ann(chunks))
+
+    def _add_documents(self, chunks: ChunkStore, rows: list[dict]) -> None:
+        """Register documents once, with their stored docname or one derived from the citation.
+
+        Stored docnames are unique across the corpus, names derived for older rows are
+        suffixed so they don't collide with them.
+        """
+        for row in sorted(rows, key=lambda r: r.get("docname") is None):
+            chunks.stored_documents.add(row.get("id"))
+            if row.get("id") in chunks.document_index:
+                continue
+            citation = row.get("citation")
+            docname = row.get("docname") or unique_docname(
+                docname_from_citation(citation), chunks.docnames
+            )
+            chunks.add_document(
+                Doc(dockey=row.get("id"), citation=citation, docname=docname),
+                authors=normalize_authors(row.get("authors")),
+                published_at=parse_timestamp(row.get("published_at")),
+            )
+
+    async def _add_missing_documents(self, chunks: ChunkStore, rows: list[dict]) -> None:
+        # documents uploaded after the documents table was read
+        missing = {
+            chunk.get("document")
+            for chunk in rows
+            if chunk.get("document") not in chunks.document_index
+        }
+        if missing:
+            supabase = await self.client()
             response = (
-                await supabase.table("chunks")
-                .select("document(id,citation),pages,text,text_emb")
-                # .eq("document", "02d7b71c-fece-582f-ac84-d976360b6292")
+                await supabase.table("documents")
+                .select(await self.select_columns("documents", DOCUMENT_COLUMNS))
+                .in_("id", list(missing))
                 .execute()
             )
-            self.texts = []
-            for chunk in response.data:
-                docname = None
-                dockey = chunk.get("document").get("id")
-                citation = chunk.get("document").get("citation")
-                if docname is None:
-                    # get first name and year from citation
-                    match = re.search(r"([A-Z][a-z]+)", citation)
-                    if match is not None:
-                        author = match.group(1)
-                    else:
-                        # panicking - no word??
-                        raise ValueError(
-                            f"Could not parse docname from citation {citation}. "
-                            "Consider just passing key explicitly - e.g. docs.py "
-                            "(path, citation, key='mykey')"
+            self._add_documents(chunks, response.data)
+
+    async def _append_page(
+        self,
+        chunks: ChunkStore,
+        rows: list[dict],
+        embeddings: dict[str, str] | None = None,
+    ) -> None:
+        if embeddings is None:
+            embeddings = {chunk.get("id"): chunk.get("text_emb") for chunk in rows}
+        # chunks without a vector in the loaded version can't be searched
+        rows = [chunk for chunk in rows if embeddings.get(chunk.get("id")) is not None]
+        if not rows:
+            return
+        # decoding the vectors is most of the work of a load, it would hold up queries
+        vectors = await asyncio.to_thread(
+            lambda: [json.loads(embeddings[chunk.get("id")]) for chunk in rows]
+        )
+        chunks.extend(
+            documents=[chunks.document_index[chunk.get("document")] for chunk in rows],
+            texts=[chunk.get("text") for chunk in rows],
+            pages=[chunk.get("pages") or [] for chunk in rows],
+            embeddings=vectors,
+            ids=[chunk.get("id") for chunk in rows],
+            page_starts=[chunk.get("page_starts") for chunk in rows],
+            digests=[chunk.get("digest") for chunk in rows],
+        )
+
+    async def _fetch_page(
+        self,
+        table: str,
+        columns: str,
+        lower: str | None = None,
+        upper: str | None = None,
+        after: str | None = None,
+    ) -> list[dict]:
+        """One keyset page of `table` ordered by id, within [lower, upper) and after `after`."""
+        supabase = await self.client()
+        request = supabase.table(table).select(columns)
+        if lower is not None:
+            request = request.gte("id", lower)
+        if upper is not None:
+            request = request.lt("id", upper)
+        if after is not None:
+            request = request.gt("id", after)
+        response = await request.order("id").limit(self.page_size).execute()
+        return response.data
+
+    async def _fetch_all(self, table: str, columns: str) -> list[dict]:
+        rows: list[dict] = []
+        after = None
+        # keep going until an empty page, PostgREST may cap pages below page_size
+        while page := await self._fetch_page(table, columns, after=after):
+            rows.extend(page)
+            after = page[-1].get("id")
+        return rows
+
+    async def _fetch_version_embeddings(
+        self, version: str, first: str, last: str
+    ) -> dict[str, str]:
+        """Vectors of `version` for the chunk ids in [first, last]."""
+        supabase = await self.client()
+        embeddings = {}
+        after = None
+        while True:
+            request = (
+                supabase.table("chunk_embeddings")
+                .select("chunk,embedding")
+                .eq("version", version)
+                .gte("chunk", first)
+                .lte("chunk", last)
+            )
+            if after is not None:
+                request = request.gt("chunk", after)
+            page = (await request.order("chunk").limit(self.page_size).execute()).data
+            # a short page isn't the last one when the server caps the page size
+            if not page:
+                return embeddings
+            embeddings.update({row.get("chunk"): row.get("embedding") for row in page})
+            after = page[-1].get("chunk")
+
+    async def load_texts(
+        self, progress_callback: Callable[[int, int], None] | None = None
+    ) -> None:
+        """Stream the chunks table into a new ChunkStore.
+
+        The id space is split into `load_partitions` ranges that are each read with
+        keyset pagination, with at most `load_concurrency` pages in flight. Pages are
+        appended to the store as they arrive, so memory stays bounded by the index
+        itself plus `load_concurrency` pages of JSON.
+        """
+        supabase = await self.client()
+        version = await fetch_active_version(supabase)
+        self._refreshed_at = time.monotonic()
+        synced_at = datetime.now(timezone.utc)
+
+        # the exact count comes back in Content-Range, one row is enough to get it
+        total = (
+            await supabase.table("chunks").select("id", count="exact").limit(1).execute()
+        ).count or 0
+        columns = await self._chunk_columns(version)
+
+        chunks = ChunkStore(capacity=total)
+        chunks.synced_at = synced_at
+        if version is not None:
+            chunks.embedding_version = version.version
+            chunks.embedding_model = version.model
+        semaphore = asyncio.Semaphore(self.load_concurrency)
+
+        async def load_range(lower: str | None, upper: str | None) -> None:
+            after = None
+            while True:
+                async with semaphore:
+                    page = await self._fetch_page("chunks", columns, lower, upper, after)
+                if not page:
+                    return
+                embeddings = None
+                if version is not None:
+                    async with semaphore:
+                        embeddings = await self._fetch_version_embeddings(
+                            version.version, page[0].get("id"), page[-1].get("id")
                         )
-                    year = ""
-                    match = re.search(r"(\d{4})", citation)
-                    if match is not None:
-                        year = match.group(1)
-                    docname = f"{author}{year}"
-                pages = chunk.get('pages')
-                pages_str = " pages " + f"{pages[0]}-{pages[-1]}"
-                self.texts.append(
-                    TextPlus(
-                        text=chunk.get("text"),
-                        name=docname + pages_str,
-                        doc=Doc(dockey=dockey, citation=citation, docname=docname),
-                        pages=chunk.get("pages"),
-                        embedding=json.loads(chunk.get("text_emb")),
-                    )
+                await self._add_missing_documents(chunks, page)
+                await self._append_page(chunks, page, embeddings)
+                after = page[-1].get("id")
+                if progress_callback is not None:
+                    progress_callback(len(chunks), total)
+
+        manifest = self._snapshot_manifest(version)
+        if manifest is not None:
+            with span("index.snapshot"):
+                await self._load_snapshot(chunks, manifest, progress_callback, total)
+            added = await self._load_created_since(
+                chunks, columns, version, manifest.exported_at
+            )
+            logger.info(f"Loaded {added} chunks created since the snapshot.")
+        else:
+            self._add_documents(
+                chunks,
+                await self._fetch_all(
+                    "documents", await self.select_columns("documents", DOCUMENT_COLUMNS)
+                ),
+            )
+            await asyncio.gather(
+                *[load_range(lower, upper) for lower, upper in uuid_ranges(self.load_partitions)]
+            )
+        if len(chunks) != total:
+            logger.warning(
+                f"Loaded {len(chunks)} chunks but the table reported {total},"
+                " it may have changed during the load."
+            )
+        logger.info(
+            f"Loaded {len(chunks)} chunks from {len(chunks.documents)} documents"
+            f" with {version.version if version else LEGACY_VERSION} embeddings."
+        )
+        # swapped in whole, searches see either the old vectors or the new ones
+        self._chunks = chunks
+
+    async def _chunk_columns(self, version: EmbeddingVersion | None) -> str:
+        # document metadata is read once, chunk rows only carry the dockey
+        chunk_columns = ["id", "document", "pages", "page_starts"]
+        if not self.lazy_text:
+            chunk_columns.append("text")
+        columns = await self.select_columns("chunks", chunk_columns)
+        # legacy vectors are in the chunks table, versioned ones in chunk_embeddings
+        if version is None:
+            columns += ",text_emb"
+        if self.load_digests:
+            columns += ",digest"
+        return columns
+
+    def _snapshot_manifest(self, version: EmbeddingVersion | None) -> SnapshotManifest | None:
+        if self.snapshot_path is None:
+            return None
+        try:
+            manifest = SnapshotManifest.read(self.snapshot_path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the snapshot at {self.snapshot_path}: {e!r}")
+            return None
+        active = version.version if version else LEGACY_VERSION
+        if manifest.embedding_version != active:
+            logger.warning(
+                f"The snapshot at {self.snapshot_path} has {manifest.embedding_version}"
+                f" embeddings but {active} is active, loading from the database."
+            )
+            return None
+        return manifest
+
+    async def _load_snapshot(
+        self,
+        chunks: ChunkStore,
+        manifest: SnapshotManifest,
+        progress_callback: Callable[[int, int], None] | None = None,
+        total: int = 0,
+    ) -> None:
+        """Append the snapshot's rows to `chunks`, parts are decoded on a worker thread."""
+        for table in ("documents", "chunks"):
+            parts = read_parts(self.snapshot_path, table, manifest)
+            while part := await asyncio.to_thread(next, parts, None):
+                rows, vectors, null = part
+                if table == "documents":
+                    self._add_documents(chunks, rows)
+                    continue
+                # chunks without a vector in the exported version can't be searched
+                rows = [row for row, missing in zip(rows, null.tolist()) if not missing]
+                await self._add_missing_documents(chunks, rows)
+                chunks.extend(
+                    documents=[chunks.document_index[row["document"]] for row in rows],
+                    texts=[None if self.lazy_text else row.get("text") for row in rows],
+                    pages=[row.get("pages") or [] for row in rows],
+                    embeddings=vectors[~null],
+                    ids=[row["id"] for row in rows],
+                    page_starts=[row.get("page_starts") for row in rows],
+                    digests=[row.get("digest") if self.load_digests else None for row in rows],
                 )
-        self._embeddings_matrix = np.array([t.embedding for t in self.texts])
+                if progress_callback is not None:
+                    progress_callback(len(chunks), total)
 
-        k = min(k, len(self.texts))
-        if k == 0:
-            return [], []
+    async def _fetch_created_since(
+        self, table: str, columns: str, since: datetime
+    ) -> list[dict]:
+        """Rows of `table` created since `since`, with keyset pagination on id."""
+        supabase = await self.client()
+        rows: list[dict] = []
+        after = None
+        while True:
+            request = supabase.table(table).select(columns).gte("created_at", since.isoformat())
+            if after is not None:
+                request = request.gt("id", after)
+            page = (await request.order("id").limit(self.page_size).execute()).data
+            if not page:
+                return rows
+            rows.extend(page)
+            after = page[-1].get("id")
+
+    async def _load_created_since(
+        self,
+        chunks: ChunkStore,
+        columns: str,
+        version: EmbeddingVersion | None,
+        since: datetime,
+    ) -> int:
+        """Append the chunks created since `since` that `chunks` doesn't have yet.
+
+        Documents created since are registered too, returns the number of chunks added.
+        """
+        supabase = await self.client()
+        self._add_documents(
+            chunks,
+            await self._fetch_created_since(
+                "documents", await self.select_columns("documents", DOCUMENT_COLUMNS), since
+            ),
+        )
+        rows = await self._fetch_created_since("chunks", columns, since)
+        if rows:
+            # `since` is before the rows `chunks` was last synced with, some are loaded already
+            known = {chunk.get("id") for chunk in rows}.intersection(chunks.ids)
+            rows = [chunk for chunk in rows if chunk.get("id") not in known]
+        for start in range(0, len(rows), self.page_size):
+            page = rows[start : start + self.page_size]
+            embeddings = None
+            if version is not None:
+                embeddings = {}
+                # by id, the page's id range spans the whole table
+                for i in range(0, len(page), 100):
+                    response = (
+                        await supabase.table("chunk_embeddings")
+                        .select("chunk,embedding")
+                        .eq("version", version.version)
+                        .in_("chunk", [chunk.get("id") for chunk in page[i : i + 100]])
+                        .execute()
+                    )
+                    embeddings.update(
+                        {row.get("chunk"): row.get("embedding") for row in response.data}
+                    )
+            await self._add_missing_documents(chunks, page)
+            await self._append_page(chunks, page, embeddings)
+        return len(rows)
+
+    async def _sync_deleted_documents(self, chunks: ChunkStore) -> None:
+        """Delete the documents of `chunks` that were deleted from the documents table.
+
+        Only the table's row count is read, unless it has fewer rows than `chunks` knows of.
+        """
+        supabase = await self.client()
+        total = (
+            await supabase.table("documents").select("id", count="exact").limit(1).execute()
+        ).count or 0
+        if total >= len(chunks.stored_documents):
+            return
+        stored = {row.get("id") for row in await self._fetch_all("documents", "id")}
+        deleted = chunks.stored_documents - stored
+        chunks.stored_documents -= deleted
+        if deleted:
+            logger.info(f"{len(deleted)} documents were deleted from the documents table.")
+            self.delete_documents(deleted)
+
+    async def refresh(self) -> None:
+        """Catch up with the tables, which other processes, e.g. jobs.py workers, write to.
+
+        A newly activated embedding version is loaded whole, the old index keeps serving
+        queries until then. Otherwise chunks created since the last refresh are appended
+        and documents deleted since are masked.
+        """
+        supabase = await self.client()
+        version = await fetch_active_version(supabase)
+        chunks = self.chunks
+        loaded = chunks.embedding_version
+        if (version.version if version else None) != loaded:
+            logger.info(
+                f"Embedding version changed from {loaded or LEGACY_VERSION} to"
+                f" {version.version if version else LEGACY_VERSION}, reloading."
+            )
+            await self.load_texts()
+            return
+        if chunks.synced_at is None:
+            # filled in-process, not loaded from the tables
+            return
+        synced_at = datetime.now(timezone.utc)
+        added = await self._load_created_since(
+            chunks, await self._chunk_columns(version), version, chunks.synced_at - SYNC_OVERLAP
+        )
+        chunks.synced_at = synced_at
+        if added:
+            logger.info(f"Loaded {added} chunks created since the last refresh.")
+            if (ann := self.ann) is not None:
+                ann.add_missing(chunks)
+                self._tombstone(ann, chunks, self._deleted_documents)
+        await self._sync_deleted_documents(chunks)
+
+    def _maybe_refresh(self) -> None:
+        if (
+            self.version_check_interval is None
+            or time.monotonic() - self._refreshed_at < self.version_check_interval
+            or (self._refresh is not None and not self._refresh.done())
+        ):
+            return
+        self._refreshed_at = time.monotonic()
+        self._refresh = asyncio.ensure_future(self.refresh())
+        self._refresh.add_done_callback(self._refresh_done)
+
+    @staticmethod
+    def _refresh_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Refreshing the index failed: {task.exception()!r}")
+
+    def query_embedding_model(self, embedding_model: EmbeddingModel) -> EmbeddingModel:
+        """The model matching the loaded vectors, queries must be embedded with it."""
+        name = self.chunks.embedding_model
+        if name is None or name == embedding_model.name:
+            return embedding_model
+        if name not in self._embedding_models:
+            self._embedding_models[name] = embedding_model_factory(name)
+        return self._embedding_models[name]
+
+    async def ensure_loaded(self) -> None:
+        if self.loaded:
+            self._maybe_refresh()
+            self._maybe_build_ann()
+            return
+        if self._load_lock is None or self._load_lock_loop is not asyncio.get_running_loop():
+            self._load_lock = asyncio.Lock()
+            self._load_lock_loop = asyncio.get_running_loop()
+        # concurrent cold queries share a single load
+        async with self._load_lock:
+            if not self.loaded:
+                with span("index.load"):
+                    await self.load_texts()
+        self._maybe_build_ann()
+
+    async def fetch_texts(self, ids: Sequence[str]) -> dict[str, str]:
+        """Chunk texts by id, from the LRU cache or with a single `in` query for the rest."""
+        texts = {}
+        missing = []
+        for chunk_id in ids:
+            if chunk_id in self._text_cache:
+                self._text_cache.move_to_end(chunk_id)
+                texts[chunk_id] = self._text_cache[chunk_id]
+            else:
+                missing.append(chunk_id)
+        if missing:
+            supabase = await self.client()
+            response = (
+                await supabase.table("chunks")
+                .select("id,text")
+                .in_("id", missing)
+                .execute()
+            )
+            for chunk in response.data:
+                texts[chunk.get("id")] = chunk.get("text")
+                self._text_cache[chunk.get("id")] = chunk.get("text")
+            while len(self._text_cache) > self.text_cache_size:
+                self._text_cache.popitem(last=False)
+        return texts
 
+    async def embed_query(self, query: str, embedding_model: EmbeddingModel) -> np.ndarray:
+        return (await self.embed_queries([query], embedding_model))[0]
+
+    async def embed_queries(
+        self, queries: Sequence[str], embedding_model: EmbeddingModel
+    ) -> np.ndarray:
+        """Embed all `queries` in a single call, one row per query."""
+        await self.ensure_loaded()
+        embedding_model = self.query_embedding_model(embedding_model)
         # this will only affect models that embedding prompts
         embedding_model.set_mode(EmbeddingModes.QUERY)
 
-        np_query = np.array((await embedding_model.embed_documents([query]))[0])
+        cached = {
+            query: self._query_embeddings[key]
+            for query in queries
+            if (key := (embedding_model.name, query)) in self._query_embeddings
+        }
+        missing = list(dict.fromkeys(q for q in queries if q not in cached))
+        if missing:
+            with span("embed_query", count=len(missing)):
+                embeddings = await embedding_model.embed_documents(missing)
+            record_embedding(embedding_model.name, missing)
+            for query, embedding in zip(missing, embeddings, strict=True):
+                cached[query] = self._query_embeddings[(embedding_model.name, query)] = (
+                    np.asarray(embedding)
+                )
+        for query in cached:
+            self._query_embeddings.move_to_end((embedding_model.name, query))
+        while len(self._query_embeddings) > self.query_embedding_cache_size:
+            self._query_embeddings.popitem(last=False)
 
         embedding_model.set_mode(EmbeddingModes.DOCUMENT)
+        return np.array([cached[query] for query in queries])
 
-        similarity_scores = cosine_similarity(
-            np_query.reshape(1, -1), self._embeddings_matrix
-        )[0]
-        similarity_scores = np.nan_to_num(similarity_scores, nan=-np.inf)
-        # minus so descending
-        # we could use arg-partition here
-        # but a lot of algorithms expect a sorted list
-        sorted_indices = np.argsort(-similarity_scores)
-        return (
-            [self.texts[i] for i in sorted_indices[:k]],
-            [similarity_scores[i] for i in sorted_indices[:k]],
+    def _without_deleted(self, filters: ChunkFilter | None) -> ChunkFilter | None:
+        # deleted documents keep their rows until the next load
+        if not self._deleted_documents:
+            return filters
+        return (filters or ChunkFilter()).excluding(dockeys=self._deleted_documents)
+
+    async def search_batch(
+        self, queries: np.ndarray, k: int, rows: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k of `rows` for each query, approximate once the ANN index is built."""
+        ann = self.ann
+        if ann is None or (rows is not None and len(rows) < self.ann_min_rows):
+            return await self.search_engine.search_batch(self.chunks, queries, k, rows)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.search_engine.executor, ann.search, self.chunks, queries, k, rows
+        )
+
+    async def search_rows(
+        self, np_query: np.ndarray, k: int, filters: ChunkFilter | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        await self.ensure_loaded()
+        with span("search", k=k):
+            rows = self.chunks.filter_rows(self._without_deleted(filters))
+            top, scores = await self.search_batch(np_query, k, rows)
+            return top[0], scores[0]
+
+    @traced("materialize")
+    async def materialize(self, rows: Sequence[int]) -> list[TextPlus]:
+        lazy_rows = [row for row in rows if not self.chunks.text_loaded[row]]
+        texts = (
+            await self.fetch_texts([self.chunks.ids[row] for row in lazy_rows])
+            if lazy_rows
+            else {}
         )
+        return [
+            self.chunks.materialize(row, text=texts.get(self.chunks.ids[row]))
+            for row in rows
+        ]
+
+    @traced("similarity_search")
+    async def similarity_search(
+        self,
+        query: str,
+        k: int,
+        embedding_model: EmbeddingModel,
+        filters: ChunkFilter | None = None,
+    ) -> tuple[Sequence[Embeddable], list[float]]:
+        await self.ensure_loaded()
+        if k == 0 or len(self.chunks) == 0:
+            return [], []
+
+        np_query = await self.embed_query(query, embedding_model)
+        rows, scores = await self.search_rows(np_query, k, filters)
+        return await self.materialize(rows), scores.tolist()
+
+    @traced("similarity_search")
+    async def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int,
+        fetch_k: int,
+        embedding_model: EmbeddingModel,
+        filters: ChunkFilter | None = None,
+    ) -> tuple[Sequence[Embeddable], list[float]]:
+        """Same as VectorStore.max_marginal_relevance_search, with `filters` applied in the search.
+
+        Selection runs on row indices, so `TextPlus` objects are only built for the winners.
+        """
+        if fetch_k < k:
+            raise ValueError("fetch_k must be greater or equal to k")
+        await self.ensure_loaded()
+        if k == 0 or len(self.chunks) == 0:
+            return [], []
+
+        np_query = await self.embed_query(query, embedding_model)
+        rows, scores = await self.search_rows(np_query, fetch_k, filters)
+        if len(rows) > k and self.mmr_lambda < 1.0:
+            with span("mmr"):
+                rows, scores = self.mmr_rows(rows, scores, k)
+        return await self.materialize(rows), scores.tolist()
+
+    @traced("similarity_search")
+    async def max_marginal_relevance_search_batch(
+        self,
+        queries: Sequence[str],
+        k: int,
+        fetch_k: int,
+        embedding_model: EmbeddingModel,
+        filters: ChunkFilter | None = None,
+    ) -> list[tuple[list[TextPlus], list[float]]]:
+        """`max_marginal_relevance_search` for many queries at once.
+
+        Queries are embedded in one call and scored in one matrix product. Rows picked
+        for several queries are materialized once and shared between their results.
+        """
+        if fetch_k < k:
+            raise ValueError("fetch_k must be greater or equal to k")
+        await self.ensure_loaded()
+        if k == 0 or len(self.chunks) == 0 or not queries:
+            return [([], []) for _ in queries]
+
+        np_queries = await self.embed_queries(queries, embedding_model)
+        with span("search", k=fetch_k, count=len(queries)):
+            rows = self.chunks.filter_rows(self._without_deleted(filters))
+            batch_rows, batch_scores = await self.search_batch(np_queries, fetch_k, rows)
+        selected = []
+        for rows, scores in zip(batch_rows, batch_scores, strict=True):
+            if len(rows) > k and self.mmr_lambda < 1.0:
+                with span("mmr"):
+                    rows, scores = self.mmr_rows(rows, scores, k)
+            selected.append((rows, scores))
+
+        unique_rows = sorted({int(row) for rows, _ in selected for row in rows})
+        texts = dict(zip(unique_rows, await self.materialize(unique_rows), strict=True))
+        return [
+            ([texts[int(row)] for row in rows], scores.tolist()) for rows, scores in selected
+        ]
+
+    def mmr_rows(
+        self, rows: np.ndarray, scores: np.ndarray, k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        embeddings = self.chunks.matrix[rows]
+        similarity_matrix = cosine_similarity(embeddings, embeddings)
+
+        selected_indices = [0]
+        while len(selected_indices) < k:
+            selected_similarities = similarity_matrix[:, selected_indices]
+            max_sim_to_selected = selected_similarities.max(axis=1)
+
+            mmr_scores = (
+                self.mmr_lambda * scores
+                - (1 - self.mmr_lambda) * max_sim_to_selected
+            )
+            mmr_scores[selected_indices] = -np.inf  # Exclude already selected documents
+            selected_indices.append(int(mmr_scores.argmax()))
+
+        return rows[selected_indices], scores[selected_indices]
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionControl, Overloaded
+
+
+def test_rejects_when_the_queue_is_full():
+    admission = AdmissionControl(max_in_flight=1, max_queued=1, queue_timeout=5.0)
+    release = asyncio.Event()
+
+    async def request():
+        async with admission.admit():
+            await release.wait()
+
+    async def run():
+        running = asyncio.create_task(request())
+        queued = asyncio.create_task(request())
+        await asyncio.sleep(0.01)
+        assert (admission.in_flight, admission.queued) == (1, 1)
+
+        with pytest.raises(Overloaded, match="queue is full"):
+            await request()
+
+        release.set()
+        await asyncio.gather(running, queued)
+        assert (admission.in_flight, admission.queued, admission.rejected) == (0, 0, 1)
+
+    asyncio.run(run())
+
+
+def test_rejects_after_waiting_too_long():
+    admission = AdmissionControl(max_in_flight=1, max_queued=4, queue_timeout=0.05)
+
+    async def run():
+        async with admission.admit():
+            with pytest.raises(Overloaded, match="queued for over"):
+                async with admission.admit():
+                    pass
+        # the slot is free again
+        async with admission.admit():
+            assert admission.in_flight == 1
+
+    asyncio.run(run())
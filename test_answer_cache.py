@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+
+from answer_cache import AnswerCache
+
+EMBEDDING = np.array([1.0, 0.0, 0.0])
+SIMILAR = np.array([1.0, 0.1, 0.0])
+DIFFERENT = np.array([0.0, 1.0, 0.0])
+
+
+def test_repeats_and_similar_questions_hit():
+    cache = AnswerCache(threshold=0.95)
+    cache.put("settings", "What is KRAS?", "v1", "answer", EMBEDDING)
+
+    answer, cached = cache.get("settings", "what is kras", "v1")
+    assert (answer, cached.similarity, cached.question) == ("answer", 1.0, "what is kras")
+
+    answer, cached = cache.get("settings", "Explain KRAS", "v1", SIMILAR)
+    assert answer == "answer"
+    assert 0.95 <= cached.similarity < 1.0
+
+    assert cache.get("settings", "What is BRAF?", "v1", DIFFERENT) is None
+    # other settings or filters are another partition
+    assert cache.get("other settings", "Explain KRAS", "v1", SIMILAR) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_exact_matches_only_without_threshold():
+    cache = AnswerCache(threshold=None)
+    cache.put("settings", "What is KRAS?", "v1", "answer", EMBEDDING)
+    assert cache.get("settings", "Explain KRAS", "v1", EMBEDDING) is None
+    assert cache.get("settings", "what is KRAS", "v1", EMBEDDING) is not None
+
+
+def test_new_corpus_versions_and_age_invalidate():
+    cache = AnswerCache(ttl=0.05)
+    cache.put("settings", "What is KRAS?", "v1", "answer", EMBEDDING)
+    assert cache.get("settings", "What is KRAS?", "v2") is None
+    assert cache.stats()["entries"] == 0
+
+    cache.put("settings", "What is KRAS?", "v2", "answer", EMBEDDING)
+    time.sleep(0.06)
+    assert cache.get("settings", "What is KRAS?", "v2") is None
+    assert cache.invalidated == 2
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = AnswerCache(max_entries=2)
+    for question in ("first", "second"):
+        cache.put("settings", question, "v1", question)
+    cache.get("settings", "first", "v1")
+    cache.put("settings", "third", "v1", "third")
+    assert [question for _, question in cache.entries] == ["first", "third"]
@@ -0,0 +1,82 @@
+from datetime import datetime, timezone
+
+import numpy as np
+from paperqa.types import Doc
+
+from chunk_store import ChunkStore
+from utils import ChunkFilter, normalize_authors
+
+DOCUMENTS = [
+    ("dockey-0", ["William Smith"], 2001),
+    ("dockey-1", ["Li, Wei", "Jane Doe"], 2010),
+    ("dockey-2", ["Olivia Wang"], 2020),
+    ("dockey-3", [], None),
+]
+
+
+def make_store(chunks_per_document: int = 3) -> ChunkStore:
+    store = ChunkStore()
+    for dockey, authors, year in DOCUMENTS:
+        index = store.add_document(
+            Doc(docname=dockey, citation=dockey, dockey=dockey),
+            authors=normalize_authors(authors),
+            published_at=datetime(year, 6, 1, tzinfo=timezone.utc) if year else None,
+        )
+        store.extend(
+            documents=[index] * chunks_per_document,
+            texts=[f"text {c} of {dockey}" for c in range(chunks_per_document)],
+            pages=[[c + 1] for c in range(chunks_per_document)],
+            embeddings=np.eye(chunks_per_document, 4),
+        )
+    return store
+
+
+def documents(store: ChunkStore, filters: ChunkFilter) -> set[str]:
+    rows = store.filter_rows(filters)
+    return {store.documents[d].dockey for d in store.row_documents[rows]}
+
+
+def test_no_filter_searches_every_row():
+    assert make_store().filter_rows(None) is None
+
+
+def test_authors_match_whole_words():
+    store = make_store()
+    assert documents(store, ChunkFilter(authors=["Li"])) == {"dockey-1"}
+    assert documents(store, ChunkFilter(authors=["wei li"])) == {"dockey-1"}
+    assert documents(store, ChunkFilter(authors=["J. Doe"])) == {"dockey-1"}
+    assert documents(store, ChunkFilter(authors=["Smith", "wang"])) == {"dockey-0", "dockey-2"}
+    # parts of words don't match
+    assert documents(store, ChunkFilter(authors=["Ng"])) == set()
+    assert documents(store, ChunkFilter(authors=["Will"])) == set()
+
+
+def test_published_range():
+    store = make_store()
+    filters = ChunkFilter(
+        published_after=datetime(2005, 1, 1, tzinfo=timezone.utc),
+        published_before=datetime(2015, 1, 1),
+    )
+    assert documents(store, filters) == {"dockey-1"}
+    # documents without a date never match a date range
+    assert "dockey-3" not in documents(
+        store, ChunkFilter(published_after=datetime(1900, 1, 1, tzinfo=timezone.utc))
+    )
+
+
+def test_dockeys_and_exclusions():
+    store = make_store()
+    filters = ChunkFilter(dockeys={"dockey-0", "dockey-1"}).excluding(dockeys={"dockey-0"})
+    assert documents(store, filters) == {"dockey-1"}
+
+    excluded = {"text 0 of dockey-2", "dockey-3 pages 2-2"}
+    rows = store.filter_rows(ChunkFilter().excluding(texts=excluded))
+    names = {store.name(row) for row in rows}
+    texts = {store.text(row) for row in rows}
+    assert len(rows) == 10
+    assert "text 0 of dockey-2" not in texts
+    assert "dockey-3 pages 2-2" not in names
+
+
+def test_empty_store():
+    assert len(ChunkStore().filter_rows(ChunkFilter(authors=["Smith"]))) == 0
@@ -0,0 +1,60 @@
+from paperqa.types import Context, Doc, Text
+
+from context_packing import dedup_quotes, pack_contexts
+
+DOC = Doc(docname="Doc", citation="Doc", dockey="dockey")
+QUOTE = "the treatment reduced mortality by a third in the first year of follow-up"
+
+
+def make_context(name: str, summary: str, quotes: list[str], score: int = 5) -> Context:
+    return Context(
+        context=summary,
+        text=Text(text=summary, name=name, doc=DOC),
+        score=score,
+        points=[{"point": "point", "quote": q} for q in quotes],
+    )
+
+
+def render(c: Context) -> str:
+    return c.context
+
+
+def test_quotes_repeated_by_lower_ranked_contexts_are_dropped():
+    first = make_context("Doc pages 1-1", "first", [QUOTE])
+    # the neighbouring chunk cuts the same sentence at its boundary
+    second = make_context(
+        "Doc pages 1-2", "second", [QUOTE.split(" in the")[0], "an unrelated quote about cost"]
+    )
+
+    (first_kept, second_kept), dropped = dedup_quotes([first, second])
+    assert dropped == 1
+    assert [p["quote"] for p in first_kept.points] == [QUOTE]
+    assert [p["quote"] for p in second_kept.points] == ["an unrelated quote about cost"]
+    # the contexts passed in are left alone
+    assert len(second.points) == 2
+
+
+def test_packing_skips_contexts_over_the_budget():
+    contexts = [
+        make_context("a", "a" * 400, [], score=9),
+        make_context("b", "b" * 400, ["quote b"], score=8),
+        make_context("c", "c" * 40, [], score=7),
+    ]
+    kept, rendered, report = pack_contexts(contexts, render, token_budget=120)
+    assert [c.text.name for c in kept] == ["a", "c"]
+    assert rendered == ["a" * 400, "c" * 40]
+    assert (report.contexts_kept, report.contexts_dropped) == (2, 1)
+    assert (report.tokens_used, report.tokens_dropped, report.quotes_dropped) == (110, 100, 1)
+
+
+def test_best_context_is_kept_over_budget():
+    kept, _, report = pack_contexts([make_context("a", "a" * 400, [])], render, token_budget=10)
+    assert len(kept) == 1
+    assert report.tokens_used == 100
+
+
+def test_no_budget_keeps_everything():
+    contexts = [make_context(str(i), "x" * 4000, []) for i in range(3)]
+    kept, _, report = pack_contexts(contexts, render)
+    assert len(kept) == 3
+    assert report.contexts_dropped == 0
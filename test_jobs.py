@@ -0,0 +1,81 @@
+import asyncio
+import time
+from pathlib import Path
+
+from jobs import JobQueue, run_worker
+from upload_docs import DocumentRejected
+
+
+def test_claims_highest_priority_first(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite")
+    low = queue.submit("low.pdf")
+    high = queue.submit("high.pdf", priority=5)
+
+    assert queue.claim("worker").id == high
+    job = queue.claim("worker")
+    assert (job.id, job.status, job.attempts, job.worker) == (low, "running", 1, "worker")
+    assert queue.claim("worker") is None
+
+
+def test_failed_jobs_are_retried_until_max_attempts(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite", max_attempts=2)
+    job_id = queue.submit_file("a.pdf", b"%PDF")
+    path = Path(queue.get(job_id).path)
+
+    queue.claim("worker")
+    queue.fail(job_id, "boom")
+    assert queue.get(job_id).status == "queued"
+    assert path.exists()
+
+    queue.claim("worker")
+    queue.fail(job_id, "boom")
+    job = queue.get(job_id)
+    assert (job.status, job.attempts, job.error) == ("failed", 2, "boom")
+    assert not path.exists()
+
+
+def test_jobs_of_lost_workers_are_requeued_then_failed(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite", max_attempts=2, stale_after=0.0)
+    job_id = queue.submit_file("a.pdf", b"%PDF")
+    path = Path(queue.get(job_id).path)
+
+    for attempt in (1, 2):
+        # the previous claim stopped heartbeating
+        time.sleep(0.01)
+        job = queue.claim("worker")
+        assert (job.id, job.attempts) == (job_id, attempt)
+
+    time.sleep(0.01)
+    assert queue.claim("worker") is None
+    job = queue.get(job_id)
+    assert (job.status, job.error) == ("failed", "worker lost while running the job")
+    assert not path.exists()
+
+
+def test_worker_runs_jobs_and_records_their_stage(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite", max_attempts=3)
+    done = queue.submit_file("done.pdf", b"%PDF")
+    rejected = queue.submit_file("rejected.pdf", b"%PDF")
+    stages = []
+
+    async def upload(job, progress_callback):
+        progress_callback("parse")
+        if job.path.endswith("rejected.pdf"):
+            raise DocumentRejected("duplicate")
+        # long enough for the worker loop to write the stage
+        await asyncio.sleep(0.05)
+        stages.append(queue.get(job.id).stage)
+
+    async def work():
+        task = asyncio.create_task(run_worker(queue, upload, poll_interval=0.01))
+        while queue.counts().get("running", 0) or queue.counts().get("queued", 0):
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(work())
+    assert stages == ["parse"]
+    assert (queue.get(done).status, queue.get(done).stage) == ("done", "done")
+    # rejected documents aren't retried
+    job = queue.get(rejected)
+    assert (job.status, job.attempts, job.error) == ("failed", 1, "duplicate")
+    assert not any((tmp_path / "files").iterdir())
@@ -0,0 +1,68 @@
+import pytest
+
+from latency_budget import DEFAULT_LATENCIES, plan_query, stage_latency
+from tracing import metrics
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def observe(retrieval: float, summary: float, answer: float) -> None:
+    metrics.observe_stage("retrieve_texts", retrieval)
+    metrics.observe_stage("evidence.summary", summary)
+    metrics.observe_stage("answer", answer)
+
+
+def test_recent_latency_is_exponentially_weighted():
+    assert metrics.recent_latency("answer") is None
+    assert stage_latency("answer") == DEFAULT_LATENCIES["answer"]
+
+    metrics.observe_stage("answer", 10.0)
+    assert metrics.recent_latency("answer") == 10.0
+    metrics.observe_stage("answer", 0.0)
+    assert metrics.recent_latency("answer") == pytest.approx(8.0)
+    metrics.observe_stage("answer", 5.0)
+    assert stage_latency("answer") == pytest.approx(7.4)
+
+
+def test_plan_query_modes():
+    observe(retrieval=0.5, summary=2.0, answer=3.0)
+
+    # 10 summaries in 2 waves of 5: 0.5 + 2 * 2 + 3
+    full = plan_query(budget=10.0, evidence_k=10, max_concurrent_requests=5)
+    assert (full.mode, full.evidence_k, full.estimated) == ("full", 10, pytest.approx(7.5))
+
+    reduced = plan_query(budget=6.0, evidence_k=10, max_concurrent_requests=5)
+    assert (reduced.mode, reduced.evidence_k) == ("reduced", 5)
+
+    assert plan_query(budget=4.0, evidence_k=10, max_concurrent_requests=5).mode == "skip_summary"
+    digest = plan_query(budget=4.0, evidence_k=10, max_concurrent_requests=5, digested=1.0)
+    assert (digest.mode, digest.estimated) == ("digest", pytest.approx(3.5))
+
+    cache_only = plan_query(budget=1.0, evidence_k=10, max_concurrent_requests=5)
+    assert (cache_only.mode, cache_only.evidence_k) == ("cache_only", 0)
+
+
+def test_plan_query_follows_recent_latency():
+    observe(retrieval=0.5, summary=2.0, answer=3.0)
+    assert plan_query(budget=8.0, evidence_k=10, max_concurrent_requests=5).mode == "full"
+
+    # summaries slow down until the full plan no longer fits
+    for _ in range(5):
+        metrics.observe_stage("evidence.summary", 4.0)
+    plan = plan_query(budget=8.0, evidence_k=10, max_concurrent_requests=5)
+    assert (plan.mode, plan.evidence_k) == ("reduced", 5)
+
+
+def test_digest_plan_counts_undigested_summaries():
+    observe(retrieval=0.5, summary=2.0, answer=3.0)
+
+    # one summary at a time, the least reduced plan takes 0.5 + 2 * 2 + 3
+    plan = plan_query(budget=6.0, evidence_k=10, max_concurrent_requests=1, digested=0.9)
+    assert (plan.mode, plan.evidence_k, plan.estimated) == ("digest", 10, pytest.approx(5.5))
+    plan = plan_query(budget=6.0, evidence_k=10, max_concurrent_requests=1, digested=0.8)
+    assert plan.mode == "skip_summary"
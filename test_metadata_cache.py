@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from paperqa.types import DocDetails
+
+from fakes import FakeMetadataProvider
+from metadata_cache import CachedMetadataClient, metadata_keys
+
+PAPERS = [
+    DocDetails(title=f"Paper number {i}", authors=["Jane Doe"], doi=f"10.1/p{i}", year=2020)
+    for i in range(3)
+]
+
+
+def make_client(tmp_path, provider, **kwargs) -> CachedMetadataClient:
+    return CachedMetadataClient(
+        tmp_path / "metadata.sqlite", clients=[provider], lookups_per_second=1000, **kwargs
+    )
+
+
+def test_hits_and_misses(tmp_path):
+    provider = FakeMetadataProvider(PAPERS)
+    client = make_client(tmp_path, provider)
+
+    async def lookups():
+        first = await client.query(title="Paper Number 1!")
+        # found by title, the DOI is cached too
+        by_doi = await client.query(doi="https://doi.org/10.1/P1")
+        missing = [await client.query(title="Nothing here") for _ in range(2)]
+        await client.close()
+        return first, by_doi, missing
+
+    first, by_doi, missing = asyncio.run(lookups())
+    assert first.doi == by_doi.doi == "10.1/p1"
+    assert missing == [None, None]
+    assert (provider.calls, client.hits, client.misses) == (2, 2, 2)
+
+    # persisted for other clients
+    other = make_client(tmp_path, provider)
+    assert asyncio.run(other.query(title="paper number 1")).doi == "10.1/p1"
+    assert provider.calls == 2
+
+
+def test_concurrent_lookups_are_made_once(tmp_path):
+    provider = FakeMetadataProvider(PAPERS, latency=0.05)
+    client = make_client(tmp_path, provider)
+
+    async def lookups():
+        results = await asyncio.gather(*[client.query(title="Paper number 2") for _ in range(5)])
+        await client.close()
+        return results
+
+    results = asyncio.run(lookups())
+    assert provider.calls == 1
+    assert {r.doi for r in results} == {"10.1/p2"}
+    # callers get their own copies
+    assert len({id(r) for r in results}) == 5
+
+
+def test_misses_expire(tmp_path):
+    provider = FakeMetadataProvider()
+    client = make_client(tmp_path, provider, negative_ttl=0.05)
+
+    async def lookup():
+        details = await client.query(title="Paper number 0")
+        await client.close()
+        return details
+
+    assert asyncio.run(lookup()) is None
+    assert asyncio.run(lookup()) is None
+    assert provider.calls == 1
+
+    provider.papers = PAPERS
+    time.sleep(0.1)
+    assert asyncio.run(lookup()).doi == "10.1/p0"
+    assert provider.calls == 2
+
+
+def test_keys_include_authors_and_fields():
+    assert metadata_keys(title="A Title") != metadata_keys(title="A Title", authors=["Jane Doe"])
+    assert metadata_keys(doi="10.1/x") != metadata_keys(doi="10.1/x", fields=["title"])
+    assert metadata_keys(doi="10.1/x", fields=["title", "doi"]) == metadata_keys(
+        doi="10.1/X", fields=["doi", "title"]
+    )
@@ -0,0 +1,96 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from embedding_versions import activate_version, fetch_active_version
+from fake_postgrest import FAKE_SERVICE_KEY, FakePostgREST
+from fakes import FakeEmbeddingModel, synthetic_corpus
+from migrate_embeddings import BACKFILLS, Throttle, backfill, catch_up, register_version
+from supabase_store import SupabaseStore
+
+EARLY_CHUNK = "00000000-0000-0000-0000-000000000001"
+
+
+class FailingEmbeddingModel(FakeEmbeddingModel):
+    """Fails after `fail_after` calls, like a backfill interrupted midway."""
+
+    fail_after: int = 1_000_000
+
+    async def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.calls >= self.fail_after:
+            raise RuntimeError("interrupted")
+        return await super().embed_documents(texts)
+
+
+def seed(fake: FakePostgREST) -> None:
+    for documents, chunks in synthetic_corpus(50, chunks_per_document=10, ndim=32):
+        fake.insert("documents", documents)
+        fake.insert("chunks", chunks)
+
+
+def make_store(fake: FakePostgREST) -> SupabaseStore:
+    return SupabaseStore(supabase_url=fake.url, supabase_service_key=FAKE_SERVICE_KEY)
+
+
+def test_interrupted_backfill_resumes_and_activates():
+    with FakePostgREST() as fake:
+        seed(fake)
+        model = FailingEmbeddingModel(name="fake-v2", ndim=16, fail_after=3)
+        throttle = Throttle(requests_per_minute=60_000)
+
+        async def run():
+            supabase = await make_store(fake).client()
+            version = await register_version(supabase, "v2", "fake-v2")
+            with pytest.raises(RuntimeError, match="interrupted"):
+                await backfill(supabase, version, model, throttle, batch_size=10)
+            with pytest.raises(ValueError, match="backfilling"):
+                await activate_version(supabase, "v2")
+
+            # a new run picks up the stored cursor
+            version = await register_version(supabase, "v2", "fake-v2")
+            assert version.chunk_cursor is not None
+            model.fail_after = 1_000_000
+            await backfill(supabase, version, model, throttle, batch_size=10)
+            await activate_version(supabase, "v2")
+            return await fetch_active_version(supabase)
+
+        active = asyncio.run(run())
+        assert (active.version, active.status, active.ndim) == ("v2", "complete", 16)
+        # 5 batches of chunks and 1 of documents, none embedded twice
+        assert model.calls == 6
+        embedded = Counter(row["chunk"] for row in fake.tables["chunk_embeddings"])
+        assert set(embedded) == {row["id"] for row in fake.tables["chunks"]}
+        assert set(embedded.values()) == {1}
+
+        store = make_store(fake)
+        asyncio.run(store.load_texts())
+        assert (store.chunks.embedding_version, store.chunks.ndim) == ("v2", 16)
+        assert len(store.chunks) == 50
+
+
+def test_catch_up_embeds_rows_created_behind_the_cursor():
+    with FakePostgREST() as fake:
+        seed(fake)
+        model = FakeEmbeddingModel(name="fake-v2", ndim=16)
+        throttle = Throttle(requests_per_minute=60_000)
+
+        async def run():
+            supabase = await make_store(fake).client()
+            version = await register_version(supabase, "v2", "fake-v2")
+            await backfill(supabase, version, model, throttle, batch_size=10)
+            # uploaded during the backfill, its id sorts before the chunk cursor
+            fake.insert(
+                "chunks",
+                [{"id": EARLY_CHUNK, "document": fake.tables["documents"][0]["id"], "text": "new"}],
+            )
+            table, text_column, target, foreign_key, _ = BACKFILLS[0]
+            await catch_up(
+                supabase, version, model, throttle, 10, table, text_column, target, foreign_key
+            )
+
+        asyncio.run(run())
+        embedded = Counter(row["chunk"] for row in fake.tables["chunk_embeddings"])
+        assert embedded[EARLY_CHUNK] == 1
+        assert len(embedded) == 51
+        assert set(embedded.values()) == {1}
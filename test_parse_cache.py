@@ -0,0 +1,51 @@
+import shutil
+
+from paperqa.readers import read_doc
+from paperqa.types import Doc
+
+import parse_cache
+from fakes import write_synthetic_documents
+from parse_cache import ParseCache
+
+DOC = Doc(docname="Doc", citation="Doc", dockey="dockey")
+
+
+def entries(cache: ParseCache) -> list:
+    return sorted(cache.directory.glob("*/*.json.gz"))
+
+
+def test_chunks_match_paperqa(tmp_path):
+    (path,) = write_synthetic_documents(tmp_path / "docs", 1)
+    cached = ParseCache(tmp_path / "cache").read_doc(path, DOC, chunk_chars=1000, overlap=50)
+    expected = read_doc(path, DOC, chunk_chars=1000, overlap=50)
+    assert [(t.name, t.text) for t in cached] == [(t.name, t.text) for t in expected]
+
+
+def test_files_are_parsed_once_by_content(tmp_path, monkeypatch):
+    (path,) = write_synthetic_documents(tmp_path / "docs", 1)
+    parsed = ParseCache(tmp_path / "cache").parse(path)
+
+    def read_doc(*args, **kwargs):
+        raise AssertionError("parsed again")
+
+    # a new process, and the same file uploaded under another name
+    copy = shutil.copy(path, tmp_path / "copy.pdf")
+    with monkeypatch.context() as patch:
+        patch.setattr(parse_cache, "read_doc", read_doc)
+        cache = ParseCache(tmp_path / "cache")
+        assert cache.parse(copy).content == parsed.content
+        assert len(entries(cache)) == 1
+
+    # other parser settings are another entry
+    cache.parse(path, page_size_limit=100_000)
+    assert len(entries(cache)) == 2
+
+
+def test_unreadable_entries_are_parsed_again(tmp_path):
+    (path,) = write_synthetic_documents(tmp_path / "docs", 1)
+    parsed = ParseCache(tmp_path / "cache").parse(path)
+    (entry,) = entries(ParseCache(tmp_path / "cache"))
+    entry.write_bytes(b"not gzip")
+
+    assert ParseCache(tmp_path / "cache").parse(path).content == parsed.content
+    assert entry.read_bytes() != b"not gzip"
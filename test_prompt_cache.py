@@ -0,0 +1,51 @@
+import asyncio
+
+from fakes import FakeLLMModel
+from prompt_cache import PromptCache
+
+PROMPT = "Cite this:\n\n{text}\n\nCitation:"
+
+
+class GarbledLLMModel(FakeLLMModel):
+    def respond(self, messages: list[dict[str, str]]) -> str:
+        return "Sorry, I can't help with that."
+
+
+def run_prompt(cache: PromptCache, llm_model: FakeLLMModel) -> tuple[str, bool]:
+    result, cached = asyncio.run(
+        cache.run_prompt(
+            llm_model,
+            PROMPT,
+            {"text": "Smith, A Paper, 2020"},
+            cacheable=lambda text: "Sorry" not in text,
+        )
+    )
+    return result.text, cached
+
+
+def test_only_accepted_completions_are_cached(tmp_path):
+    cache = PromptCache(tmp_path / "prompts.sqlite")
+
+    garbled = GarbledLLMModel(name="fake-llm")
+    assert run_prompt(cache, garbled) == ("Sorry, I can't help with that.", False)
+    assert run_prompt(cache, garbled) == ("Sorry, I can't help with that.", False)
+    assert garbled.calls == 2
+
+    llm = FakeLLMModel()
+    assert run_prompt(cache, llm) == ("Smith, A Paper, 2020", False)
+    assert run_prompt(cache, llm) == ("Smith, A Paper, 2020", True)
+    assert llm.calls == 1
+
+
+def test_rejected_entries_are_not_served(tmp_path):
+    cache = PromptCache(tmp_path / "prompts.sqlite")
+    # stored before completions were checked
+    asyncio.run(
+        cache.run_prompt(
+            GarbledLLMModel(name="fake-llm"),
+            PROMPT,
+            {"text": "Smith, A Paper, 2020"},
+        )
+    )
+
+    assert run_prompt(cache, FakeLLMModel()) == ("Smith, A Paper, 2020", False)
@@ -0,0 +1,34 @@
+import pytest
+from paperqa.readers import chunk_pdf
+from paperqa.types import Doc, ParsedMetadata, ParsedText
+
+from quote_locator import chunk_page_starts
+
+PARSED = ParsedText(
+    content={"1": "a" * 120, "2": "b" * 50, "3": "c" * 200},
+    metadata=ParsedMetadata(parsing_libraries=[], total_parsed_text_length=370),
+)
+DOC = Doc(docname="Doc", citation="Doc", dockey="dockey")
+
+
+def test_page_starts_line_up_with_paperqa_chunks():
+    chunks = chunk_pdf(PARSED, DOC, chunk_chars=100, overlap=20)
+    starts = chunk_page_starts(PARSED, chunk_chars=100, overlap=20)
+
+    assert len(starts) == len(chunks)
+    for chunk, chunk_starts in zip(chunks, starts, strict=True):
+        first, _, last = chunk.name.rpartition(" ")[2].partition("-")
+        assert len(chunk_starts) == int(last) - int(first) + 1
+        for page, start in zip(range(int(first), int(last) + 1), chunk_starts):
+            if 0 <= start < len(chunk.text):
+                assert chunk.text[start] == PARSED.content[str(page)][0]
+
+
+def test_zero_chunk_chars_is_one_chunk():
+    assert chunk_page_starts(PARSED, chunk_chars=0, overlap=20) == [[0, 120, 170]]
+
+
+@pytest.mark.parametrize(("chunk_chars", "overlap"), [(100, 100), (50, 100)])
+def test_overlap_must_be_smaller_than_chunks(chunk_chars, overlap):
+    with pytest.raises(ValueError, match="overlap"):
+        chunk_page_starts(PARSED, chunk_chars=chunk_chars, overlap=overlap)
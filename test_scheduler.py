@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import pytest
+
+from scheduler import LLMScheduler
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+def flaky_call(calls: list, failures: int, error: type[Exception] = RateLimited):
+    async def fn():
+        calls.append(time.monotonic())
+        if len(calls) <= failures:
+            raise error("slow down")
+        return "done"
+
+    return fn
+
+
+def test_burst_of_429s_halves_once_per_cooldown():
+    scheduler = LLMScheduler(initial_concurrency=32, cooldown=0.05)
+    for _ in range(10):
+        scheduler._record("model", None, rate_limited=True)
+    assert scheduler.state("model").concurrency == 16
+
+    time.sleep(0.06)
+    scheduler._record("model", None, rate_limited=True)
+    assert scheduler.state("model").concurrency == 8
+
+
+def test_window_is_at_least_the_call_latency():
+    scheduler = LLMScheduler(initial_concurrency=32, cooldown=0.0)
+    scheduler._record("model", 0.2)
+    scheduler._record("model", None, rate_limited=True)
+    concurrency = scheduler.state("model").concurrency
+    scheduler._record("model", None, rate_limited=True)
+    assert scheduler.state("model").concurrency == concurrency
+
+    time.sleep(0.25)
+    scheduler._record("model", None, rate_limited=True)
+    assert scheduler.state("model").concurrency == concurrency / 2
+
+
+def test_slow_calls_halve_once_per_window():
+    scheduler = LLMScheduler(initial_concurrency=32, target_latency=0.1, cooldown=10.0)
+    for _ in range(5):
+        scheduler._record("model", 0.5)
+    assert scheduler.state("model").concurrency == 16
+
+
+def test_run_retries_429s_with_backoff():
+    scheduler = LLMScheduler(initial_concurrency=8, backoff=0.02, cooldown=10.0)
+    calls = []
+    assert asyncio.run(scheduler.run("model", flaky_call(calls, failures=2))) == "done"
+    assert len(calls) == 3
+    assert calls[2] - calls[1] >= 2 * (calls[1] - calls[0]) * 0.9
+    # halved once for the burst, then grown by the success
+    assert 4 < scheduler.state("model").concurrency < 5
+    assert scheduler.state("model").in_flight == 0
+
+
+def test_run_gives_up_after_max_retries():
+    scheduler = LLMScheduler(max_retries=2, backoff=0.0)
+    calls = []
+    with pytest.raises(RateLimited):
+        asyncio.run(scheduler.run("model", flaky_call(calls, failures=10)))
+    assert len(calls) == 3
+
+    calls = []
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run("model", flaky_call(calls, failures=1, error=ValueError)))
+    assert len(calls) == 1
+    assert scheduler.state("model").in_flight == 0
+
+
+def test_slots_are_shared_round_robin_across_queries():
+    scheduler = LLMScheduler(initial_concurrency=1, max_concurrency=1)
+    order = []
+
+    def call(query_id: str):
+        async def fn():
+            order.append(query_id)
+            await asyncio.sleep(0.01)
+
+        return scheduler.run("model", fn, query_id=query_id)
+
+    async def run():
+        # a query with many summaries queued before another query's one
+        await asyncio.gather(*[call("a") for _ in range(4)], call("b"))
+
+    asyncio.run(run())
+    assert order == ["a", "a", "b", "a", "a"]
@@ -0,0 +1,57 @@
+import asyncio
+
+import numpy as np
+import pytest
+from paperqa.types import Doc
+
+from chunk_store import ChunkStore, top_k
+from sharded_search import ShardedSearch
+
+RNG = np.random.default_rng(0)
+
+
+def make_store(num_chunks: int = 1000, ndim: int = 16) -> ChunkStore:
+    store = ChunkStore()
+    document = store.add_document(Doc(docname="Doc", citation="Doc", dockey="dockey"))
+    store.extend(
+        documents=[document] * num_chunks,
+        texts=[f"text {i}" for i in range(num_chunks)],
+        pages=[[1]] * num_chunks,
+        embeddings=RNG.standard_normal((num_chunks, ndim), dtype=np.float32),
+    )
+    return store
+
+
+@pytest.fixture
+def search():
+    search = ShardedSearch(workers=4, min_shard_rows=100)
+    yield search
+    search.shutdown()
+
+
+def test_sharded_top_k_matches_exact_search(search):
+    store = make_store()
+    queries = RNG.standard_normal((3, 16), dtype=np.float32)
+    assert len(search._shards(len(store))) == 4
+
+    rows, scores = asyncio.run(search.search_batch(store, queries, 10))
+    expected_rows, expected_scores = top_k(store.embeddings, store.norms, queries, 10)
+    np.testing.assert_array_equal(rows, expected_rows)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+
+def test_sharded_search_over_filtered_rows(search):
+    store = make_store()
+    query = RNG.standard_normal(16, dtype=np.float32)
+    allowed = np.arange(1, len(store), 3)
+
+    rows, scores = asyncio.run(search.search(store, query, 5, rows=allowed))
+    expected_rows, _ = top_k(store.embeddings[allowed], store.norms[allowed], query[None], 5)
+    np.testing.assert_array_equal(rows, allowed[expected_rows[0]])
+    assert list(scores) == sorted(scores, reverse=True)
+
+
+def test_k_larger_than_the_store(search):
+    store = make_store(num_chunks=7)
+    rows, _ = asyncio.run(search.search(store, RNG.standard_normal(16), 10))
+    assert sorted(rows) == list(range(7))
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight, normalize_question
+
+
+def counting_call(calls: list, result, delay: float = 0.05):
+    async def fn():
+        calls.append(result)
+        await asyncio.sleep(delay)
+        return result
+
+    return fn
+
+
+def test_concurrent_calls_with_one_key_run_once():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def run():
+        return await asyncio.gather(
+            single_flight.run("a", counting_call(calls, "a")),
+            single_flight.run("a", counting_call(calls, "a")),
+            single_flight.run("b", counting_call(calls, "b")),
+        )
+
+    assert asyncio.run(run()) == ["a", "a", "b"]
+    assert sorted(calls) == ["a", "b"]
+    assert single_flight.calls == single_flight.waiters == {}
+
+
+def test_shared_call_is_cancelled_with_its_last_caller():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def run():
+        first = asyncio.create_task(single_flight.run("a", counting_call(calls, "a", 0.1)))
+        second = asyncio.create_task(single_flight.run("a", counting_call(calls, "a", 0.1)))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        # the other caller still gets the result
+        assert await second == "a"
+
+        third = asyncio.create_task(single_flight.run("b", counting_call(calls, "b", 10.0)))
+        await asyncio.sleep(0.01)
+        shared = single_flight.calls["b"]
+        third.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await third
+        await asyncio.sleep(0)
+        assert shared.cancelled()
+
+    asyncio.run(run())
+    assert calls == ["a", "b"]
+
+
+def test_calls_are_coalesced_across_processes(tmp_path):
+    # each instance stands in for a process, their lock files are opened separately
+    processes = [SingleFlight(lock_dir=tmp_path, poll_interval=0.01) for _ in range(2)]
+    calls = []
+
+    async def run():
+        first = asyncio.create_task(processes[0].run("a", counting_call(calls, {"answer": 1})))
+        await asyncio.sleep(0.01)
+        return await asyncio.gather(
+            first, processes[1].run("a", counting_call(calls, {"answer": 2}))
+        )
+
+    assert asyncio.run(run()) == [{"answer": 1}, {"answer": 1}]
+    assert calls == [{"answer": 1}]
+
+
+def test_normalize_question():
+    assert normalize_question("  What is  KRAS?? ") == normalize_question("what is kras")
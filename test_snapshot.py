@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import numpy as np
+
+from fake_postgrest import FAKE_SERVICE_KEY, FakePostgREST
+from fakes import synthetic_corpus
+from snapshot import export_snapshot, import_snapshot
+from supabase_store import SupabaseStore
+
+DIGEST = {"summary": "summary", "points": [{"point": "point", "quote": "quote"}]}
+
+
+def seed(fake: FakePostgREST) -> None:
+    for documents, chunks in synthetic_corpus(60, chunks_per_document=10, ndim=16):
+        chunks[0]["digest"] = DIGEST
+        chunks[1]["page_starts"] = [0, 10]
+        fake.insert("documents", documents)
+        fake.insert("chunks", chunks)
+
+
+def client(fake: FakePostgREST):
+    return SupabaseStore(supabase_url=fake.url, supabase_service_key=FAKE_SERVICE_KEY).client()
+
+
+def rows(fake: FakePostgREST, table: str) -> dict[str, dict]:
+    return {row["id"]: row for row in fake.tables[table]}
+
+
+def test_export_import_round_trip(tmp_path):
+    with FakePostgREST() as source, FakePostgREST() as target:
+        seed(source)
+
+        async def run():
+            await export_snapshot(
+                await client(source),
+                tmp_path,
+                part_rows=25,
+                page_size=10,
+                partitions=2,
+            )
+            await import_snapshot(await client(target), tmp_path, batch_size=7)
+
+        asyncio.run(run())
+        for table, vector in [("documents", "abstract_emb"), ("chunks", "text_emb")]:
+            exported, imported = rows(source, table), rows(target, table)
+            assert exported.keys() == imported.keys()
+            for key, row in exported.items():
+                for column, value in row.items():
+                    if column == vector:
+                        np.testing.assert_allclose(
+                            json.loads(imported[key][column]), json.loads(value), atol=1e-6
+                        )
+                    elif column != "created_at":
+                        assert imported[key][column] == value, (table, column)
+
+
+def test_store_loads_the_snapshot_and_newer_rows(tmp_path):
+    with FakePostgREST() as fake:
+        seed(fake)
+
+        async def export():
+            await export_snapshot(await client(fake), tmp_path)
+
+        asyncio.run(export())
+        # created after the export, so only the database has it
+        new_chunk = dict(fake.tables["chunks"][0], id="ffffffff-0000-0000-0000-000000000001")
+        del new_chunk["created_at"]
+        fake.insert("chunks", [new_chunk])
+
+        from_snapshot = SupabaseStore(
+            supabase_url=fake.url,
+            supabase_service_key=FAKE_SERVICE_KEY,
+            snapshot_path=tmp_path,
+            load_digests=True,
+        )
+        from_database = SupabaseStore(
+            supabase_url=fake.url, supabase_service_key=FAKE_SERVICE_KEY, load_digests=True
+        )
+        requests = [fake.requests]
+        for store in (from_snapshot, from_database):
+            asyncio.run(store.load_texts())
+            requests.append(fake.requests)
+        # the snapshot only reads what was created since it was exported
+        assert requests[1] - requests[0] < requests[2] - requests[1]
+        assert len(from_snapshot.chunks) == len(from_database.chunks) == 61
+        for store in (from_snapshot, from_database):
+            row = store.chunks.ids.index(new_chunk["id"])
+            assert store.chunks.digests[row] == DIGEST
+        query = np.asarray(json.loads(fake.tables["chunks"][5]["text_emb"]), dtype=np.float32)
+        for store in (from_snapshot, from_database):
+            found, _ = asyncio.run(store.search_rows(query, 3))
+            assert store.chunks.ids[found[0]] == fake.tables["chunks"][5]["id"]
@@ -0,0 +1,186 @@
+import asyncio
+
+import numpy as np
+import pytest
+from postgrest.exceptions import APIError
+
+from fake_postgrest import FAKE_SERVICE_KEY, FakePostgREST
+from fakes import synthetic_corpus
+from supabase_store import SupabaseStore
+
+NEW_DOCUMENT = "ffffffff-0000-0000-0000-000000000001"
+NEW_CHUNK = "ffffffff-0000-0000-0000-000000000002"
+
+
+def make_store(fake: FakePostgREST, **kwargs) -> SupabaseStore:
+    return SupabaseStore(supabase_url=fake.url, supabase_service_key=FAKE_SERVICE_KEY, **kwargs)
+
+
+def seed(fake: FakePostgREST, num_chunks: int, ndim: int = 16) -> None:
+    for documents, chunks in synthetic_corpus(num_chunks, chunks_per_document=10, ndim=ndim):
+        fake.insert("documents", documents)
+        fake.insert("chunks", chunks)
+
+
+def test_refresh_follows_other_writers():
+    with FakePostgREST() as fake:
+        seed(fake, 40)
+        store = make_store(fake)
+        vector = np.ones(16, dtype=np.float32)
+
+        async def run():
+            await store.ensure_loaded()
+            version = store.corpus_version
+
+            # uploaded by a jobs.py worker
+            fake.insert(
+                "documents", [{"id": NEW_DOCUMENT, "citation": "Novak, A New Document, 2024"}]
+            )
+            fake.insert(
+                "chunks",
+                [
+                    {
+                        "id": NEW_CHUNK,
+                        "document": NEW_DOCUMENT,
+                        "pages": [1],
+                        "text": "new",
+                        "text_emb": vector.tolist(),
+                    }
+                ],
+            )
+            await store.refresh()
+            rows, _ = await store.search_rows(vector, 1)
+            assert store.chunks.ids[rows[0]] == NEW_CHUNK
+            assert store.corpus_version != version
+
+            # nothing is appended twice
+            await store.refresh()
+            assert len(store.chunks) == 41
+
+            version = store.corpus_version
+            supabase = await store.client()
+            await supabase.table("chunks").delete().eq("document", NEW_DOCUMENT).execute()
+            await supabase.table("documents").delete().eq("id", NEW_DOCUMENT).execute()
+            await store.refresh()
+            rows, _ = await store.search_rows(vector, 5)
+            assert NEW_CHUNK not in {store.chunks.ids[row] for row in rows}
+            assert store.corpus_version != version
+
+        asyncio.run(run())
+
+
+def test_queries_schedule_a_refresh():
+    with FakePostgREST() as fake:
+        seed(fake, 20)
+        store = make_store(fake, version_check_interval=0.0)
+
+        async def run():
+            await store.ensure_loaded()
+            fake.insert("documents", [{"id": NEW_DOCUMENT, "citation": "Ito, Another, 2024"}])
+            fake.insert(
+                "chunks",
+                [
+                    {
+                        "id": NEW_CHUNK,
+                        "document": NEW_DOCUMENT,
+                        "text": "new",
+                        "text_emb": [1.0] * 16,
+                    }
+                ],
+            )
+            await store.ensure_loaded()
+            await store._refresh
+            return len(store.chunks)
+
+        assert asyncio.run(run()) == 21
+
+
+def test_has_column_caches_only_missing_columns():
+    with FakePostgREST(missing_columns=["documents.docname"]) as fake:
+        store = make_store(fake)
+
+        async def run():
+            assert not await store.has_column("documents", "docname")
+            assert await store.has_column("chunks", "page_starts")
+            requests = fake.requests
+            assert not await store.has_column("documents", "docname")
+            assert fake.requests == requests
+
+        asyncio.run(run())
+
+
+def test_has_column_raises_other_errors(monkeypatch):
+    with FakePostgREST() as fake:
+        store = make_store(fake)
+
+        async def run():
+            supabase = await store.client()
+
+            async def timed_out(self):
+                raise APIError({"code": "57014", "message": "canceling statement due to timeout"})
+
+            request = type(supabase.table("documents").select("docname"))
+            with monkeypatch.context() as patch:
+                patch.setattr(request, "execute", timed_out)
+                with pytest.raises(APIError):
+                    await store.has_column("documents", "docname")
+            # not remembered as missing
+            assert await store.has_column("documents", "docname")
+
+        asyncio.run(run())
+
+
+def test_load_pages_through_truncated_responses():
+    # responses capped below page_size, like PostgREST's db-max-rows
+    with FakePostgREST(max_rows=7) as fake:
+        seed(fake, 95)
+        store = make_store(fake, page_size=20, load_partitions=4, load_concurrency=2)
+        progress = []
+        asyncio.run(store.load_texts(lambda n, total: progress.append((n, total))))
+
+        assert sorted(store.chunks.ids) == sorted(row["id"] for row in fake.tables["chunks"])
+        assert len(store.chunks.documents) == 10
+        assert progress[-1] == (95, 95)
+        assert [n for n, _ in progress] == sorted(n for n, _ in progress)
+
+
+def load_documents(fake: FakePostgREST, rows: list[dict]) -> dict[str, str]:
+    fake.insert("documents", rows)
+    fake.insert(
+        "chunks",
+        [{"document": row["id"], "text": "text", "text_emb": [1.0] * 4} for row in rows],
+    )
+    store = make_store(fake)
+    asyncio.run(store.load_texts())
+    return {d.dockey: d.docname for d in store.chunks.documents}
+
+
+DOCUMENT_IDS = [f"00000000-0000-0000-0000-00000000000{i}" for i in range(3)]
+
+
+def test_stored_docnames_win_over_derived_ones():
+    ids = DOCUMENT_IDS
+    with FakePostgREST() as fake:
+        docnames = load_documents(
+            fake,
+            [
+                # written before the docname column, in id order before the stored one
+                {"id": ids[0], "citation": "Smith, Old Upload, 2020"},
+                {"id": ids[1], "citation": "Smith, New Upload, 2020", "docname": "Smith2020"},
+                {"id": ids[2], "citation": "Smith, Older Upload, 2020"},
+            ],
+        )
+    assert docnames[ids[1]] == "Smith2020"
+    assert sorted(docnames.values()) == ["Smith2020", "Smith2020a", "Smith2020b"]
+
+
+def test_docnames_without_the_migration():
+    with FakePostgREST(missing_columns=["documents.docname"]) as fake:
+        docnames = load_documents(
+            fake,
+            [
+                {"id": DOCUMENT_IDS[0], "citation": "Doe, A Paper, 2001"},
+                {"id": DOCUMENT_IDS[1], "citation": "Doe, Another Paper, 2001"},
+            ],
+        )
+    assert sorted(docnames.values()) == ["Doe2001", "Doe2001a"]
@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+
+import numpy as np
+from paperqa import Settings
+from paperqa.types import Doc
+
+from fake_postgrest import FAKE_SERVICE_KEY, FakePostgREST
+from fakes import FakeEmbeddingModel, FakeLLMModel, write_synthetic_documents
+from tracing import metrics
+from upload_docs import UploadDocs, rank_score
+from utils import TextPlus
+
+
+def make_docs(documents: int = 4, chunks: int = 50, ndim: int = 16) -> UploadDocs:
+    docs = UploadDocs(
+        supabase_url="http://localhost:1",
+        supabase_service_key="key",
+        ann_backend="ivfpq",
+        ann_params={"nlist": 4, "pq_m": 4, "nprobe": 4},
+        ann_path=None,
+    )
+    rng = np.random.default_rng(0)
+    texts = []
+    for d in range(documents):
+        doc = Doc(docname=f"Doc{d}", citation=f"Citation {d}", dockey=f"dockey-{d}")
+        for c in range(chunks):
+            texts.append(
+                TextPlus(
+                    text=f"chunk {c} of {d}",
+                    name=f"Doc{d} chunk {c}",
+                    doc=doc,
+                    embedding=rng.standard_normal(ndim).tolist(),
+                )
+            )
+    docs.store.add_texts_and_embeddings(texts)
+    asyncio.run(docs.store._load_ann(docs.store.chunks))
+    return docs
+
+
+def candidate_documents(docs: UploadDocs) -> set[int]:
+    chunks = docs.store.chunks
+    queries = chunks.embeddings[: len(chunks) : 10]
+    rows, _ = docs.store.ann.search(chunks, queries, k=len(chunks))
+    return set(chunks.row_documents[rows[rows >= 0]].tolist())
+
+
+def test_delete_by_name_tombstones_uploaded_document():
+    docs = make_docs()
+    version = docs.store.corpus_version
+    assert candidate_documents(docs) == {0, 1, 2, 3}
+
+    docs.delete(name="Doc1")
+
+    assert docs.deleted_dockeys == {"dockey-1"}
+    assert 1 not in candidate_documents(docs)
+    assert docs.store.corpus_version != version
+
+
+def test_delete_by_dockey_and_repeat():
+    docs = make_docs()
+    docs.delete(dockey="dockey-2")
+    version = docs.store.corpus_version
+    docs.delete(dockey="dockey-2")
+
+    assert docs.deleted_dockeys == {"dockey-2"}
+    assert 2 not in candidate_documents(docs)
+    assert docs.store.corpus_version == version
+
+
+def test_rebuilt_index_keeps_tombstones():
+    docs = make_docs()
+    docs.delete(dockey="dockey-0")
+    asyncio.run(docs.store._load_ann(docs.store.chunks))
+
+    assert 0 not in candidate_documents(docs)
+
+
+def test_only_summary_calls_are_timed():
+    docs = make_docs(documents=1, chunks=3)
+    matches = [docs.store.chunks.materialize(row) for row in range(3)]
+    settings = Settings()
+    metrics.reset()
+
+    settings.answer.evidence_skip_summary = True
+    asyncio.run(
+        docs.aget_evidence(
+            "question", settings=settings, summary_llm_model=FakeLLMModel(), matches=matches
+        )
+    )
+    assert metrics.recent_latency("evidence.summary") is None
+
+    settings.answer.evidence_skip_summary = False
+    asyncio.run(
+        docs.aget_evidence(
+            "question", settings=settings, summary_llm_model=FakeLLMModel(), matches=matches
+        )
+    )
+    assert metrics.recent_latency("evidence.summary") is not None
+    metrics.reset()
+
+
+def test_batch_retrieval_timeout_fails_each_question():
+    docs = make_docs(documents=1, chunks=3)
+
+    async def run():
+        deadline = asyncio.get_running_loop().time()
+        return [
+            result
+            async for result in docs.aquery_batch(
+                ["first", "second", "first"],
+                settings=Settings(),
+                llm_model=FakeLLMModel(),
+                summary_llm_model=FakeLLMModel(),
+                embedding_model=FakeEmbeddingModel(ndim=16, latency=0.05),
+                deadline=deadline,
+            )
+        ]
+
+    results = asyncio.run(run())
+    assert [i for i, _ in results] == [0, 1, 2]
+    assert all(isinstance(error, TimeoutError) for _, error in results)
+
+
+class GarbledLLMModel(FakeLLMModel):
+    def respond(self, messages: list[dict[str, str]]) -> str:
+        return "Sorry, I can't help with that."
+
+
+def test_unparseable_citation_falls_back_and_is_not_cached(tmp_path):
+    [path] = write_synthetic_documents(tmp_path, 1)
+    with FakePostgREST() as fake:
+        docs = UploadDocs(
+            supabase_url=fake.url,
+            supabase_service_key=FAKE_SERVICE_KEY,
+            combined_citation=True,
+            parse_cache_dir=None,
+            metadata_cache_path=None,
+            prompt_cache_path=tmp_path / "prompts.sqlite",
+        )
+        asyncio.run(
+            docs.aupload(
+                path,
+                settings=Settings(),
+                llm_model=GarbledLLMModel(),
+                embedding_model=FakeEmbeddingModel(ndim=16),
+            )
+        )
+        [document] = fake.tables["documents"]
+
+    assert document["citation"] == f"Unknown, {path.name}, {datetime.datetime.now().year}"
+    with docs.prompt_cache.connect() as db:
+        assert db.execute("select count(*) from completions").fetchone()[0] == 0
+
+
+def test_rank_scores_share_the_llm_relevance_scale():
+    scores = [rank_score(rank, 10) for rank in range(10)]
+    assert scores[0] == 10
+    assert scores[-1] == 1
+    assert scores == sorted(scores, reverse=True)
+    assert rank_score(0, 1) == 10
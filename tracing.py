@@ -0,0 +1,232 @@
+from collections import defaultdict
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from uuid import uuid4
+import bisect
+import logging
+import threading
+import time
+
+from paperqa.types import LLMResult
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+
+# seconds, the stages range from sub-millisecond searches to multi-second LLM calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: str | None
+    start_time: float
+    end_time: float | None = None
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def start_time_unix_nano(self) -> int:
+        return int(self.start_time * 1e9)
+
+    @property
+    def end_time_unix_nano(self) -> int | None:
+        return None if self.end_time is None else int(self.end_time * 1e9)
+
+
+class Trace:
+    """The spans recorded while collecting a trace, see `collect_trace`."""
+
+    def __init__(self):
+        self.spans: list[Span] = []
+
+    def timings(self) -> list[dict]:
+        """Spans in start order with offsets relative to the first one, in milliseconds."""
+        if not self.spans:
+            return []
+        spans = sorted(self.spans, key=lambda s: s.start_time)
+        origin = spans[0].start_time
+        names = {s.span_id: s.name for s in spans}
+        return [
+            {
+                "name": s.name,
+                "parent": names.get(s.parent_id),
+                "start_ms": round((s.start_time - origin) * 1000, 3),
+                "duration_ms": round(s.duration * 1000, 3),
+                **({"attributes": s.attributes} if s.attributes else {}),
+            }
+            for s in spans
+        ]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Process-wide stage latency histograms and LLM/embedding usage counters."""
+
+    def __init__(self, prefix: str = "didact"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.stages: dict[str, Histogram] = defaultdict(Histogram)
+        # (metric, model) -> value
+        self.counters: dict[tuple[str, str], float] = defaultdict(float)
+        # exponentially weighted recent latency per stage, see latency_budget.plan_query
+        self.recent: dict[str, float] = {}
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.stages[stage].observe(seconds)
+            previous = self.recent.get(stage)
+            self.recent[stage] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+    def recent_latency(self, stage: str) -> float | None:
+        with self.lock:
+            return self.recent.get(stage)
+
+    def increment(self, metric: str, model: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[(metric, model)] += value
+
+    def reset(self) -> None:
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.recent.clear()
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            name = f"{self.prefix}_stage_duration_seconds"
+            lines += [
+                f"# HELP {name} Time spent in each stage of uploads and queries.",
+                f"# TYPE {name} histogram",
+            ]
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(
+                    [*histogram.buckets, "+Inf"], histogram.counts, strict=True
+                ):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+            metrics = sorted({metric for metric, _ in self.counters})
+            for metric in metrics:
+                name = f"{self.prefix}_{metric}_total"
+                lines.append(f"# TYPE {name} counter")
+                for (counter, model), value in sorted(self.counters.items()):
+                    if counter == metric:
+                        lines.append(f'{name}{{model="{model}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+# called with every finished span, e.g. to forward them to another tracing backend
+span_hooks: list[Callable[[Span], None]] = []
+
+
+@contextmanager
+def collect_trace() -> Iterator[Trace]:
+    """Collect the spans of everything run inside the block, including spawned tasks."""
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """Time a stage.
+
+    Every span feeds the `metrics` histogram for its name and the trace being collected,
+    if any. When OpenTelemetry is installed, a matching OpenTelemetry span is started too.
+    """
+    parent = _current_span.get()
+    current = Span(
+        name=name,
+        span_id=uuid4().hex[:16],
+        parent_id=parent.span_id if parent else None,
+        start_time=time.time(),
+        attributes=attributes,
+    )
+    token = _current_span.set(current)
+    otel_span = None
+    if otel_trace is not None:
+        otel_span = otel_trace.get_tracer(__name__).start_as_current_span(
+            name, attributes=attributes
+        )
+        otel_span.__enter__()
+    try:
+        yield current
+    finally:
+        current.end_time = time.time()
+        _current_span.reset(token)
+        if otel_span is not None:
+            otel_span.__exit__(None, None, None)
+        metrics.observe_stage(name, current.duration)
+        if (trace := _current_trace.get()) is not None:
+            trace.spans.append(current)
+        for hook in span_hooks:
+            try:
+                hook(current)
+            except Exception:
+                logger.exception(f"Span hook {hook} failed")
+
+
+def traced(name: str) -> Callable:
+    """Decorator running a coroutine function inside a span."""
+
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_llm_result(result: LLMResult) -> None:
+    model = result.model or "unknown"
+    metrics.increment("llm_calls", model)
+    metrics.increment("llm_prompt_tokens", model, result.prompt_count)
+    metrics.increment("llm_completion_tokens", model, result.completion_count)
+
+
+def record_embedding(model: str, texts: Sequence[str]) -> None:
+    metrics.increment("embedding_calls", model)
+    metrics.increment("embedding_texts", model, len(texts))
+    # embedding APIs don't report usage, so estimate at ~4 characters per token
+    metrics.increment("embedding_tokens", model, sum(len(t) for t in texts) // 4)
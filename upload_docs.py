@@ -1,4 +1,4 @@
-from collections.abc import Callable, Sequence
+from collections.abc import AsyncIterator, Callable, Sequence
 from collections import OrderedDict
 from functools import partial
 from pathlib import Path
@@ -13,7 +13,7 @@ import os
 import re
 
 from postgrest.exceptions import APIError
-from supabase._async.client import create_client as create_async_client, AsyncClient
+from supabase._async.client import AsyncClient
 import numpy as np
 
 from paperqa.clients import DEFAULT_CLIENTS, DocMetadataClient
@@ -26,90 +26,401 @@ from paperqa.llms import (
     NumpyVectorStore,
     PromptRunner,
     cosine_similarity,
+    embedding_model_factory,
 )
 from paperqa.readers import read_doc
-from paperqa.settings import MaybeSettings, get_settings
+from paperqa.settings import MaybeSettings, Settings, get_settings
 from paperqa.types import (
     Answer,
     Context,
     Doc,
     DocKey,
     Embeddable,
+    LLMResult,
+    ParsedText,
     Text,
     set_llm_answer_ids,
 )
 from paperqa.utils import (
     gather_with_concurrency,
+    get_loop,
     maybe_is_text,
     name_in_text,
+    strip_citations,
 )
 
-from quote_docs import AnswerQuotes
+from answer_cache import AnswerCache
+from context_packing import pack_contexts
+from embedding_versions import EmbeddingVersion, fetch_active_version, fetch_versions
+from latency_budget import QueryPlan, plan_query
+from quote_docs import AnswerQuotes, digest_json_system_prompt_with_quote, digest_prompt
+from scheduler import estimate_tokens, llm_scheduler
+from single_flight import normalize_question
+from metadata_cache import CachedMetadataClient
+from parse_cache import ParseCache
+from prompt_cache import PromptCache
+from quote_locator import chunk_page_starts, locate_context_quotes
 from supabase_store import SupabaseStore
-from utils import TextPlus, AnswerQuotesFormatted
+from tracing import metrics, record_embedding, record_llm_result, span, traced
+from utils import (
+    AnswerQuotesFormatted,
+    ChunkFilter,
+    TextPlus,
+    docname_from_citation,
+    unique_docname,
+)
 
 logger = logging.getLogger(__name__)
 
 
 NAMESPACE_CITATION = UUID("5345abad-94db-4db0-a1b1-6107ba7a4cb7")
 
+# retries when concurrent uploads pick the same docname
+MAX_DOCNAME_ATTEMPTS = 5
+
+# citation_prompt and structured_citation_prompt in one call, see UploadDocs.combined_citation
+CITATION_JSON_PROMPT = (
+    "Provide the citation for the following text in MLA Format, along with its title,"
+    " authors, and doi. Return them as a JSON with citation, title, authors, and doi as"
+    " keys, author's value should be a list of authors. If any field can not be found,"
+    " return it as null. Do not write an introductory sentence. If reporting date"
+    " accessed, the current year is 2024"
+    "\n\n{text}\n\n"
+    "Citation JSON:"
+)
+
+class DocumentRejected(ValueError):
+    """The document itself can't be uploaded, e.g. unreadable or a duplicate, retrying won't help."""
+
+
 def generate_dockey(citation: str):
     return str(uuid5(NAMESPACE_CITATION, citation))
 
 
-async def upload_chunk(chunk: Text|TextPlus, supabase: AsyncClient):
-    response = (
-        await supabase.table("chunks")
-        .insert(
-            {
-                "document": chunk.doc.dockey,
-                "pages": chunk.pages if type(chunk) == TextPlus else [],
-                "text": chunk.text,
-                "text_emb": chunk.embedding,
-            }
-        )
-        .execute()
+def usable_citation(citation: str) -> bool:
+    return (
+        len(citation) >= 3  # noqa: PLR2004
+        and "Unknown" not in citation
+        and "insufficient" not in citation
+    )
+
+
+def parses_to_citation(text: str) -> bool:
+    citation_json = parse_citation_json(text)
+    return citation_json is not None and usable_citation(str(citation_json.get("citation") or ""))
+
+
+def parses_to_digest(text: str) -> bool:
+    try:
+        return bool(llm_parse_json(text).get("summary"))
+    except (ValueError, AttributeError):
+        return False
+
+
+def rank_score(rank: int, count: int) -> int:
+    """Relevance out of 10 for the `rank`-th of `count` retrieved chunks, which no LLM scored.
+
+    Linear from 10 for the nearest chunk down to 1, so they sort among LLM relevance scores
+    on the same scale and none is dropped for scoring 0.
+    """
+    if count <= 1:
+        return 10
+    return round(10 - 9 * rank / (count - 1))
+
+
+def digest_context(text: TextPlus, score: int) -> Context:
+    """Context from the digest made at upload, in place of a summary for the question."""
+    return Context(
+        context=text.digest["summary"],
+        text=Text(
+            text=text.text,
+            name=text.name,
+            doc=text.doc.__class__(**text.doc.model_dump(exclude={"embedding"})),
+        ),
+        score=score,
+        # copies, quote locations are added to the points
+        points=[dict(p) for p in text.digest.get("points") or []],
     )
+
+
+def parse_citation_json(text: str) -> dict | None:
+    # This code below tries to isolate the JSON
+    # based on observed messages from LLMs
+    # it does so by isolating the content between
+    # the first { and last } in the response.
+    # Since the anticipated structure should  not be nested,
+    # we don't have to worry about nested curlies.
+    clean_text = text.split("{", 1)[-1].split("}", 1)[0]
+    clean_text = "{" + clean_text + "}"
+    try:
+        citation_json = json.loads(clean_text)
+    except json.JSONDecodeError:
+        # clean_text was not actually JSON
+        return None
+    # e.g. a list
+    return citation_json if isinstance(citation_json, dict) else None
+
+
+async def upload_chunk(
+    chunk: Text|TextPlus, supabase: AsyncClient, legacy: bool = True, page_starts: bool = True
+) -> str:
+    row = {
+        "document": chunk.doc.dockey,
+        "pages": chunk.pages if type(chunk) == TextPlus else [],
+        "text": chunk.text,
+        # once a versioned embedding is active, vectors only go to chunk_embeddings
+        "text_emb": chunk.embedding if legacy else None,
+    }
+    # without the page_starts migration, quotes are located in the chunk but not its page
+    if page_starts:
+        row["page_starts"] = chunk.page_starts if type(chunk) == TextPlus else []
+    if getattr(chunk, "digest", None) is not None:
+        row["digest"] = chunk.digest
+    response = await supabase.table("chunks").insert(row).execute()
     if not len(response.data):
         raise ValueError("Chunk not inserted")
+    return response.data[0]["id"]
 
 
 class UploadDocs(Docs):
     supabase_url: str
     supabase_service_key: str
+    # see SupabaseStore.lazy_text
+    lazy_text: bool = False
+    # parsed pages are cached here by file hash, None parses every time
+    parse_cache_dir: Path | None = Path("parse_cache")
+    _parse_cache: ParseCache | None = None
+    # Crossref and Semantic Scholar results are cached here, None looks up every time
+    metadata_cache_path: Path | None = Path("metadata_cache/metadata.sqlite")
+    _metadata_client: CachedMetadataClient | None = None
+    # citation prompt results are cached here, None prompts every time
+    prompt_cache_path: Path | None = Path("prompt_cache/prompts.sqlite")
+    _prompt_cache: PromptCache | None = None
+    # extract the citation and its title, authors and DOI in one LLM call
+    combined_citation: bool = False
+    # summarize every chunk once at upload, so queries with evidence_from_digests need no
+    # summary calls, needs the digest column (see NOTES.md)
+    chunk_digests: bool = False
+    # answers are reused for questions at least this cosine similar, None reuses them
+    # only for repeats of a question when the latency budget allows nothing else
+    answer_cache_threshold: float | None = None
+    answer_cache_size: int = 1024
+    _answer_cache: AnswerCache | None = None
+    # see SupabaseStore.ann_backend
+    ann_backend: str | None = None
+    ann_params: dict = {}
+    ann_path: Path | None = Path("ann_index")
+    # see SupabaseStore.snapshot_path
+    snapshot_path: Path | None = None
 
-    async def retrieve_texts(
+    @property
+    def answer_cache(self) -> AnswerCache:
+        if self._answer_cache is None:
+            self._answer_cache = AnswerCache(
+                threshold=self.answer_cache_threshold, max_entries=self.answer_cache_size
+            )
+        return self._answer_cache
+
+    @property
+    def prompt_cache(self) -> PromptCache | None:
+        if self.prompt_cache_path is None:
+            return None
+        if self._prompt_cache is None or self._prompt_cache.path != self.prompt_cache_path:
+            self._prompt_cache = PromptCache(self.prompt_cache_path)
+        return self._prompt_cache
+
+    @property
+    def metadata_client(self) -> CachedMetadataClient | None:
+        if self.metadata_cache_path is None:
+            return None
+        if self._metadata_client is None or self._metadata_client.path != self.metadata_cache_path:
+            self._metadata_client = CachedMetadataClient(self.metadata_cache_path)
+        return self._metadata_client
+
+    @property
+    def parse_cache(self) -> ParseCache | None:
+        if self.parse_cache_dir is None:
+            return None
+        if self._parse_cache is None or self._parse_cache.directory != self.parse_cache_dir:
+            self._parse_cache = ParseCache(self.parse_cache_dir)
+        return self._parse_cache
+
+    def read_doc(
         self,
-        query: str,
-        k: int,
-        settings: MaybeSettings = None,
-        embedding_model: EmbeddingModel | None = None,
+        path: Path,
+        doc: Doc,
+        chunk_chars: int,
+        overlap: int,
+        page_size_limit: int | None = None,
     ) -> list[Text]:
-        self.texts_index = SupabaseStore(
-            supabase_url=self.supabase_url,
-            supabase_service_key=self.supabase_service_key,
+        if self.parse_cache is None:
+            return read_doc(
+                path,
+                doc,
+                chunk_chars=chunk_chars,
+                overlap=overlap,
+                page_size_limit=page_size_limit,
+            )
+        return self.parse_cache.read_doc(
+            path,
+            doc,
+            chunk_chars=chunk_chars,
+            overlap=overlap,
+            page_size_limit=page_size_limit,
         )
 
+    def parse(self, path: Path, page_size_limit: int | None = None) -> ParsedText:
+        if self.parse_cache is None:
+            return read_doc(
+                path,
+                Doc(docname="", citation="", dockey=str(path)),
+                parsed_text_only=True,
+                page_size_limit=page_size_limit,
+            )
+        return self.parse_cache.parse(path, page_size_limit)
+
+    @property
+    def store(self) -> SupabaseStore:
+        # keep the loaded index around so only the first query pays for loading it
+        if not isinstance(self.texts_index, SupabaseStore):
+            self.texts_index = SupabaseStore(
+                supabase_url=self.supabase_url,
+                supabase_service_key=self.supabase_service_key,
+                lazy_text=self.lazy_text,
+                load_digests=self.chunk_digests,
+                ann_backend=self.ann_backend,
+                ann_params=self.ann_params,
+                ann_path=self.ann_path,
+                snapshot_path=self.snapshot_path,
+            )
+        return self.texts_index
+
+    def delete(
+        self,
+        name: str | None = None,
+        docname: str | None = None,
+        dockey: DocKey | None = None,
+    ) -> None:
+        """Hide a document from searches, its rows are kept.
+
+        Uploaded documents are not in `docs`, their dockey is looked up by name in the
+        loaded index or else the documents table.
+        """
+        get_loop().run_until_complete(self.adelete(name=name, docname=docname, dockey=dockey))
+
+    async def adelete(
+        self,
+        name: str | None = None,
+        docname: str | None = None,
+        dockey: DocKey | None = None,
+    ) -> None:
+        name = docname if name is None else name
+        if name is not None:
+            dockey = await self._find_dockey(name)
+            if dockey is None:
+                return
+        if dockey is None or dockey in self.deleted_dockeys:
+            return
+        if dockey in self.docs:
+            super().delete(dockey=dockey)
+        self.deleted_dockeys.add(dockey)
+        self.store.delete_documents([dockey])
+
+    async def _find_dockey(self, docname: str) -> DocKey | None:
+        for doc in self.docs.values():
+            if doc.docname == docname:
+                return doc.dockey
+        if self.store.loaded:
+            for doc in self.store.chunks.documents:
+                if doc.docname == docname:
+                    return doc.dockey
+        if not await self.store.has_column("documents", "docname"):
+            return None
+        supabase = await self.store.client()
+        response = (
+            await supabase.table("documents").select("id").eq("docname", docname).execute()
+        )
+        return response.data[0]["id"] if response.data else None
+
+    async def _prepare_texts_index(
+        self,
+        settings: MaybeSettings,
+        embedding_model: EmbeddingModel | None,
+        filters: ChunkFilter | None,
+    ) -> tuple[EmbeddingModel, ChunkFilter | None]:
         settings = get_settings(settings)
         if embedding_model is None:
             embedding_model = settings.get_embedding_model()
 
         # TODO: should probably happen elsewhere
-        self.texts_index.mmr_lambda = settings.texts_index_mmr_lambda
+        self.store.mmr_lambda = settings.texts_index_mmr_lambda
 
         await self._build_texts_index(embedding_model)
-        _k = k + len(self.deleted_dockeys)
+        # deleted documents are masked inside the store's search, see adelete
+        return embedding_model, filters
+
+    async def awarm(
+        self,
+        settings: MaybeSettings = None,
+        embedding_model: EmbeddingModel | None = None,
+    ) -> None:
+        """Load the index and open the database and embedding connections before any query."""
+        embedding_model, _ = await self._prepare_texts_index(settings, embedding_model, None)
+        with span("warm"):
+            await self.store.ensure_loaded()
+            # also starts the search threads and, with lazy_text, fetches a chunk text
+            await self.store.similarity_search("warm up", 1, embedding_model)
+
+    async def aclose(self) -> None:
+        """Close the HTTP session of the metadata lookups, on the loop that used it."""
+        if self._metadata_client is not None:
+            await self._metadata_client.close()
+
+    @traced("retrieve_texts")
+    async def retrieve_texts(
+        self,
+        query: str,
+        k: int,
+        settings: MaybeSettings = None,
+        embedding_model: EmbeddingModel | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> list[Text]:
+        embedding_model, filters = await self._prepare_texts_index(
+            settings, embedding_model, filters
+        )
         matches: list[Text] = cast(
             list[Text],
             (
                 await self.texts_index.max_marginal_relevance_search(
-                    query, k=_k, fetch_k=2 * _k, embedding_model=embedding_model
+                    query,
+                    k=k,
+                    fetch_k=2 * k,
+                    embedding_model=embedding_model,
+                    filters=filters,
                 )
             )[0],
         )
-        matches = [m for m in matches if m.doc.dockey not in self.deleted_dockeys]
         return matches[:k]
 
+    @traced("retrieve_texts")
+    async def retrieve_texts_batch(
+        self,
+        queries: Sequence[str],
+        k: int,
+        settings: MaybeSettings = None,
+        embedding_model: EmbeddingModel | None = None,
+        filters: ChunkFilter | None = None,
+    ) -> list[list[Text]]:
+        """`retrieve_texts` for many queries, with one embedding call and one search."""
+        embedding_model, filters = await self._prepare_texts_index(
+            settings, embedding_model, filters
+        )
+        results = await self.texts_index.max_marginal_relevance_search_batch(
+            queries, k=k, fetch_k=2 * k, embedding_model=embedding_model, filters=filters
+        )
+        return [cast(list[Text], matches)[:k] for matches, _ in results]
+
+    @traced("aget_evidence")
     async def aget_evidence(
         self,
         query: Answer | str,
@@ -118,9 +429,15 @@ class UploadDocs(Docs):
         callbacks: list[Callable] | None = None,
         embedding_model: EmbeddingModel | None = None,
         summary_llm_model: LLMModel | None = None,
+        filters: ChunkFilter | None = None,
+        matches: list[Text] | None = None,
+        deadline: float | None = None,
     ) -> Answer:
-        supabase = await create_async_client(self.supabase_url, self.supabase_service_key)
+        """Summarize evidence for the question, `matches` skips retrieval when given.
 
+        `deadline` is an event loop time (`loop.time()`), summaries still pending then are
+        cancelled and TimeoutError is raised.
+        """
         evidence_settings = get_settings(settings)
         answer_config = evidence_settings.answer
         prompt_config = evidence_settings.prompts
@@ -131,14 +448,19 @@ class UploadDocs(Docs):
             else query
         )
 
-        num_chunks_response = (
-            await supabase.table("chunks")
-            .select("id", count="exact")
-            .execute()
-        )
+        # a loaded, non-empty index already answers whether there is anything to search
+        if matches is None and not (self.store.loaded and len(self.store.chunks)):
+            supabase = await self.store.client()
+            with span("evidence.count"):
+                num_chunks_response = (
+                    await supabase.table("chunks")
+                    .select("id", count="exact")
+                    .limit(1)
+                    .execute()
+                )
 
-        if not self.docs and num_chunks_response.count == 0:
-            return answer
+            if not self.docs and num_chunks_response.count == 0:
+                return answer
 
         if embedding_model is None:
             embedding_model = evidence_settings.get_embedding_model()
@@ -149,27 +471,24 @@ class UploadDocs(Docs):
         exclude_text_filter = exclude_text_filter or set()
         exclude_text_filter |= {c.text.name for c in answer.contexts}
 
-        _k = answer_config.evidence_k
-        if exclude_text_filter:
-            _k += len(
-                exclude_text_filter
-            )  # heuristic - get enough so we can downselect
-
-        if answer_config.evidence_retrieval:
-            matches = await self.retrieve_texts(
-                answer.question, _k, evidence_settings, embedding_model
-            )
+        if matches is not None:
+            matches = [m for m in matches if m.name not in exclude_text_filter]
+        elif answer_config.evidence_retrieval:
+            # excluded texts are masked inside the search instead of over-fetching
+            if exclude_text_filter:
+                filters = (filters or ChunkFilter()).excluding(texts=exclude_text_filter)
+            async with asyncio.timeout_at(deadline):
+                matches = await self.retrieve_texts(
+                    answer.question,
+                    answer_config.evidence_k,
+                    evidence_settings,
+                    embedding_model,
+                    filters=filters,
+                )
         else:
             matches = self.texts
-
-        if exclude_text_filter:
-            matches = [m for m in matches if m.text not in exclude_text_filter]
-
-        matches = (
-            matches[: answer_config.evidence_k]
-            if answer_config.evidence_retrieval
-            else matches
-        )
+            if exclude_text_filter:
+                matches = [m for m in matches if m.text not in exclude_text_filter]
 
         prompt_runner: PromptRunner | None = None
         if not answer_config.evidence_skip_summary:
@@ -185,32 +504,192 @@ class UploadDocs(Docs):
                     prompt_config.summary,
                     system_prompt=prompt_config.system,
                 )
+            # rate limits are per process, queries share the budget round-robin
+            prompt_runner = llm_scheduler.prompt_runner(
+                prompt_runner, summary_llm_model.name, query_id=answer.id
+            )
 
-        with set_llm_answer_ids(answer.id):
-            results = await gather_with_concurrency(
-                answer_config.max_concurrent_requests,
-                [
-                    map_fxn_summary(
-                        text=m,
-                        question=answer.question,
-                        prompt_runner=prompt_runner,
-                        extra_prompt_data={
-                            "summary_length": answer_config.evidence_summary_length,
-                            "citation": f"{m.name}: {m.doc.citation}",
-                        },
-                        parser=llm_parse_json if prompt_config.use_json else None,
-                        callbacks=callbacks,
+        # chunks digested at upload need no summary, see UploadDocs.chunk_digests
+        digested: dict[int, Context] = {}
+        if getattr(answer_config, "evidence_from_digests", False):
+            digested = {
+                # digests aren't scored for the question, the retrieval rank stands in
+                i: digest_context(m, score=rank_score(i, len(matches)))
+                for i, m in enumerate(matches)
+                if getattr(m, "digest", None)
+            }
+        to_summarize = [m for i, m in enumerate(matches) if i not in digested]
+        if isinstance(answer, AnswerQuotesFormatted):
+            answer.digested_contexts += len(digested)
+
+        summarize = map_fxn_summary
+        if prompt_runner is not None:
+            # only summary LLM calls are timed, plan_query estimates queries from them
+            summarize = traced("evidence.summary")(map_fxn_summary)
+        with set_llm_answer_ids(answer.id), span("evidence.summaries", count=len(to_summarize)):
+            summaries = [
+                summarize(
+                    text=m,
+                    question=answer.question,
+                    prompt_runner=prompt_runner,
+                    extra_prompt_data={
+                        "summary_length": answer_config.evidence_summary_length,
+                        "citation": f"{m.name}: {m.doc.citation}",
+                    },
+                    parser=llm_parse_json if prompt_config.use_json else None,
+                    callbacks=callbacks,
+                )
+                for m in to_summarize
+            ]
+            try:
+                # cancelling the gather cancels every summary still running or queued
+                async with asyncio.timeout_at(deadline):
+                    summarized = iter(
+                        await gather_with_concurrency(
+                            answer_config.max_concurrent_requests, summaries
+                        )
                     )
-                    for m in matches
-                ],
-            )
+            finally:
+                # summaries cancelled while queued were never started
+                for summary in summaries:
+                    summary.close()
+        results = [
+            (digested[i], LLMResult(model="", date="")) if i in digested else next(summarized)
+            for i in range(len(matches))
+        ]
+
+        if answer_config.evidence_skip_summary:
+            # unsummarized contexts all score 5, keep the retrieval order instead
+            for rank, (r, _) in enumerate(results):
+                r.score = len(results) - rank
 
         for _, llm_result in results:
             answer.add_tokens(llm_result)
+            if llm_result.model:
+                record_llm_result(llm_result)
+
+        def locate_quotes() -> None:
+            for (r, _), m in zip(results, matches, strict=True):
+                if r is not None:
+                    locate_context_quotes(r, m)
+
+        # quote offsets for highlighting, instead of asking the LLM to find them again,
+        # fuzzy matching is CPU bound so it runs off the event loop
+        with span("evidence.locate_quotes"):
+            await asyncio.to_thread(locate_quotes)
 
         answer.contexts += [r for r, _ in results if r is not None]
         return answer
 
+    async def _unique_docname(self, supabase: AsyncClient, docname: str) -> str:
+        """Suffix `docname` so it is unique in the documents table, not only in this Docs."""
+        if not await self.store.has_column("documents", "docname"):
+            # names are derived from citations on load, see SupabaseStore._add_documents
+            return unique_docname(docname, set(self.docnames))
+        response = (
+            await supabase.table("documents")
+            .select("docname")
+            .like("docname", f"{docname}*")
+            .execute()
+        )
+        taken = {row.get("docname") for row in response.data} | set(self.docnames)
+        return unique_docname(docname, taken)
+
+    @staticmethod
+    async def _delete_document_rows(supabase: AsyncClient, dockey: DocKey) -> None:
+        """Delete a document and its chunks, their vectors go with them."""
+        try:
+            await supabase.table("chunks").delete().eq("document", dockey).execute()
+            await supabase.table("documents").delete().eq("id", dockey).execute()
+        except Exception:
+            logger.exception(f"Could not delete the partial upload of {dockey}")
+
+    async def _embed_versions(
+        self,
+        versions: Sequence[EmbeddingVersion],
+        texts: list[str],
+        embedding_model: EmbeddingModel,
+        embeddings: list[list[float]],
+    ) -> dict[str, list[list[float]]]:
+        """Vectors of `texts` for every version, reusing `embeddings` where the model matches."""
+        by_model = {embedding_model.name: embeddings}
+        for version in versions:
+            if version.model not in by_model:
+                model = embedding_model_factory(version.model)
+                by_model[version.model] = await model.embed_documents(texts=texts)
+                record_embedding(version.model, texts)
+        return {version.version: by_model[version.model] for version in versions}
+
+    async def _run_ingest_prompt(
+        self,
+        llm_model: LLMModel,
+        prompt: str,
+        data: dict,
+        cacheable: Callable[[str], bool] | None = None,
+        **kwargs,
+    ) -> LLMResult:
+        """Run an ingestion prompt, through the prompt cache when there is one."""
+        if self.prompt_cache is None:
+            result = await llm_model.run_prompt(prompt=prompt, data=data, **kwargs)
+        else:
+            result, cached = await self.prompt_cache.run_prompt(
+                llm_model, prompt, data, cacheable=cacheable, **kwargs
+            )
+            if cached:
+                metrics.increment("llm_cache_hits", llm_model.name)
+                return result
+        record_llm_result(result)
+        return result
+
+    async def _digest_chunks(
+        self, texts: list[TextPlus], settings: Settings, llm_model: LLMModel
+    ) -> None:
+        """Set the `digest` of every chunk, left None where digesting it fails."""
+
+        async def make_digest(text: TextPlus) -> dict | None:
+            data = {
+                "citation": f"{text.name}: {text.doc.citation}",
+                "text": text.text,
+                "summary_length": settings.answer.evidence_summary_length,
+            }
+            result = await llm_scheduler.run(
+                llm_model.name,
+                lambda: self._run_ingest_prompt(
+                    llm_model,
+                    digest_prompt,
+                    data,
+                    cacheable=parses_to_digest,
+                    system_prompt=digest_json_system_prompt_with_quote,
+                ),
+                estimated_tokens=estimate_tokens(
+                    digest_prompt, digest_json_system_prompt_with_quote, *data.values()
+                ),
+                query_id=text.doc.dockey,
+            )
+            parsed = llm_parse_json(result.text)
+            if not parsed.get("summary"):
+                return None
+            return {
+                "summary": strip_citations(str(parsed["summary"])),
+                "points": [
+                    {"quote": str(p["quote"]), "point": str(p.get("point") or "")}
+                    for p in parsed.get("points") or []
+                    if isinstance(p, dict) and p.get("quote")
+                ],
+            }
+
+        async def digest(text: TextPlus) -> None:
+            # queries summarize chunks without a digest, so one failure shouldn't fail the upload
+            try:
+                text.digest = await make_digest(text)
+            except Exception as e:
+                logger.warning(f"Could not digest {text.name}: {e!r}")
+
+        await gather_with_concurrency(
+            settings.answer.max_concurrent_requests, [digest(t) for t in texts]
+        )
+
+    @traced("aupload")
     async def aupload(  # noqa: PLR0912
         self,
         path: Path,
@@ -224,19 +703,38 @@ class UploadDocs(Docs):
         settings: MaybeSettings = None,
         llm_model: LLMModel | None = None,
         embedding_model: EmbeddingModel | None = None,
+        progress_callback: Callable[[str], None] | None = None,
+        summary_llm_model: LLMModel | None = None,
         **kwargs,
     ) -> str | None:
-        """Add a document to the collection."""
+        """Add a document to the collection.
+
+        `progress_callback` is called with the name of each stage as it starts, see
+        jobs.UPLOAD_STAGES.
+        """
+        def progress(stage: str) -> None:
+            if progress_callback is not None:
+                progress_callback(stage)
+
         all_settings = get_settings(settings)
         parse_config = all_settings.parsing
+        if 0 < parse_config.chunk_size <= parse_config.overlap:
+            # paperqa's chunkers would never finish
+            raise ValueError(
+                f"Chunk overlap ({parse_config.overlap}) must be smaller than the chunk size"
+                f" ({parse_config.chunk_size})"
+            )
 
-        supabase = await create_async_client(self.supabase_url, self.supabase_service_key)
+        supabase = await self.store.client()
 
         if llm_model is None:
             llm_model = all_settings.get_llm()
+        # title, authors and DOI from the combined citation prompt
+        citation_json: dict | None = None
         if citation is None:
+            progress("citation")
             # Peek first chunk
-            texts = read_doc(
+            texts = self.read_doc(
                 path,
                 Doc(docname="", citation="", dockey=dockey),  # Fake doc
                 chunk_chars=parse_config.chunk_size,
@@ -244,78 +742,67 @@ class UploadDocs(Docs):
                 page_size_limit=parse_config.page_size_limit,
             )
             if not texts:
-                raise ValueError(f"Could not read document {path}. Is it empty?")
-            result = await llm_model.run_prompt(
-                prompt=parse_config.citation_prompt,
-                data={"text": texts[0].text},
-                skip_system=True,  # skip system because it's too hesitant to answer
-            )
-            citation = result.text
-            if (
-                len(citation) < 3  # noqa: PLR2004
-                or "Unknown" in citation
-                or "insufficient" in citation
-            ):
-                citation = f"Unknown, {os.path.basename(path)}, {datetime.now().year}"
+                raise DocumentRejected(f"Could not read document {path}. Is it empty?")
+            with span("upload.citation"):
+                if self.combined_citation and parse_config.use_doc_details:
+                    result = await self._run_ingest_prompt(
+                        llm_model,
+                        CITATION_JSON_PROMPT,
+                        {"text": texts[0].text},
+                        cacheable=parses_to_citation,
+                        skip_system=True,
+                    )
+                    citation_json = parse_citation_json(result.text) or {}
+                    citation = str(citation_json.get("citation") or "")
+                else:
+                    result = await self._run_ingest_prompt(
+                        llm_model,
+                        parse_config.citation_prompt,
+                        {"text": texts[0].text},
+                        cacheable=usable_citation,
+                        skip_system=True,  # skip system because it's too hesitant to answer
+                    )
+                    citation = result.text
+            if not usable_citation(citation):
+                citation = f"Unknown, {os.path.basename(path)}, {datetime.datetime.now().year}"
         
         # Generate dockey from citation info to support dedup
         if dockey is None:
             dockey = generate_dockey(citation)
 
         if docname is None:
-            # get first name and year from citation
-            match = re.search(r"([A-Z][a-z]+)", citation)
-            if match is not None:
-                author = match.group(1)
-            else:
-                # panicking - no word??
-                raise ValueError(
-                    f"Could not parse docname from citation {citation}. "
-                    "Consider just passing key explicitly - e.g. docs.py "
-                    "(path, citation, key='mykey')"
-                )
-            year = ""
-            match = re.search(r"(\d{4})", citation)
-            if match is not None:
-                year = match.group(1)
-            docname = f"{author}{year}"
-        docname = self._get_unique_name(docname)
+            docname = docname_from_citation(citation)
 
         doc = Doc(docname=docname, citation=citation, dockey=dockey)
 
+        progress("metadata")
         # try to extract DOI / title from the citation
         if (doi is title is None) and parse_config.use_doc_details:
-            # TODO: specify a JSON schema here when many LLM providers support this
-            result = await llm_model.run_prompt(
-                prompt=parse_config.structured_citation_prompt,
-                data={"citation": citation},
-                skip_system=True,
-            )
-            # This code below tries to isolate the JSON
-            # based on observed messages from LLMs
-            # it does so by isolating the content between
-            # the first { and last } in the response.
-            # Since the anticipated structure should  not be nested,
-            # we don't have to worry about nested curlies.
-            clean_text = result.text.split("{", 1)[-1].split("}", 1)[0]
-            clean_text = "{" + clean_text + "}"
-            try:
-                citation_json = json.loads(clean_text)
+            if citation_json is None:
+                # TODO: specify a JSON schema here when many LLM providers support this
+                with span("upload.structured_citation"):
+                    result = await self._run_ingest_prompt(
+                        llm_model,
+                        parse_config.structured_citation_prompt,
+                        {"citation": citation},
+                        cacheable=lambda text: parse_citation_json(text) is not None,
+                        skip_system=True,
+                    )
+                citation_json = parse_citation_json(result.text)
+            if citation_json is None:
+                logger.warning(
+                    "Failed to parse all of title, DOI, and authors from the"
+                    " ParsingSettings.structured_citation_prompt's response"
+                    f" {result.text}, consider using a manifest file or specifying a"
+                    " different citation prompt."
+                )
+            else:
                 if citation_title := citation_json.get("title"):
                     title = citation_title
                 if citation_doi := citation_json.get("doi"):
                     doi = citation_doi
                 if citation_author := citation_json.get("authors"):
                     authors = citation_author
-            except (json.JSONDecodeError, AttributeError):
-                # json.JSONDecodeError: clean_text was not actually JSON
-                # AttributeError: citation_json was not a dict (e.g. a list)
-                logger.warning(
-                    "Failed to parse all of title, DOI, and authors from the"
-                    " ParsingSettings.structured_citation_prompt's response"
-                    f" {clean_text}, consider using a manifest file or specifying a"
-                    " different citation prompt."
-                )
         # see if we can upgrade to DocDetails
         # if not, we can progress with a normal Doc
         # if "overwrite_fields_from_metadata" is used:
@@ -323,6 +810,9 @@ class UploadDocs(Docs):
         if (title or doi) and parse_config.use_doc_details:
             if kwargs.get("metadata_client"):
                 metadata_client = kwargs["metadata_client"]
+            elif self.metadata_client is not None and not {"session", "clients"} & kwargs.keys():
+                # shared by every upload, so concurrent lookups are cached and rate limited
+                metadata_client = self.metadata_client
             else:
                 metadata_client = DocMetadataClient(
                     session=kwargs.pop("session", None),
@@ -338,87 +828,217 @@ class UploadDocs(Docs):
             if title:
                 query_kwargs["title"] = title
             
-            doc = await metadata_client.upgrade_doc_to_doc_details(
-                doc, **(query_kwargs | kwargs)
-            )
+            with span("upload.metadata"):
+                doc = await metadata_client.upgrade_doc_to_doc_details(
+                    doc, **(query_kwargs | kwargs)
+                )
 
             # Revert UUID dockey
             doc.dockey = dockey
 
-        embedding_model = all_settings.get_embedding_model()
+        if embedding_model is None:
+            embedding_model = all_settings.get_embedding_model()
         if not embedding_model:
             raise ValueError(f"Invalid embedding_model {embedding_model}")
 
+        # new documents get vectors in every version that may become active
+        versions = [v for v in await fetch_versions(supabase) if v.status != "retired"]
+        legacy = not versions or await fetch_active_version(supabase) is None
+
         abstract_emb = None
+        abstract_embs = {}
         if abstract:
             abstract_emb = (await embedding_model.embed_documents(texts=[abstract]))[0]
+            record_embedding(embedding_model.name, [abstract])
+            abstract_embs = await self._embed_versions(
+                versions, [abstract], embedding_model, [abstract_emb]
+            )
 
         # Upload document to `documents` table
+        base_docname = doc.docname
+        docname_column = await self.store.has_column("documents", "docname")
+        created = False
+        for _ in range(MAX_DOCNAME_ATTEMPTS):
+            doc.docname = await self._unique_docname(supabase, base_docname)
+            row = {
+                "id": dockey,
+                "title": title,
+                "abstract": abstract,
+                "abstract_emb": abstract_emb if legacy else None,
+                "citation": citation,
+                "authors": authors,
+                "published_at": kwargs.get("published_at"),
+            }
+            if docname_column:
+                row["docname"] = doc.docname
+            try:
+                response = await supabase.table("documents").insert(row).execute()
+                if not len(response.data):
+                    raise ValueError("Document not inserted")
+                created = True
+                break
+
+            except APIError as e:
+                if not e.message.startswith("duplicate key"):
+                    raise e
+                if "docname" in e.message:
+                    # another upload took the name after we checked it
+                    continue
+                if not kwargs.get("ignore_duplicate_doc"):
+                    raise DocumentRejected("Another document with the same citation has already been uploaded previously")
+                if not docname_column:
+                    break
+                # chunks must carry the name the document was stored with
+                response = (
+                    await supabase.table("documents")
+                    .select("docname")
+                    .eq("id", dockey)
+                    .execute()
+                )
+                if response.data and response.data[0].get("docname"):
+                    doc.docname = response.data[0]["docname"]
+                break
+        else:
+            raise ValueError(f"Could not find a unique docname for {base_docname}")
         try:
-            response = (
-                await supabase.table("documents")
-                .insert(
-                    {
-                        "id": dockey,
-                        "title": title,
-                        "abstract": abstract,
-                        "abstract_emb": abstract_emb,
-                        "citation": citation,
-                        "authors": authors,
-                        "published_at": kwargs.get("published_at"),
-                    }
+            if abstract_embs:
+                await (
+                    supabase.table("document_embeddings")
+                    .upsert(
+                        [
+                            {"document": dockey, "version": version, "embedding": e[0]}
+                            for version, e in abstract_embs.items()
+                        ],
+                        on_conflict="document,version",
+                    )
+                    .execute()
                 )
-                .execute()
-            )
-            if not len(response.data):
-                raise ValueError("Document not inserted")
 
-        except APIError as e:
-            if e.message.startswith("duplicate key"):
-                if kwargs.get("ignore_duplicate_doc"):
-                    pass
-                else:
-                    raise ValueError("Another document with the same citation has already been uploaded previously")
-            else:
-                raise e
+            progress("parse")
+            # Read document and chunk text
+            with span("upload.parse"):
+                texts = self.read_doc(
+                    path,
+                    doc,
+                    chunk_chars=parse_config.chunk_size,
+                    overlap=parse_config.overlap,
+                    page_size_limit=parse_config.page_size_limit,
+                )
+            # loose check to see if document was loaded
+            if (
+                not texts
+                or len(texts[0].text) < 10  # noqa: PLR2004
+                or (
+                    not parse_config.disable_doc_valid_check
+                    and not maybe_is_text(texts[0].text)
+                )
+            ):
+                raise DocumentRejected(
+                    f"This does not look like a text document: {path}. Pass disable_check"
+                    " to ignore this error."
+                )
 
-        # Read document and chunk text
-        texts = read_doc(
-            path,
-            doc,
-            chunk_chars=parse_config.chunk_size,
-            overlap=parse_config.overlap,
-            page_size_limit=parse_config.page_size_limit,
-        )
-        # loose check to see if document was loaded
-        if (
-            not texts
-            or len(texts[0].text) < 10  # noqa: PLR2004
-            or (
-                not parse_config.disable_doc_valid_check
-                and not maybe_is_text(texts[0].text)
-            )
-        ):
-            raise ValueError(
-                f"This does not look like a text document: {path}. Pass disable_check"
-                " to ignore this error."
+            # Retrieve page numbers
+            for i, t in enumerate(texts):
+                texts[i] = TextPlus.from_text(t)
+            if str(path).endswith(".pdf"):
+                # lets quotes be located on their page, the parse is cached
+                page_starts = chunk_page_starts(
+                    self.parse(path, parse_config.page_size_limit),
+                    chunk_chars=parse_config.chunk_size,
+                    overlap=parse_config.overlap,
+                )
+                if len(page_starts) == len(texts):
+                    for t, starts in zip(texts, page_starts, strict=True):
+                        t.page_starts = starts
+
+            progress("embed")
+            with span("upload.embed", count=len(texts)):
+                embeddings = await embedding_model.embed_documents(texts=[t.text for t in texts])
+            record_embedding(embedding_model.name, [t.text for t in texts])
+            for t, t_embedding in zip(texts, embeddings, strict=True):
+                t.embedding = t_embedding
+            version_embeddings = await self._embed_versions(
+                versions, [t.text for t in texts], embedding_model, embeddings
             )
 
-        # Retrieve page numbers
-        for i, t in enumerate(texts):
-            texts[i] = TextPlus.from_text(t)
+            if self.chunk_digests:
+                progress("digest")
+                with span("upload.digest", count=len(texts)):
+                    await self._digest_chunks(
+                        texts, all_settings, summary_llm_model or all_settings.get_summary_llm()
+                    )
+
+            progress("insert")
+            page_starts_column = await self.store.has_column("chunks", "page_starts")
+            with span("upload.insert", count=len(texts)):
+                # every insert settles before a failure cleans up after them
+                chunk_ids = await asyncio.gather(
+                    *[
+                        upload_chunk(t, supabase, legacy=legacy, page_starts=page_starts_column)
+                        for t in texts
+                    ],
+                    return_exceptions=True,
+                )
+                for result in chunk_ids:
+                    if isinstance(result, BaseException):
+                        raise result
+                for version, vectors in version_embeddings.items():
+                    await (
+                        supabase.table("chunk_embeddings")
+                        .insert(
+                            [
+                                {"chunk": chunk_id, "version": version, "embedding": e}
+                                for chunk_id, e in zip(chunk_ids, vectors, strict=True)
+                            ]
+                        )
+                        .execute()
+                    )
+        except BaseException:
+            if created:
+                # leave nothing behind, so a retry of the upload can insert the document again
+                await self._delete_document_rows(supabase, dockey)
+            raise
+
+        # keep an already loaded index in sync without reloading the whole table
+        if isinstance(self.texts_index, SupabaseStore) and self.texts_index.loaded:
+            loaded_version = self.texts_index.chunks.embedding_version
+            if loaded_version is not None:
+                if loaded_version not in version_embeddings:
+                    # picked up by the next reload instead
+                    return None
+                for t, t_embedding in zip(texts, version_embeddings[loaded_version], strict=True):
+                    t.embedding = t_embedding
+            self.texts_index.add_texts_and_embeddings(texts, ids=chunk_ids)
 
-        for t, t_embedding in zip(
-            texts,
-            await embedding_model.embed_documents(texts=[t.text for t in texts]),
-            strict=True,
-        ):
-            t.embedding = t_embedding
-        
-        await asyncio.gather(*[upload_chunk(t, supabase) for t in texts])
-        
         return None
 
+    def query(
+        self,
+        query: Answer | str,
+        settings: MaybeSettings = None,
+        callbacks: list[Callable] | None = None,
+        llm_model: LLMModel | None = None,
+        summary_llm_model: LLMModel | None = None,
+        embedding_model: EmbeddingModel | None = None,
+        filters: ChunkFilter | None = None,
+        timeout: float | None = None,
+    ) -> AnswerQuotesFormatted:
+        loop = get_loop()
+        return loop.run_until_complete(
+            self.aquery(
+                query,
+                settings=settings,
+                callbacks=callbacks,
+                llm_model=llm_model,
+                summary_llm_model=summary_llm_model,
+                embedding_model=embedding_model,
+                filters=filters,
+                deadline=None if timeout is None else loop.time() + timeout,
+            )
+        )
+
+    @traced("aquery")
     async def aquery(  # noqa: PLR0912
         self,
         query: Answer | str,
@@ -427,8 +1047,17 @@ class UploadDocs(Docs):
         llm_model: LLMModel | None = None,
         summary_llm_model: LLMModel | None = None,
         embedding_model: EmbeddingModel | None = None,
+        filters: ChunkFilter | None = None,
+        deadline: float | None = None,
+        latency_budget: float | None = None,
     ) -> AnswerQuotesFormatted:
+        """Answer the question, raising TimeoutError once the `deadline` loop time passes.
 
+        Any LLM calls still pending at the deadline are cancelled. With a
+        `latency_budget` in seconds, the evidence is gathered in the most thorough mode
+        expected to finish in time, see latency_budget.plan_query, and the mode is
+        reported in the answer's `plan`.
+        """
         query_settings = get_settings(settings)
         answer_config = query_settings.answer
         prompt_config = query_settings.prompts
@@ -448,26 +1077,76 @@ class UploadDocs(Docs):
 
         contexts = answer.contexts
 
+        # answers are only reused under the same settings and filters
+        cache_partition = json.dumps(
+            [query_settings.md5, filters.cache_key() if filters else None]
+        )
+        plan: QueryPlan | None = None
+        if latency_budget is not None and not contexts:
+            if deadline is not None:
+                latency_budget = min(
+                    latency_budget, deadline - asyncio.get_running_loop().time()
+                )
+            plan = plan_query(
+                latency_budget,
+                answer_config.evidence_k,
+                answer_config.max_concurrent_requests,
+                digested=(
+                    self.store.chunks.num_digests / len(self.store.chunks)
+                    if self.chunk_digests
+                    and hasattr(answer_config, "evidence_from_digests")
+                    and self.store.loaded
+                    and len(self.store.chunks)
+                    else 0.0
+                ),
+            )
+            logger.info(f"Answering in {plan.mode} mode within {latency_budget:.1f}s")
+        if not contexts and (
+            self.answer_cache_threshold is not None or (plan and plan.mode == "cache_only")
+        ):
+            with span("answer_cache"):
+                cached = await self._cached_answer(cache_partition, answer, embedding_model)
+            if cached is not None:
+                cached.plan = plan
+                return cached
+        if plan is not None:
+            answer.plan = plan
+            if plan.mode == "cache_only":
+                answer.answer = "I cannot answer this question within the latency budget."
+                answer.formatted_answer = f"Question: {answer.question}\n\n{answer.answer}\n"
+                return answer
+            if plan.mode != "full":
+                query_settings = query_settings.model_copy(deep=True)
+                answer_config = query_settings.answer
+                answer_config.evidence_k = plan.evidence_k
+                answer_config.evidence_skip_summary = plan.mode == "skip_summary"
+                if plan.mode == "digest":
+                    answer_config.evidence_from_digests = True
+
         if not contexts:
             answer = await self.aget_evidence(
                 answer,
                 callbacks=callbacks,
-                settings=settings,
+                settings=query_settings,
                 embedding_model=embedding_model,
                 summary_llm_model=summary_llm_model,
+                filters=filters,
+                deadline=deadline,
             )
             contexts = answer.contexts
         pre_str = None
         if prompt_config.pre is not None:
             with set_llm_answer_ids(answer.id):
-                pre = await llm_model.run_prompt(
-                    prompt=prompt_config.pre,
-                    data={"question": answer.question},
-                    callbacks=callbacks,
-                    name="pre",
-                    system_prompt=prompt_config.system,
-                )
+                async with asyncio.timeout_at(deadline):
+                    pre = await llm_model.run_prompt(
+                        prompt=prompt_config.pre,
+                        data={"question": answer.question},
+                        callbacks=callbacks,
+                        name="pre",
+                        system_prompt=prompt_config.system,
+                    )
             answer.add_tokens(pre)
+            record_llm_result(pre)
             pre_str = pre.text
 
         # sort by first score, then name
@@ -487,16 +1166,33 @@ class UploadDocs(Docs):
         ):
             context_inner_prompt = context_inner_prompt.replace("\nFrom {citation}", "")
 
-        inner_context_strs = [
-            context_inner_prompt.format(
+        def render_context(c: Context) -> str:
+            return context_inner_prompt.format(
                 name=c.text.name,
                 text=c.context,
-                quotes="\n".join(f"quote{i+1}: \"{p['quote']}\"" for i, p in enumerate(c.points)),
+                quotes="\n".join(
+                    f"quote{i+1}: \"{p['quote']}\""
+                    # unsummarized contexts have no quotes
+                    for i, p in enumerate((c.model_extra or {}).get("points") or [])
+                ),
                 citation=c.text.doc.citation,
                 **(c.model_extra or {}),
             )
-            for c in filtered_contexts
-        ]
+
+        # quotes are renumbered after dedup, so the bib below must use the packed contexts
+        with span("pack_contexts") as packing_span:
+            filtered_contexts, inner_context_strs, packing = await asyncio.to_thread(
+                pack_contexts,
+                filtered_contexts,
+                render_context,
+                token_budget=getattr(answer_config, "answer_context_token_budget", None),
+            )
+        packing_span.attributes.update(packing.model_dump(exclude_none=True))
+        if packing.contexts_dropped or packing.quotes_dropped:
+            logger.info(
+                f"Dropped {packing.contexts_dropped} contexts and {packing.quotes_dropped}"
+                f" quotes ({packing.tokens_dropped} tokens) from the answer prompt."
+            )
         if pre_str:
             inner_context_strs += (
                 [f"Extra background information: {pre_str}"] if pre_str else []
@@ -513,22 +1209,31 @@ class UploadDocs(Docs):
                 "I cannot answer this question due to insufficient information."
             )
         else:
-            with set_llm_answer_ids(answer.id):
-                answer_result = await llm_model.run_prompt(
-                    prompt=prompt_config.qa,
-                    data={
-                        "context": context_str,
-                        "answer_length": answer_config.answer_length,
-                        "question": answer.question,
-                        "example_citation": prompt_config.EXAMPLE_CITATION,
-                        "example_citation_quote": prompt_config.example_citation_quote,
-                    },
-                    callbacks=callbacks,
-                    name="answer",
-                    system_prompt=prompt_config.system,
-                )
+            with set_llm_answer_ids(answer.id), span("answer"):
+                async with asyncio.timeout_at(deadline):
+                    answer_result = await llm_scheduler.run(
+                        llm_model.name,
+                        lambda: llm_model.run_prompt(
+                            prompt=prompt_config.qa,
+                            data={
+                                "context": context_str,
+                                "answer_length": answer_config.answer_length,
+                                "question": answer.question,
+                                "example_citation": prompt_config.EXAMPLE_CITATION,
+                                "example_citation_quote": prompt_config.example_citation_quote,
+                            },
+                            callbacks=callbacks,
+                            name="answer",
+                            system_prompt=prompt_config.system,
+                        ),
+                        estimated_tokens=estimate_tokens(
+                            prompt_config.qa, context_str, prompt_config.system
+                        ),
+                        query_id=answer.id,
+                    )
             answer_text = answer_result.text
             answer.add_tokens(answer_result)
+            record_llm_result(answer_result)
         # it still happens
         if prompt_config.EXAMPLE_CITATION in answer_text:
             answer_text = answer_text.replace(prompt_config.EXAMPLE_CITATION, "")
@@ -555,15 +1260,17 @@ class UploadDocs(Docs):
 
         if prompt_config.post is not None:
             with set_llm_answer_ids(answer.id):
-                post = await llm_model.run_prompt(
-                    prompt=prompt_config.post,
-                    data=answer.model_dump(),
-                    callbacks=callbacks,
-                    name="post",
-                    system_prompt=prompt_config.system,
-                )
+                async with asyncio.timeout_at(deadline):
+                    post = await llm_model.run_prompt(
+                        prompt=prompt_config.post,
+                        data=answer.model_dump(),
+                        callbacks=callbacks,
+                        name="post",
+                        system_prompt=prompt_config.system,
+                    )
             answer_text = post.text
             answer.add_tokens(post)
+            record_llm_result(post)
             formatted_answer = f"Question: {answer.question}\n\n{post}\n"
             if bib:
                 formatted_answer += f"\nReferences\n\n{bib_str}\n"
@@ -576,5 +1283,133 @@ class UploadDocs(Docs):
         answer.context = context_str
         answer.filtered_contexts = filtered_contexts
         answer.bib = bib
+        answer.packing = packing
+
+        # answers of faster modes would stand in for full ones
+        if self.store.loaded and (plan is None or plan.mode == "full"):
+            # the question was embedded for retrieval, so this reuses that embedding
+            embedding = (
+                await self.store.embed_query(answer.question, embedding_model)
+                if self.answer_cache_threshold is not None
+                else None
+            )
+            self.answer_cache.put(
+                cache_partition,
+                answer.question,
+                self.store.corpus_version,
+                answer,
+                embedding=embedding,
+            )
+        return answer
+
+    async def _cached_answer(
+        self, partition: str, answer: AnswerQuotesFormatted, embedding_model: EmbeddingModel
+    ) -> AnswerQuotesFormatted | None:
+        """A copy of the cached answer to this or a similar question, None on a miss."""
+        if not self.store.loaded:
+            # nothing was answered from this index yet
+            return None
+        embedding = None
+        if self.answer_cache_threshold is not None:
+            embedding = await self.store.embed_query(answer.question, embedding_model)
+        hit = self.answer_cache.get(
+            partition, answer.question, self.store.corpus_version, embedding=embedding
+        )
+        if hit is None:
+            return None
+        cached_answer, cached = hit
+        cached_answer = cached_answer.model_copy(deep=True)
+        cached_answer.question = answer.question
+        cached_answer.cached = cached
+        return cached_answer
+
+    async def aquery_batch(
+        self,
+        queries: Sequence[str],
+        settings: MaybeSettings = None,
+        callbacks: list[Callable] | None = None,
+        llm_model: LLMModel | None = None,
+        summary_llm_model: LLMModel | None = None,
+        embedding_model: EmbeddingModel | None = None,
+        filters: ChunkFilter | None = None,
+        deadline: float | None = None,
+    ) -> AsyncIterator[tuple[int, AnswerQuotesFormatted | Exception]]:
+        """Answer many questions, yielding (index, answer) as each one finishes.
+
+        Retrieval for the whole batch is one embedding call and one search, and every
+        summary and answer call goes through the shared LLM scheduler. Repeated questions
+        are answered once. A failed question yields its exception instead of an answer,
+        questions unanswered by the `deadline` loop time yield TimeoutError.
+        """
+        query_settings = get_settings(settings)
+        if llm_model is None:
+            llm_model = query_settings.get_llm()
+        if summary_llm_model is None:
+            summary_llm_model = query_settings.get_summary_llm()
+        if embedding_model is None:
+            embedding_model = query_settings.get_embedding_model()
+
+        indices: dict[str, list[int]] = {}
+        questions: list[str] = []
+        for i, question in enumerate(queries):
+            key = normalize_question(question)
+            if key not in indices:
+                indices[key] = []
+                questions.append(question)
+            indices[key].append(i)
 
-        return answer  
\ No newline at end of file
+        batch_matches: list[list[Text] | None] = [None] * len(questions)
+        if query_settings.answer.evidence_retrieval:
+            try:
+                async with asyncio.timeout_at(deadline):
+                    batch_matches = await self.retrieve_texts_batch(
+                        questions,
+                        query_settings.answer.evidence_k,
+                        query_settings,
+                        embedding_model,
+                        filters=filters,
+                    )
+            except Exception as e:
+                # retrieval is shared, so every question fails with it
+                for i in range(len(queries)):
+                    yield i, e
+                return
+
+        async def answer_question(question: str, matches: list[Text] | None):
+            answer = AnswerQuotesFormatted(question=question, config_md5=query_settings.md5)
+            answer = await self.aget_evidence(
+                answer,
+                settings=query_settings,
+                callbacks=callbacks,
+                embedding_model=embedding_model,
+                summary_llm_model=summary_llm_model,
+                filters=filters,
+                matches=matches,
+                deadline=deadline,
+            )
+            return await self.aquery(
+                answer,
+                settings=query_settings,
+                callbacks=callbacks,
+                llm_model=llm_model,
+                summary_llm_model=summary_llm_model,
+                embedding_model=embedding_model,
+                filters=filters,
+                deadline=deadline,
+            )
+
+        pending = {
+            asyncio.ensure_future(answer_question(question, matches)): question
+            for question, matches in zip(questions, batch_matches, strict=True)
+        }
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    question = pending.pop(task)
+                    result = task.exception() or task.result()
+                    for i in indices[normalize_question(question)]:
+                        yield i, result
+        finally:
+            for task in pending:
+                task.cancel()
@@ -1,5 +1,8 @@
-from pydantic import Field
+from collections.abc import Collection
+from datetime import datetime, timezone
+from pydantic import BaseModel, Field
 from typing import List
+import json
 import re
 
 import numpy as np
@@ -10,9 +13,17 @@ from paperqa.types import (
     Text,
 )
 
+from answer_cache import CachedAnswer
+from context_packing import ContextPacking
+from latency_budget import QueryPlan
+
 
 class TextPlus(Text):
     pages: List[int] = []
+    # offset in `text` where each of `pages` starts, see quote_locator.chunk_page_starts
+    page_starts: List[int] = []
+    # question-independent summary and quotes, see UploadDocs.chunk_digests
+    digest: dict | None = None
 
     @classmethod
     def from_text(cls, text: Text):
@@ -41,3 +52,142 @@ class TextPlus(Text):
 class AnswerQuotesFormatted(Answer):
     bib: dict[str, Context] = Field(default_factory=dict)
     filtered_contexts: list[Context] = Field(default_factory=list)
+    packing: ContextPacking | None = None
+    # set when answered within a latency budget
+    plan: QueryPlan | None = None
+    # set when answered from the answer cache
+    cached: CachedAnswer | None = None
+    # contexts taken from chunk digests instead of summarized, see UploadDocs.chunk_digests
+    digested_contexts: int = 0
+
+
+def docname_from_citation(citation: str) -> str:
+    """First capitalized word and year of the citation, e.g. Smith2024."""
+    match = re.search(r"([A-Z][a-z]+)", citation)
+    if match is not None:
+        author = match.group(1)
+    else:
+        # panicking - no word??
+        raise ValueError(
+            f"Could not parse docname from citation {citation}. "
+            "Consider just passing key explicitly - e.g. docs.py "
+            "(path, citation, key='mykey')"
+        )
+    year = ""
+    match = re.search(r"(\d{4})", citation)
+    if match is not None:
+        year = match.group(1)
+    return f"{author}{year}"
+
+
+def unique_docname(docname: str, taken: Collection[str]) -> str:
+    """Same suffixing as Docs._get_unique_name, against any set of names."""
+    suffix = ""
+    while docname + suffix in taken:
+        # move suffix to next letter
+        suffix = "a" if suffix == "" else chr(ord(suffix) + 1)
+    return docname + suffix
+
+
+def parse_timestamp(value: str | datetime | None) -> datetime | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    # treat naive timestamps as UTC so they compare with timestamptz columns
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def normalize_author(author: str) -> str:
+    """The lowercase words of a name without punctuation, "Doe, J." becomes "doe j"."""
+    return " ".join(re.findall(r"\w+", author.lower()))
+
+
+def normalize_authors(authors: list[str] | str | None) -> list[str]:
+    if not authors:
+        return []
+    if isinstance(authors, str):
+        authors = [authors]
+    return [name for a in authors if a and (name := normalize_author(a))]
+
+
+def author_matches(wanted: str, author: str) -> bool:
+    """Whether every word of `wanted` is a word of `author`, both normalized, in any order.
+
+    "li" matches "wei li" and "li wei" but not "william smith", a single letter matches
+    a word's initial, so "j doe" matches "jane doe".
+    """
+    words = author.split()
+    return all(
+        any(w == word or (len(w) == 1 and word.startswith(w)) for word in words)
+        for w in wanted.split()
+    )
+
+
+class ChunkFilter(BaseModel):
+    """Restricts a search to a subset of chunks, applied inside the vector search."""
+
+    dockeys: set[str] | None = Field(
+        default=None, description="Only search chunks from these documents"
+    )
+    exclude_dockeys: set[str] = Field(
+        default_factory=set, description="Never return chunks from these documents"
+    )
+    published_after: datetime | None = None
+    published_before: datetime | None = None
+    authors: list[str] | None = Field(
+        default=None,
+        description=(
+            "Only search documents with any of these authors, whole words of a name match"
+            " in any order and case"
+        ),
+    )
+    exclude_texts: set[str] = Field(
+        default_factory=set, description="Chunk names or chunk texts to skip"
+    )
+
+    def excluding(
+        self,
+        dockeys: set[str] | None = None,
+        texts: set[str] | None = None,
+    ) -> "ChunkFilter":
+        return self.model_copy(
+            update={
+                "exclude_dockeys": self.exclude_dockeys | (dockeys or set()),
+                "exclude_texts": self.exclude_texts | (texts or set()),
+            }
+        )
+
+    def cache_key(self) -> str:
+        """Stable string for the filter, set ordering varies between processes."""
+        data = self.model_dump(mode="json")
+        return json.dumps(
+            {k: sorted(v) if isinstance(v, list) else v for k, v in data.items()},
+            sort_keys=True,
+        )
+
+    def matches_document(
+        self,
+        dockey: str,
+        authors: list[str],
+        published_at: datetime | None,
+    ) -> bool:
+        """Check document-level fields, `authors` are expected to be normalized."""
+        if self.dockeys is not None and dockey not in self.dockeys:
+            return False
+        if dockey in self.exclude_dockeys:
+            return False
+        if self.published_after or self.published_before:
+            if published_at is None:
+                return False
+            if self.published_after and published_at < parse_timestamp(self.published_after):
+                return False
+            if self.published_before and published_at > parse_timestamp(self.published_before):
+                return False
+        if self.authors:
+            wanted = normalize_authors(self.authors)
+            if not any(author_matches(w, a) for w in wanted for a in authors):
+                return False
+        return True